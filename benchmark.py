@@ -0,0 +1,315 @@
+"""Benchmarks of the VM's hot paths
+
+    python3 benchmark.py [-o FILE] [--compare BASELINE] [--quick] [--repeat N] [--only NAME ...]
+
+Measures:
+
+* `ips`: instructions per second running the example programs at scaled sizes (`fibonacci.asm` with n numbers,
+  `p3.asm` with the factorial of n and `p4.asm` sorting n values)
+* `context_switches`: context switches per second with 1 to 1000 processes sharing the CPU
+* `load`: milliseconds to decode and load 1k lines of a program, with the program cache off
+* `frames`: frames allocated (and freed) per second with half of the memory in use
+* `io_trap`: microseconds per `TRAP` round trip, from the system call until its process runs again
+* `shell_load`: milliseconds per `load` shell command, at the median and the 99th percentile
+
+Every measurement is repeated and its median kept. The results are written as JSON (see `write_results`).
+`--compare` checks them against a baseline written by an earlier run. It prints how much faster or slower every
+measurement is, and exits with status 1 if any is slower by more than `--threshold`.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+from source.user.client import Client
+from source.vm.devices import ListInput, MemoryOutput
+from source.vm.virtual_machine import VirtualMachine
+
+PROGRAMS = Path(__file__).resolve().parent / 'example_programs'
+
+
+class Measurement(NamedTuple):
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool
+
+
+# Programs
+
+
+def _replace(source: str, old: str, new: str) -> str:
+    if old not in source:
+        raise ValueError(f'Cannot scale the program, {old!r} not found')
+    return source.replace(old, new)
+
+
+def fibonacci_source(n: int) -> str:
+    """`fibonacci.asm`, writing the first `n` Fibonacci numbers from address 50"""
+
+    return _replace((PROGRAMS / 'fibonacci.asm').read_text(), 'LDI R7, 60', f'LDI R7, {50 + n}')
+
+
+def factorial_source(n: int) -> str:
+    """`p3.asm`, computing `n!`"""
+
+    return _replace((PROGRAMS / 'p3.asm').read_text(), 'LDI R0, 6 ; N = 6', f'LDI R0, {n} ; N = {n}')
+
+
+def bubble_sort_source(n: int) -> str:
+    """`p4.asm`, sorting `n` random values"""
+
+    source = (PROGRAMS / 'p4.asm').read_text()
+    code, _, _ = source.partition('; LOAD RANDOMIZED ARRAY INTO MEMORY')
+    # The array starts at 300, with its size right before it, unless the longer loading code reaches that far
+    start = max(300, 50 + 2 * n)
+    source = _replace(_replace(code, 'LDI R1, 300', f'LDI R1, {start}'), '[298]', f'[{start - 2}]')
+    values = random.Random(n).choices(range(200), k=n)
+    loader = ''.join(f'LDI R0, {value}\nSTD [{start + i}], R0\n' for i, value in enumerate(values))
+    return _replace(source, 'LDI R0, 50', f'LDI R0, {n}') + f'; LOAD RANDOMIZED ARRAY INTO MEMORY\n{loader}JMPI R1\n'
+
+
+def _counter_loop(iterations: int, body: str = '') -> str:
+    # Runs `body` `iterations` times. `body` can't use R1 nor R6
+    lines = [f'LDI R1, {iterations}', 'LDI R6, 2', *body.splitlines(), 'SUBI R1, 1', 'JMPIG R6, R1', 'STOP']
+    return '\n'.join(lines)
+
+
+def _vm(mem_size: int = 4096, **kwargs) -> VirtualMachine:
+    vm = VirtualMachine(mem_size=mem_size, stdin=ListInput(()), stdout=MemoryOutput(), **kwargs)
+    # No `memory.dump` when the CPU stops: writing it takes longer than most runs, and it would land in the working
+    # directory
+    dump = vm.dump
+    vm.dump = lambda e=None, to_file=True: None if to_file else dump(e, to_file=False)
+    return vm
+
+
+def _run(vm: VirtualMachine) -> float:
+    # Seconds the VM takes to run every loaded process, until its CPU loop ends. Shutting the VM down isn't timed
+    loop, ended = vm.cpu.loop, []
+
+    def timed_loop():
+        try:
+            loop()
+        finally:
+            ended.append(perf_counter())
+
+    vm.cpu.loop = timed_loop
+    start = perf_counter()
+    vm.start()
+    vm.join()
+    return ended[0] - start
+
+
+# Benchmarks. Each runs once and returns its measurements
+
+
+def bench_ips(quick: bool) -> Iterable[Measurement]:
+    programs = [
+        ('fibonacci', fibonacci_source, (100, 500) if quick else (100, 1000, 5000)),
+        ('p3', factorial_source, (100, 500) if quick else (100, 1000, 5000)),
+        ('p4', bubble_sort_source, (10, 20) if quick else (10, 30, 60)),
+    ]
+    for name, source, sizes in programs:
+        for n in sizes:
+            vm = _vm(mem_size=16384)
+            vm.load_source(name, source(n), _print=False)
+            elapsed = _run(vm)
+            yield Measurement(f'ips.{name}.n={n}', vm.cpu.instructions_executed / elapsed, 'instructions/s', True)
+
+
+def bench_context_switches(quick: bool) -> Iterable[Measurement]:
+    for processes in (1, 10, 100) if quick else (1, 10, 100, 1000):
+        # About the same number of instructions however many processes share them
+        source = _counter_loop(max(10, (2000 if quick else 20000) // processes))
+        vm = _vm(mem_size=max(4096, 32 * processes))
+        for _ in range(processes):
+            vm.load_source('loop', source, _print=False)
+        elapsed = _run(vm)
+        yield Measurement(f'context_switches.processes={processes}', vm.process_manager.context_switches / elapsed,
+                          'switches/s', True)
+
+
+def bench_load(quick: bool) -> Iterable[Measurement]:
+    for lines in (1000,) if quick else (1000, 10000):
+        source = '\n'.join(f'LDI R{i % 8}, {i}' for i in range(lines - 1)) + '\nSTOP'
+        vm = _vm(mem_size=lines + 4096, program_cache_size=0)
+        try:
+            start = perf_counter()
+            vm.load_source('load', source, _print=False)
+            elapsed = perf_counter() - start
+        finally:
+            vm.end_threads = True
+        yield Measurement(f'load.lines={lines}', elapsed * 1000 / (lines / 1000), 'ms/1k lines', False)
+
+
+def bench_frames(quick: bool) -> Iterable[Measurement]:
+    vm = _vm(mem_size=65536)
+    try:
+        process_manager, memory = vm.process_manager, vm.memory
+        page_size = memory.page_size
+        process_manager.allocate(memory.frame_amount // 2 * page_size, 1)  # Held throughout
+        rounds, frames = (50 if quick else 500), 64
+        start = perf_counter()
+        for _ in range(rounds):
+            memory.deallocate(process_manager.allocate(frames * page_size, 2))
+        elapsed = perf_counter() - start
+    finally:
+        vm.end_threads = True
+    yield Measurement('frames.allocate', rounds * frames / elapsed, 'frames/s', True)
+
+
+def bench_io_trap(quick: bool) -> Iterable[Measurement]:
+    traps = 50 if quick else 500
+    # Writes memory position 20 to the output device `traps` times
+    source = _counter_loop(traps, 'LDI R8, 2\nLDI R9, 20\nTRAP R8, R9') + '\nDATA 0' * 16
+    vm = _vm()
+    vm.load_source('io', source, _print=False)
+    elapsed = _run(vm)
+    written = sum(len(values) for values in vm.stdout.by_process().values())
+    if written != traps:
+        raise RuntimeError(f'{written} values written by {traps} traps')
+    yield Measurement('io_trap.round_trip', elapsed * 1e6 / traps, 'us/trap', False)
+
+
+def bench_shell_load(quick: bool) -> Iterable[Measurement]:
+    requests = 20 if quick else 200
+    vm = _vm(mem_size=65536, create_shell_sock=True, shell_endpoint=0, keep_alive=True)
+    vm.start()
+    latencies = []
+    try:
+        with Client([vm.shell_address], pool_size=1) as client:
+            for _ in range(requests):
+                start = perf_counter()
+                client.load(str(PROGRAMS / 'fibonacci.asm'))
+                latencies.append(perf_counter() - start)
+    finally:
+        vm.shutdown()
+        vm.join()
+    latencies.sort()
+    yield Measurement('shell_load.p50', latencies[len(latencies) // 2] * 1000, 'ms', False)
+    yield Measurement('shell_load.p99', latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000, 'ms',
+                      False)
+
+
+BENCHMARKS: Dict[str, Callable[[bool], Iterable[Measurement]]] = {
+    'ips': bench_ips,
+    'context_switches': bench_context_switches,
+    'load': bench_load,
+    'frames': bench_frames,
+    'io_trap': bench_io_trap,
+    'shell_load': bench_shell_load,
+}
+
+
+# Running and comparing
+
+
+def run_benchmarks(names: Iterable[str] = None, repeat: int = 3, quick: bool = False) -> Dict[str, Any]:
+    """Run the benchmarks called `names` (every one by default) `repeat` times each
+
+    Returns:
+        Dict[str, Any]: The results, as written by `write_results`
+    """
+
+    samples: Dict[str, Tuple[Measurement, List[float]]] = {}
+    for name in names or BENCHMARKS:
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):  # The VMs print every program they load
+                measurements = list(BENCHMARKS[name](quick))
+            for measurement in measurements:
+                samples.setdefault(measurement.name, (measurement, []))[1].append(measurement.value)
+
+    return {
+        'meta': {
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': f'{platform.python_implementation()} {platform.python_version()}',
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'quick': quick,
+        },
+        'results': {name: {'value': statistics.median(values), 'unit': measurement.unit,
+                           'higher_is_better': measurement.higher_is_better, 'samples': values}
+                    for name, (measurement, values) in samples.items()},
+    }
+
+
+def write_results(results: Dict[str, Any], file: Path):
+    file.write_text(json.dumps(results, indent=4) + '\n')
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.1) -> Tuple[List[str], List[str]]:
+    """Compare results with a baseline, for the measurements they both have
+
+    Returns:
+        Tuple[List[str], List[str]]: Report lines, and the names of the measurements that are worse than the baseline
+            by more than `threshold` (0.1 is 10%)
+    """
+
+    lines = [f'{"MEASUREMENT":<36} {"BASELINE":>14} {"CURRENT":>14} {"CHANGE":>8}']
+    regressions = []
+    for name, current in results['results'].items():
+        if (previous := baseline['results'].get(name)) is None or not previous['value']:
+            continue
+        # Positive when it got better, whichever way better is
+        change = (current['value'] - previous['value']) / previous['value']
+        if not current['higher_is_better']:
+            change = -change
+        verdict = ''
+        if change < -threshold:
+            verdict = 'SLOWER'
+            regressions.append(name)
+        elif change > threshold:
+            verdict = 'faster'
+        lines.append(f'{name:<36} {previous["value"]:>14.2f} {current["value"]:>14.2f} {100 * change:>+7.1f}% '
+                     f'{verdict}'.rstrip())
+    return lines, regressions
+
+
+def report(results: Dict[str, Any]) -> List[str]:
+    return [f'{name:<36} {result["value"]:>14.2f} {result["unit"]}' for name, result in results['results'].items()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the VM\'s hot paths')
+    parser.add_argument('-o', '--output', type=Path, default=Path('benchmark.json'), metavar='FILE',
+                        help='where to write the results (default: %(default)s)')
+    parser.add_argument('--compare', type=Path, metavar='BASELINE',
+                        help='compare the results with those of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction by which a measurement may be worse than the baseline (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='runs of every benchmark, the median is kept (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a quick check')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), metavar='NAME',
+                        help=f'benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    results = run_benchmarks(args.only, args.repeat, args.quick)
+    write_results(results, args.output)
+    print('\n'.join(report(results)))
+    print(f'\nResults written to {args.output}')
+    if baseline is not None:
+        lines, regressions = compare(results, baseline, args.threshold)
+        print(f'\nCompared with {args.compare}:')
+        print('\n'.join(lines))
+        if regressions:
+            print(f'\n{len(regressions)} measurements are slower than the baseline: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
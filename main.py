@@ -10,17 +10,70 @@ import argparse
 import pathlib
 
 from glob import iglob
+from source.memory.scheduler import SCHEDULERS
+from source.vm.devices import FileInput, FileOutput, MappedBlockDevice
+from source.vm.dispatcher import Dispatcher
 from source.vm.virtual_machine import VirtualMachine
 
 
+def block_device(spec: str) -> MappedBlockDevice:
+    path, _, words = spec.rpartition(':')
+    if not path or not words.isdigit():
+        path, words = spec, None
+    try:
+        return MappedBlockDevice(path, int(words) if words is not None else None)
+    except (OSError, ValueError) as E:
+        raise argparse.ArgumentTypeError(str(E))
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='virtual machine emulator',
         epilog='star this on github: https://github.com/debemdeboas/virtual-machine'
     )
     parser.add_argument('programs', nargs='*', help='assembly files to be loaded and executed')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='decode the programs in parallel using N worker processes (0 uses every CPU)')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='optimize the programs on load (constant propagation, direct jumps, dead stores)')
+    parser.add_argument('--input', metavar='FILE', help='read the TRAP input values from FILE instead of the terminal')
+    parser.add_argument('--output', metavar='FILE', help='write the TRAP output values to FILE instead of the terminal')
+    parser.add_argument('--scheduler', choices=SCHEDULERS, default='round-robin',
+                        help='scheduling policy (default: %(default)s)')
+    parser.add_argument('--wakeup-preemption', action='store_true',
+                        help='let processes whose I/O has finished take the CPU right away')
+    parser.add_argument('--admission', choices=('reject', 'queue'), default='reject',
+                        help='what to do with programs that do not fit in the free memory (default: %(default)s)')
+    parser.add_argument('--budget', type=int, metavar='N',
+                        help='end any process that executes more than N instructions')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='keep running once every program has ended, waiting for jobs from the shell socket')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='run N VMs in worker processes behind a dispatcher that serves the shell socket '
+                             '(0 starts one per CPU). The dispatcher runs until the `shutdown` shell command, as with '
+                             '--keep-alive')
+    parser.add_argument('--shell', metavar='ADDRESS', default='localhost:8899',
+                        help='address of the shell socket: HOST:PORT, PORT (0 picks a free one) or unix:PATH for a '
+                             'Unix domain socket (default: %(default)s)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the VM, print a report when it stops and write the hot spots to FILE in the '
+                             'folded stack format of flamegraph tools')
+    parser.add_argument('--trace', type=int, default=0, metavar='N',
+                        help='keep a binary trace of the last N instructions, written to memory.trace if the CPU '
+                             'stops on a fault or on the `trace` shell command')
+    parser.add_argument('--block', metavar='FILE[:WORDS]', action='append', default=[], type=block_device,
+                        help='memory-map FILE as a block device, numbered in the order they are given. The file is '
+                             'created, or grown, to WORDS 64-bit words if given')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.workers is not None:
+        # Each worker has a VM of its own, in another process: these only apply to a VM in this one
+        unsupported = [option for option, value in (('-j/--jobs', args.jobs is not None), ('--input', args.input),
+                                                    ('--output', args.output), ('--profile', args.profile),
+                                                    ('--block', args.block)) if value]
+        if unsupported:
+            parser.error(f'argument --workers: not allowed with {", ".join(unsupported)}')
+    return args
 
 
 def main():
@@ -31,11 +84,45 @@ def main():
     else:
         files = iglob('example_programs/*.asm')
 
-    vm = VirtualMachine(mem_size=4096, create_shell_sock=True)
-    for file in files:
-        vm.load_from_file(pathlib.Path(file))
+    if args.workers is not None:
+        serve_dispatcher(args, files)
+        return
+
+    vm = VirtualMachine(mem_size=4096, create_shell_sock=True, optimize=args.optimize,
+                        stdin=FileInput(args.input) if args.input else None,
+                        stdout=FileOutput(args.output) if args.output else None,
+                        block_devices=dict(enumerate(args.block)), scheduler=args.scheduler,
+                        wakeup_preemption=args.wakeup_preemption, admission=args.admission,
+                        instruction_budget=args.budget, keep_alive=args.keep_alive, shell_endpoint=args.shell,
+                        profile=args.profile is not None, trace=args.trace)
+    if args.jobs is not None:
+        vm.load_many(files, workers=args.jobs or None)
+    else:
+        for file in files:
+            vm.load_from_file(pathlib.Path(file))
     vm.start()
     vm.join()
+    vm.stdin.close()
+    vm.stdout.close()
+    for device in args.block:
+        device.close()
+    if vm.profiler is not None:
+        print(vm.profiler.report())
+        vm.profiler.write_folded(args.profile)
+
+
+def serve_dispatcher(args, files):
+    vm_options = dict(optimize=args.optimize, scheduler=args.scheduler, wakeup_preemption=args.wakeup_preemption,
+                      admission=args.admission, instruction_budget=args.budget, trace=args.trace)
+    with Dispatcher(args.workers or None, vm_options) as dispatcher:
+        dispatcher.serve(args.shell)
+        for file in files:
+            file = pathlib.Path(file)
+            print(f'Loaded process {file.name}. PID: {dispatcher.upload(file.name, file.read_text())}')
+        try:
+            dispatcher.wait()
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == '__main__':
@@ -303,6 +303,87 @@ class Command_JMPIE(BaseCommand):
             self.pc.value += 1
 
 
+class Command_JMPG(BaseCommand):
+    """Conditional jump, absolute (immediate)
+
+        Jumps to `p` only if `r2` is greater than zero.
+
+        Syntax:
+            JMPG p, R2
+
+        Micro-operation:
+            If R2 > 0
+                Then PC <- p
+                Else PC <- PC + 1
+
+    """
+
+    PARAMS = ['p', 'r2']
+
+    def __init__(self, *args):
+        super().__init__('JMPG', *args)
+
+    def execute(self):
+        if self.r2.value > 0:
+            self.pc.value = self.p
+        else:
+            self.pc.value += 1
+
+
+class Command_JMPL(BaseCommand):
+    """Conditional jump, absolute (immediate)
+
+        Jumps to `p` only if `r2` is lesser than zero.
+
+        Syntax:
+            JMPL p, R2
+
+        Micro-operation:
+            If R2 < 0
+                Then PC <- p
+                Else PC <- PC + 1
+
+    """
+
+    PARAMS = ['p', 'r2']
+
+    def __init__(self, *args):
+        super().__init__('JMPL', *args)
+
+    def execute(self):
+        if self.r2.value < 0:
+            self.pc.value = self.p
+        else:
+            self.pc.value += 1
+
+
+class Command_JMPE(BaseCommand):
+    """Conditional jump, absolute (immediate)
+
+        Jumps to `p` only if `r2` is equal to zero.
+
+        Syntax:
+            JMPE p, R2
+
+        Micro-operation:
+            If R2 = 0
+                Then PC <- p
+                Else PC <- PC + 1
+
+    """
+
+    PARAMS = ['p', 'r2']
+
+    def __init__(self, *args):
+        super().__init__('JMPE', *args)
+
+    def execute(self):
+        if self.r2.value == 0:
+            self.pc.value = self.p
+        else:
+            self.pc.value += 1
+
+
 class Command_JMPIM(BaseCommand):
     """Indirect jump, with memory
 
@@ -666,12 +747,18 @@ class Command_TRAP(BaseCommand):
     System calls:
 
     R8 = 1: IN
-        Read something from STDIO.
-        In this case, R9 represents the address in memory in which the value read from STDIO will be stored.
+        Read something from the process's input device (STDIO by default).
+        In this case, R9 represents the address in memory in which the value read will be stored.
 
     R8 = 2: OUT
-        Print something to STDIO.
-        In this case, R9 represents the address in memory in which the value to be printed is stored.
+        Write something to the process's output device (STDIO by default).
+        In this case, R9 represents the address in memory in which the value to be written is stored.
+
+    R8 = 3: BLOCK READ
+        Read R7 words, starting at word R6 of block device R5, into memory starting at the address in R9.
+
+    R8 = 4: BLOCK WRITE
+        Write the R7 `DATA` words in memory starting at the address in R9 to block device R5, starting at word R6.
 
     Syntax:
         TRAP R8, R9
@@ -682,6 +769,7 @@ class Command_TRAP(BaseCommand):
     def __init__(self, *args):
         super().__init__('TRAP', *args)
         self.func = None
+        self.device = None  # I/O device that services the system call (see `source.vm.devices`)
 
     def _sys_call_in(self):
         """Mock a system call to the I/O handler
@@ -691,7 +779,7 @@ class Command_TRAP(BaseCommand):
         """
 
         # In a real system, this TRAP would call the keyboard driver
-        word = input(f'PROCESS {self.proc.pid} INPUT: ')
+        word = self.device.read(self.proc.pid)
         try:
             self.process_manager.save(to_word(f'DATA {int(word)}'), self.proc.saved_register_values['r9'], self.proc)
         except (EInvalidAddress, EInvalidCommand) as E:
@@ -707,17 +795,56 @@ class Command_TRAP(BaseCommand):
         word = self.process_manager.access(self.proc.saved_register_values['r9'], self.proc)
         if isinstance(word.command, Command_DATA):
             # In a real system, this TRAP would call the graphics card driver
-            print(f'PROCESS {self.proc.pid} OUTPUT: {word.command.execute()}')
+            value = word.command.execute()
+            self.device.write(self.proc.pid, value)
+            if (events := self.process_manager.owner.events).active:
+                events.publish('output', self.proc.pid, value=value)
         else:
             self.interrupt(EInvalidCommand(f'Address {self.proc.saved_register_values["r9"]} does not contain any DATA'))
 
+    def _sys_call_read_block(self):
+        registers = self.proc.saved_register_values
+        try:
+            values = self.device.read_block(registers['r6'], registers['r7'])
+            self.process_manager.store_block(registers['r9'], values, self.proc)
+        except IndexError as E:
+            self.interrupt(EInvalidAddress(str(E)))
+        except (EInvalidAddress, EInvalidCommand) as E:
+            self.interrupt(E)
+
+    def _sys_call_write_block(self):
+        registers = self.proc.saved_register_values
+        try:
+            values = self.process_manager.load_block(registers['r9'], registers['r7'], self.proc)
+            self.device.write_block(registers['r6'], values)
+        except IndexError as E:
+            self.interrupt(EInvalidAddress(str(E)))
+        except (EInvalidAddress, EInvalidCommand) as E:
+            self.interrupt(E)
+
     def execute(self):
-        self.func = {
-            1: self._sys_call_in,
-            2: self._sys_call_out,
-        }[self.r1.value]
         self.proc = self.process_manager.current_process
-        self.interrupt(ETrap(self.func))
+        call = self.r1.value
+        try:
+            self.func = {
+                1: self._sys_call_in,
+                2: self._sys_call_out,
+                3: self._sys_call_read_block,
+                4: self._sys_call_write_block,
+            }[call]
+            if call == 1:
+                self.device = self.process_manager.input_device(self.proc)
+            elif call == 2:
+                self.device = self.process_manager.output_device(self.proc)
+            else:
+                self.device = self.process_manager.block_device(self.registers['r5'].value)
+        except KeyError:
+            self.interrupt(EInvalidCommand(f'Invalid system call {call}'))
+            return
+        except EInvalidCommand as E:
+            self.interrupt(E)
+            return
+        self.interrupt(ETrap(self.func, self.device))
 
 
 CommandInformation = namedtuple(
@@ -732,6 +859,9 @@ INFO = {
     'JMPIG': CommandInformation('JMPIG', r'JMPIG\s([R|r]\d+),\s([R|r]\d+)', Command_JMPIG),
     'JMPIL': CommandInformation('JMPIL', r'JMPIL\s([R|r]\d+),\s([R|r]\d+)', Command_JMPIL),
     'JMPIE': CommandInformation('JMPIE', r'JMPIE\s([R|r]\d+),\s([R|r]\d+)', Command_JMPIE),
+    'JMPG': CommandInformation('JMPG', r'JMPG\s(-?\d+),\s([R|r]\d+)', Command_JMPG),
+    'JMPL': CommandInformation('JMPL', r'JMPL\s(-?\d+),\s([R|r]\d+)', Command_JMPL),
+    'JMPE': CommandInformation('JMPE', r'JMPE\s(-?\d+),\s([R|r]\d+)', Command_JMPE),
     'JMPIM': CommandInformation('JMPIM', r'JMPIM\s\[(\d+)\]', Command_JMPIM),
     'JMPIGM': CommandInformation('JMPIGM', r'JMPIGM\s\[(\d+)\],\s([R|r]\d+)', Command_JMPIGM),
     'JMPILM': CommandInformation('JMPILM', r'JMPILM\s\[(\d+)\],\s([R|r]\d+)', Command_JMPILM),
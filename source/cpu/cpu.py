@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
 from queue import Queue
+from time import perf_counter_ns
 
-from source.command.command import EIOOperationComplete, ETrap, EProgramEnd, EShutdown, ESignalVirtualAlarm
+from source.command.command import (EIOOperationComplete, EInvalidAddress, ETrap, EProgramEnd, EShutdown,
+                                    ESignalVirtualAlarm)
 from source.register.register import Register
 
 import logging
@@ -43,6 +46,9 @@ class Cpu(ICpu):
         self.__interruption_queue = Queue()  # Infinitely big interruption queue
         self.last_pc_value = 0  # Used in the memory dumping mechanism
         self.current_process_instruction_count = 0
+        self.instructions_executed = 0  # By every process, up to the last time slice that ended
+        self.interrupts_handled = 0
+        self.last_interrupt = None
 
     @property
     def pc(self):
@@ -63,12 +69,18 @@ class Cpu(ICpu):
         }
 
     def loop(self):
-        end_loop = False
         logging.info('CPU: Start loop')
-        while True:
-            # Default to False on every loop
-            skip_pc_increment = False
+        # The loop is chosen once, so that profiling and tracing cost nothing while they're off
+        profiler, tracer = self.owner.profiler, self.owner.tracer
+        if profiler is None and tracer is None:
+            self._loop()
+        else:
+            with profiler.attach(self.owner) if profiler is not None else nullcontext():
+                self._instrumented_loop(profiler, tracer)
+        logging.info('CPU: End')
 
+    def _loop(self):
+        while True:
             # Access the memory address stored in PC
             _curr_address = self.pc.value
 
@@ -84,59 +96,152 @@ class Cpu(ICpu):
             # Execute the command
             self.__instruction_register.command.execute()
 
-            if self.current_process_instruction_count >= ESignalVirtualAlarm.SIGVTALRM_THRESHOLD:
-                self.queue_interrupt(ESignalVirtualAlarm())
-            else:
-                self.current_process_instruction_count += 1
-
-            # Check for any interruptions
-            while self.__interruption_queue.qsize() > 0:
-                interrupt = self.__interruption_queue.get_nowait()
-                if isinstance(interrupt, ETrap):  # Software interruption triggered by the user program
-                    self.owner.io_handler.queue_operation(self.owner.process_manager.current_process, interrupt.args[0])
+            if self._retire(_curr_address):
+                break
 
-                    # Give way to another process
-                    self.owner.process_manager.cpu_schedule_next_process(self.pc.value == _curr_address, blocked=True)
-                    self.current_process_instruction_count = 0
+    def _instrumented_loop(self, profiler, tracer):
+        # Same as `_loop`, timing every step (see `Profiler`) and/or recording it (see `TraceBuffer`)
+        clock = perf_counter_ns
+        process_manager = self.owner.process_manager
+        registers = list(self.registers.values())
+        try:
+            while True:
+                _curr_address = self.pc.value
+                process = process_manager.current_process
+                if tracer is not None:
+                    before = [register.value for register in registers]
+                if profiler is not None:
+                    translation = profiler.translation_ns
+                    start = clock()
+                    self._execute(_curr_address)
+                    profiler.instruction(process, _curr_address, self.__instruction_register.command.opcode,
+                                         clock() - start, profiler.translation_ns - translation)
+                else:
+                    self._execute(_curr_address)
+                if tracer is not None:
+                    # Before the registers of another process are restored
+                    changed = [(index, register.value) for index, register in enumerate(registers)
+                               if register.value != before[index]]
+
+                interrupts = self.interrupts_handled
+                retired = clock()
+                end_loop = self._retire(_curr_address)
+                interrupted = interrupts != self.interrupts_handled
+                if profiler is not None:
+                    if process is not process_manager.current_process:
+                        profiler.context_switch(clock() - retired)
+                    elif interrupted:
+                        profiler.interrupt(clock() - retired)
+                if tracer is not None:
+                    interrupt = self.last_interrupt.__class__.__name__ if interrupted else ''
+                    tracer.record(process.pid, _curr_address, self.__instruction_register.command.opcode, changed,
+                                  interrupt)
+                    if end_loop and not isinstance(self.last_interrupt, EShutdown):
+                        self._dump_trace(f'{interrupt}: {self.last_interrupt}')
+                if end_loop:
+                    break
+        except Exception as E:
+            if tracer is not None:
+                self._dump_trace(f'{E.__class__.__name__}: {E}')
+            raise
+
+    def _dump_trace(self, reason):
+        try:
+            count = self.owner.dump_trace(reason=reason)
+            logging.info(f'CPU: Trace of the last {count} instructions written to {self.owner.trace_file}')
+        except OSError as E:
+            logging.error(f'CPU: Could not write the trace: {E}')
+
+    def _execute(self, _curr_address):
+        # The fetch and execution of `_loop`
+        self.__instruction_register = self.owner.process_manager.access(int(_curr_address))
+        self.__instruction_register.command.set_instance_params(**self.command_params)
+        self.owner.dump(to_file=False)
+        self.__instruction_register.command.execute()
+
+    def _retire(self, _curr_address) -> bool:
+        # Charge the instruction, handle the interruptions and move on to the next instruction
+        # Returns whether the loop should end
+        end_loop = False
+        skip_pc_increment = False
+        switched = False  # Whether another process has been given the CPU while handling the interruptions
+
+        process_manager = self.owner.process_manager
+        self.current_process_instruction_count += 1
+        if self.current_process_instruction_count > process_manager.current_quantum:
+            self.queue_interrupt(ESignalVirtualAlarm())
+        elif process_manager.wakeup_preemption and process_manager.poll_wakeups():
+            self.queue_interrupt(ESignalVirtualAlarm())
+
+        # Check for any interruptions
+        while self.__interruption_queue.qsize() > 0:
+            interrupt = self.__interruption_queue.get_nowait()
+            self.interrupts_handled += 1
+            self.last_interrupt = interrupt
+            if isinstance(interrupt, ETrap):  # Software interruption triggered by the user program
+                process = self.owner.process_manager.current_process
+                self.end_time_slice()
+                if self.owner.process_manager.enforce_budget():
+                    switched = True
                     skip_pc_increment = True
-
                     continue
-                elif isinstance(interrupt, EIOOperationComplete):  # An IO request has been fulfilled
-                    response = interrupt.args[0]
-                    self.owner.process_manager.unblock_process(response.process_id)
 
+                # Give way to another process
+                # The process is suspended (and its registers saved) before the request is queued, since the
+                # request reads them and may complete right away
+                self.owner.process_manager.cpu_schedule_next_process(self.pc.value == _curr_address, blocked=True)
+
+                # args: system call function, device
+                self.owner.io_handler.queue_operation(process, *interrupt.args)
+                switched = True
+                skip_pc_increment = True
+
+                continue
+            elif isinstance(interrupt, EIOOperationComplete):  # A batch of IO requests has been fulfilled
+                self.owner.process_manager.unblock_processes(self.owner.io_handler.completions.drain())
+
+                continue
+            elif isinstance(interrupt, EProgramEnd):  # STOP instruction
+                logging.info('STOP received. Ending process.')
+                self.end_time_slice()
+                self.reset()
+                self.owner.process_manager.end_current_process()
+                # Process changing routine
+                skip_pc_increment = True
+                switched = True
+                continue
+            elif isinstance(interrupt, EShutdown):
+                self.pc.value = self.last_pc_value
+                logging.info('Shutting down...')
+            elif isinstance(interrupt, ESignalVirtualAlarm):
+                if switched:  # The process that was meant to be preempted has already left the CPU
                     continue
-                elif isinstance(interrupt, EProgramEnd):  # STOP instruction
-                    logging.info('STOP received. Ending process.')
-                    self.reset()
-                    self.owner.process_manager.end_current_process()
-                    # Process changing routine
-                    skip_pc_increment = True
-                    continue
-                elif isinstance(interrupt, EShutdown):
-                    self.pc.value = self.last_pc_value
-                    logging.info('Shutting down...')
-                elif isinstance(interrupt, ESignalVirtualAlarm):
-                    # Give way to another process
+                # Give way to another process
+                self.end_time_slice()
+                if not self.owner.process_manager.enforce_budget():
                     self.owner.process_manager.cpu_schedule_next_process(self.pc.value == _curr_address)
-                    self.current_process_instruction_count = 0
-                    skip_pc_increment = True
-                    continue
-                else:
-                    logging.error(f'Error: {interrupt}')
+                switched = True
+                skip_pc_increment = True
+                continue
+            else:
+                logging.error(f'Error: {interrupt}')
+                if (events := self.owner.events).active:
+                    kind = 'invalid_address' if isinstance(interrupt, EInvalidAddress) else 'fault'
+                    events.publish(kind, self.owner.process_manager.current_process.pid,
+                                   interrupt=interrupt.__class__.__name__, error=str(interrupt))
 
-                # Some other exception (interruption) occurred, end the program execution
-                with self.__interruption_queue.mutex:  # Guarantee thread-safety
-                    self.__interruption_queue.queue.clear()
-                self.owner.dump(interrupt)
-                end_loop = True
+            # Some other exception (interruption) occurred, end the program execution
+            with self.__interruption_queue.mutex:  # Guarantee thread-safety
+                self.__interruption_queue.queue.clear()
+            self.owner.dump(interrupt)
+            end_loop = True
 
-            if end_loop:  # End loop before incrementing PC to dump the correct memory data
-                break
+        if end_loop:  # End loop before incrementing PC to dump the correct memory data
+            return True
 
-            if (not skip_pc_increment) and (self.pc.value == _curr_address):
-                self.pc.value += 1
-        logging.info('CPU: End')
+        if (not skip_pc_increment) and (self.pc.value == _curr_address):
+            self.pc.value += 1
+        return False
 
     def dump(self, file):
         file.writelines(self.dump_list())
@@ -151,6 +256,13 @@ class Cpu(ICpu):
     def queue_interrupt(self, interrupt):
         self.__interruption_queue.put(interrupt)
 
+    def end_time_slice(self):
+        # Charge the instructions of this time slice to the running process
+        self.owner.process_manager.current_process.instructions += self.current_process_instruction_count
+        self.owner.process_manager.end_time_slice(self.current_process_instruction_count)
+        self.instructions_executed += self.current_process_instruction_count
+        self.current_process_instruction_count = 0
+
     def reset(self):
         self.last_pc_value = self.__program_counter.value
         self.__program_counter.value = 0
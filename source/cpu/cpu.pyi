@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from queue import Queue
-from typing import Dict, Union, Any, TextIO, List
+from typing import Dict, Optional, Union, Any, TextIO, List
 
 from source.register.register import IRegister
 from source.vm.virtual_machine import IVirtualMachine
@@ -38,6 +38,9 @@ class Cpu(ICpu):
     __interruption_queue: Queue
 
     current_process_instruction_count: int
+    instructions_executed: int
+    interrupts_handled: int
+    last_interrupt: Optional[Exception]  # Last interruption handled
 
     def __init__(self, owner: IVirtualMachine): ...
 
@@ -0,0 +1,143 @@
+"""Execution profiler
+
+With `VirtualMachine(profile=True)` the CPU runs a profiled copy of its loop (see `Cpu.loop`), which counts and times:
+
+* Every instruction retired, by opcode and by (PID, PC), so the hot guest code paths stand out.
+* The VM subsystems: context switches (from the end of an instruction to the first instruction of the next process),
+  other interruption handling, and the translation of relative into absolute addresses, which is part of the time of
+  the instructions that access memory (fetching included).
+
+Times are in nanoseconds of wall-clock time. Without `profile` the plain loop runs, so there is nothing to pay.
+
+`report` summarizes the hot spots, and `write_folded` exports them in the folded stack format of flamegraph tools
+(`flamegraph.pl`, speedscope, inferno, ...): one `process;pc:opcode <nanoseconds>` line per instruction address, with
+the address translation of each one as a child frame, and a line per subsystem.
+"""
+
+from contextlib import contextmanager
+from os import PathLike
+from threading import Lock
+from time import perf_counter_ns
+from typing import Any, Dict, List, Tuple, Union
+
+from source.memory.process import ProcessControlBlock
+
+
+class Profiler:
+    def __init__(self):
+        self.opcodes: Dict[str, List[int]] = {}  # Opcode: [instructions, ns]
+        self.addresses: Dict[Tuple[int, int], List] = {}  # (PID, PC): [instructions, ns, translation ns, opcode]
+        self.names: Dict[int, str] = {}  # Process names, by PID
+        self.context_switches = [0, 0]  # [count, ns]
+        self.interrupts = [0, 0]  # [count, ns], interruptions that didn't switch processes
+        self.translations = 0
+        self.translation_ns = 0
+        self.elapsed_ns = 0  # Profiled time, so far
+        self._started_at = None
+        self._lock = Lock()  # Only for the translations, which I/O threads make too
+
+    def instruction(self, process: ProcessControlBlock, pc: int, opcode: str, ns: int, translation_ns: int):
+        if (counters := self.addresses.get((process.pid, pc))) is None:
+            counters = self.addresses[(process.pid, pc)] = [0, 0, 0, opcode]
+            self.names.setdefault(process.pid, process.name)
+        counters[0] += 1
+        counters[1] += ns
+        counters[2] += translation_ns
+        if (counters := self.opcodes.get(opcode)) is None:
+            counters = self.opcodes[opcode] = [0, 0]
+        counters[0] += 1
+        counters[1] += ns
+
+    def context_switch(self, ns: int):
+        self.context_switches[0] += 1
+        self.context_switches[1] += ns
+
+    def interrupt(self, ns: int):
+        self.interrupts[0] += 1
+        self.interrupts[1] += ns
+
+    @contextmanager
+    def attach(self, vm):
+        """Time the address translations of `vm` while the CPU loop runs"""
+
+        process_manager = vm.process_manager
+        translate = process_manager.relative_to_absolute_address
+
+        def timed_translation(address, process):
+            start = perf_counter_ns()
+            try:
+                return translate(address, process)
+            finally:
+                ns = perf_counter_ns() - start
+                with self._lock:
+                    self.translations += 1
+                    self.translation_ns += ns
+
+        process_manager.relative_to_absolute_address = timed_translation  # Shadows the method
+        self._started_at = perf_counter_ns()
+        try:
+            yield self
+        finally:
+            del process_manager.relative_to_absolute_address
+            self.elapsed_ns += perf_counter_ns() - self._started_at
+            self._started_at = None
+
+    def as_dict(self, top: int = 20) -> Dict[str, Any]:
+        """The profile so far, with the `top` hottest instruction addresses"""
+
+        # Copied first, since the CPU keeps adding to them
+        opcodes, addresses, names = dict(self.opcodes), dict(self.addresses), dict(self.names)
+        elapsed = self.elapsed_ns + (perf_counter_ns() - self._started_at if self._started_at is not None else 0)
+        hottest = sorted(addresses.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return {
+            'elapsed_ns': elapsed,
+            'instructions': sum(count for count, _ in opcodes.values()),
+            'opcodes': {opcode: {'instructions': count, 'ns': ns}
+                        for opcode, (count, ns) in sorted(opcodes.items(), key=lambda item: item[1][1], reverse=True)},
+            'hot_spots': [{'pid': pid, 'name': names.get(pid, ''), 'pc': pc, 'opcode': opcode, 'instructions': count,
+                           'ns': ns, 'translation_ns': translation_ns}
+                          for (pid, pc), (count, ns, translation_ns, opcode) in hottest],
+            'subsystems': {
+                'context_switch': {'count': self.context_switches[0], 'ns': self.context_switches[1]},
+                'interrupt': {'count': self.interrupts[0], 'ns': self.interrupts[1]},
+                'translation': {'count': self.translations, 'ns': self.translation_ns},
+            },
+        }
+
+    def report(self, top: int = 20) -> str:
+        profile = self.as_dict(top)
+        elapsed = profile['elapsed_ns'] or 1
+        lines = [f'{profile["instructions"]} instructions in {elapsed / 1e9:.3f}s', '',
+                 f'{"OPCODE":<8} {"INSTRUCTIONS":>12} {"TIME (ms)":>10} {"%":>6} {"NS/INSTR":>9}']
+        for opcode, counters in profile['opcodes'].items():
+            lines.append(f'{opcode:<8} {counters["instructions"]:>12} {counters["ns"] / 1e6:>10.3f} '
+                         f'{100 * counters["ns"] / elapsed:>6.2f} {counters["ns"] / counters["instructions"]:>9.0f}')
+        lines += ['', f'{"SUBSYSTEM":<16} {"COUNT":>12} {"TIME (ms)":>10} {"%":>6}']
+        for subsystem, counters in profile['subsystems'].items():
+            lines.append(f'{subsystem:<16} {counters["count"]:>12} {counters["ns"] / 1e6:>10.3f} '
+                         f'{100 * counters["ns"] / elapsed:>6.2f}')
+        lines += ['', f'{"PROCESS":<24} {"PC":>6} {"OPCODE":<8} {"INSTRUCTIONS":>12} {"TIME (ms)":>10} {"%":>6}']
+        for spot in profile['hot_spots']:
+            lines.append(f'{spot["name"]:<24} {spot["pc"]:>6} {spot["opcode"]:<8} {spot["instructions"]:>12} '
+                         f'{spot["ns"] / 1e6:>10.3f} {100 * spot["ns"] / elapsed:>6.2f}')
+        return '\n'.join(lines)
+
+    def folded(self) -> List[str]:
+        """Folded stacks, weighted by nanoseconds"""
+
+        addresses, names = dict(self.addresses), dict(self.names)
+        lines = []
+        for (pid, pc), (_, ns, translation_ns, opcode) in sorted(addresses.items()):
+            frame = f'{names.get(pid, pid)};{pc}:{opcode}'.replace(' ', '_')
+            if ns > translation_ns:
+                lines.append(f'{frame} {ns - translation_ns}')
+            if translation_ns:
+                lines.append(f'{frame};translation {translation_ns}')
+        for subsystem, (_, ns) in (('[context_switch]', self.context_switches), ('[interrupt]', self.interrupts)):
+            if ns:
+                lines.append(f'{subsystem} {ns}')
+        return lines
+
+    def write_folded(self, file: Union[str, PathLike]):
+        with open(file, 'w') as f:
+            f.writelines(f'{line}\n' for line in self.folded())
@@ -0,0 +1,172 @@
+"""Binary execution trace
+
+With `VirtualMachine(trace=N)` the CPU records its last N instructions in a fixed-size ring buffer, a compact binary
+entry each: when it ran, the process and PC, the opcode, the registers it changed and the interruption that followed it,
+if any. Recording costs the same small amount per instruction however long the VM runs, since the buffer is allocated
+once and old entries are overwritten in place.
+
+The buffer is written to a trace file when the CPU stops on a fault (any interruption other than a shutdown, such as
+`EInvalidAddress` or `EInvalidCommand`, or an exception escaping the loop), and on demand (`VirtualMachine.dump_trace`
+or the `trace` shell command). Decode it with `read_trace`, or from the command line:
+
+    python3 -m source.cpu.trace memory.trace
+
+File format: `FILE_HEADER` (magic and length of the metadata), the metadata in JSON (opcode, interruption and register
+names, process names, why it was written), then the entries, each an `ENTRY`, oldest first.
+"""
+
+import json
+import struct
+import sys
+from os import PathLike
+from time import perf_counter_ns
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+MAGIC = b'VMTRACE1'
+FILE_HEADER = struct.Struct('<8sI')  # Magic, metadata length
+# Time (ns), PID, PC, opcode, interruption (0 for none), changed register (-1 for none) x2, their new values x2
+ENTRY = struct.Struct('<QiIBBbbqq')
+_INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+
+class TraceEntry(NamedTuple):
+    time_ns: int  # `perf_counter_ns` of the VM
+    pid: int
+    pc: int
+    opcode: str
+    registers: Dict[str, int]  # Registers the instruction changed, and their new values
+    interrupt: Optional[str]  # Interruption handled right after the instruction
+
+    def __str__(self) -> str:
+        registers = ' '.join(f'{name}={value}' for name, value in self.registers.items())
+        interrupt = f' !{self.interrupt}' if self.interrupt else ''
+        return f'{self.time_ns:>16} {self.pid:>5} {self.pc:>6} {self.opcode:<6} {registers}{interrupt}'.rstrip()
+
+
+class Trace(NamedTuple):
+    reason: str
+    processes: Dict[int, str]  # Names of the traced processes, by PID
+    entries: List[TraceEntry]
+
+
+class TraceBuffer:
+    """Ring buffer of the last `size` instructions"""
+
+    def __init__(self, size: int, registers: Sequence[str] = tuple(f'r{i}' for i in range(10))):
+        if size <= 0:
+            raise ValueError('The trace needs room for at least one instruction')
+        self.size = size
+        self.registers = list(registers)
+        self.recorded = 0  # Instructions recorded so far, the buffer holds the last `size`
+        self._buffer = bytearray(size * ENTRY.size)
+        self._opcodes: Dict[str, int] = {}
+        self._interrupts: Dict[str, int] = {'': 0}
+
+    def record(self, pid: int, pc: int, opcode: str, changed: Sequence[Tuple[int, int]], interrupt: str = ''):
+        """
+        Args:
+            changed (Sequence[Tuple[int, int]]): Index and new value of each register the instruction changed. Only
+                two fit, which is as many as any instruction changes
+            interrupt (str): Name of the interruption that followed the instruction
+        """
+
+        if (opcode_id := self._opcodes.get(opcode)) is None:
+            opcode_id = self._opcodes[opcode] = len(self._opcodes)
+        if (interrupt_id := self._interrupts.get(interrupt)) is None:
+            interrupt_id = self._interrupts[interrupt] = len(self._interrupts)
+        (first, first_value), (second, second_value) = (*changed[:2], (-1, 0), (-1, 0))[:2]
+        offset = (self.recorded % self.size) * ENTRY.size
+        try:
+            ENTRY.pack_into(self._buffer, offset, perf_counter_ns(), pid, pc, opcode_id, interrupt_id, first, second,
+                            first_value, second_value)
+        except struct.error:  # A value that doesn't fit in 64 bits
+            ENTRY.pack_into(self._buffer, offset, perf_counter_ns(), pid, pc & 0xFFFFFFFF, opcode_id & 0xFF,
+                            interrupt_id & 0xFF, first, second, min(max(first_value, _INT64[0]), _INT64[1]),
+                            min(max(second_value, _INT64[0]), _INT64[1]))
+        self.recorded += 1
+
+    def _snapshot(self) -> List[tuple]:
+        # The raw entries, oldest first. The CPU may be recording meanwhile: copying the buffer is atomic, and the
+        # entries are put in order by their time rather than by where the ring starts
+        data = bytes(self._buffer)
+        entries = [entry for entry in ENTRY.iter_unpack(data) if entry[0]]
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def _metadata(self, reason: str, processes: Dict[int, str]) -> Dict:
+        return {
+            'reason': reason,
+            'entry': ENTRY.format,
+            'opcodes': sorted(self._opcodes, key=self._opcodes.get),
+            'interrupts': sorted(self._interrupts, key=self._interrupts.get),
+            'registers': self.registers,
+            'processes': {str(pid): name for pid, name in processes.items()},
+        }
+
+    def entries(self) -> List[TraceEntry]:
+        """The recorded instructions, decoded, oldest first"""
+
+        return _decode(self._metadata('', {}), self._snapshot())
+
+    def dump(self, file: Union[str, PathLike], reason: str = '',
+             process_name: Callable[[int], Optional[str]] = None) -> int:
+        """Write the buffer to a trace file. Returns how many instructions it holds
+
+        Args:
+            reason (str): Why the trace was written, such as the fault
+            process_name (Callable[[int], Optional[str]]): Name of a process, by PID, for the processes in the trace
+        """
+
+        entries = self._snapshot()
+        processes = {}
+        if process_name is not None:
+            processes = {pid: name for pid in {entry[1] for entry in entries} if (name := process_name(pid))}
+        metadata = json.dumps(self._metadata(reason, processes)).encode('utf-8')
+        with open(file, 'wb') as f:
+            f.write(FILE_HEADER.pack(MAGIC, len(metadata)))
+            f.write(metadata)
+            f.write(b''.join(ENTRY.pack(*entry) for entry in entries))
+        return len(entries)
+
+
+def _decode(metadata: Dict, entries) -> List[TraceEntry]:
+    opcodes, interrupts, registers = metadata['opcodes'], metadata['interrupts'], metadata['registers']
+    decoded = []
+    for time_ns, pid, pc, opcode, interrupt, first, second, first_value, second_value in entries:
+        changed = {registers[index]: value for index, value in ((first, first_value), (second, second_value))
+                   if index >= 0}
+        decoded.append(TraceEntry(time_ns, pid, pc, opcodes[opcode], changed, interrupts[interrupt] or None))
+    return decoded
+
+
+def read_trace(file: Union[str, PathLike]) -> Trace:
+    """Decode a trace file
+
+    Raises:
+        ValueError: Not a trace file
+    """
+
+    with open(file, 'rb') as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size:
+        raise ValueError(f'{file} is not a trace file')
+    magic, length = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f'{file} is not a trace file')
+    metadata = json.loads(data[FILE_HEADER.size:FILE_HEADER.size + length])
+    entry = struct.Struct(metadata['entry'])
+    body = data[FILE_HEADER.size + length:]
+    body = body[:len(body) - len(body) % entry.size]
+    return Trace(metadata['reason'], {int(pid): name for pid, name in metadata['processes'].items()},
+                 _decode(metadata, entry.iter_unpack(body)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python3 -m source.cpu.trace <trace file>')
+        sys.exit(1)
+    trace = read_trace(sys.argv[1])
+    print(f'{len(trace.entries)} instructions. {trace.reason}'.strip())
+    print(f'{"TIME (NS)":>16} {"PID":>5} {"PC":>6} {"OPCODE":<6} REGISTERS')
+    for trace_entry in trace.entries:
+        print(f'{trace_entry} ({trace.processes.get(trace_entry.pid, "?")})')
@@ -0,0 +1,79 @@
+"""Latency histograms
+
+Averages hide the tail latencies that interactive programs suffer under load, so the process manager keeps the
+distribution of its scheduling latencies (see `SchedulingHistograms`), for every process and in aggregate. Buckets are
+fixed, so recording is cheap and memory use doesn't grow with the number of samples. Percentiles are estimated as the
+upper bound of the bucket they fall in.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from typing import Any, Dict, Sequence
+
+# Powers of two from 1µs to about a minute, in seconds
+LATENCY_BUCKETS = tuple(2 ** i / 1e6 for i in range(27))
+# Tenths of a time slice
+QUANTUM_USE_BUCKETS = tuple(i / 10 for i in range(1, 11))
+
+
+class Histogram:
+    """Distribution of a measure over buckets, given by their upper bounds. One more bucket holds anything above"""
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = Lock()
+
+    def record(self, value: float):
+        with self._lock:
+            self.buckets[bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, percent: float) -> float:
+        with self._lock:
+            return self._percentile(percent)
+
+    def _percentile(self, percent: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Count, average, maximum, percentiles and the buckets that aren't empty, by upper bound"""
+
+        with self._lock:
+            labels = [f'{bound:g}' for bound in self.bounds] + ['inf']
+            return {
+                'count': self.count,
+                'avg': self.total / (self.count or 1),
+                'max': self.max,
+                'p50': self._percentile(50),
+                'p90': self._percentile(90),
+                'p99': self._percentile(99),
+                'buckets': {label: count for label, count in zip(labels, self.buckets) if count},
+            }
+
+
+class SchedulingHistograms:
+    """Scheduling latencies of a process, or of every process. Latencies are in seconds"""
+
+    def __init__(self):
+        self.ready_wait = Histogram()  # In the ready queue, from becoming ready until entering the CPU
+        self.io_wait = Histogram()  # Blocked, from its `TRAP` until its I/O request has been completed
+        self.wakeup = Histogram()  # From being unblocked until running its next instruction
+        self.quantum_use = Histogram(QUANTUM_USE_BUCKETS)  # Fraction of its time slice used before leaving the CPU
+
+    def as_dict(self) -> Dict[str, Dict[str, Any]]:
+        return {name: histogram.as_dict() for name, histogram in vars(self).items()}
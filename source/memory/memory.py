@@ -1,16 +1,28 @@
 from abc import ABC, abstractmethod
+from copy import copy
+from collections import deque
 from itertools import count
-from typing import Any, List, Dict
-from queue import Queue
+from math import ceil
+from typing import Deque, List, Dict, NamedTuple
+from threading import Condition, RLock
+from time import perf_counter
 
-from source.command.command import to_word, EInvalidAddress, EShutdown
+from source.command.command import to_word, Command_DATA, EInvalidAddress, EInvalidCommand, EShutdown
 from source.memory.frame import Frame
+from source.memory.histogram import SchedulingHistograms
 from source.memory.process import ProcessControlBlock, ProcessState
+from source.memory.process_table import ProcessSummary, ProcessTable
+from source.memory.program import ProgramImage, decode_program
+from source.memory.scheduler import IScheduler, LatencyStats, ReadyReason, make_scheduler
 
 import logging
 
 logging.basicConfig(level=logging.WARN)
 
+
+class EOutOfMemory(Exception):
+    """There aren't enough free frames to load a program"""
+
 class IMemory(ABC):
     @abstractmethod
     def dump(self, file): ...
@@ -70,9 +82,8 @@ class IMemoryManager(IMemory):
     @abstractmethod
     def allocate(self, number_of_words: int, owner_pid: int) -> List[Frame]: ...
 
-    @staticmethod
     @abstractmethod
-    def deallocate(frames): ...
+    def deallocate(self, frames): ...
 
     @property
     @abstractmethod
@@ -80,11 +91,12 @@ class IMemoryManager(IMemory):
 
 
 class MemoryManager(Memory):
-    @staticmethod
-    def deallocate(frames):
+    def deallocate(self, frames):
         # Mark each position in the given frames as free
         for frame in frames:
-            frame.is_free = True
+            if not frame.is_free:
+                frame.is_free = True
+                self._free_frames += 1
             # Don't re-write the owner
             # frame.owner = 0  # System owns this frame now
 
@@ -107,12 +119,17 @@ class MemoryManager(Memory):
             frame = Frame(frame_addresses, index)
             index += 1
             self._frames.append(frame)
+        self._free_frames = self._frame_amount  # Kept up to date, so it can be polled without walking the frames
+
+    def free_frames(self) -> int:
+        return self._free_frames
 
     def get_next_free_frame(self) -> Frame:
         # Return the next free frame
         for frame in self._frames:
             if frame.is_free:
                 frame.is_free = False
+                self._free_frames -= 1
                 return frame
         raise Exception('Out of memory')
 
@@ -144,19 +161,61 @@ class MemoryManager(Memory):
                                f'{command.dump()}\n')
         return memory_data
 
+class PendingAdmission(NamedTuple):
+    """A program waiting for enough free frames to be loaded"""
+
+    pid: int
+    image: ProgramImage
+    stdin: object
+    stdout: object
+    priority: int
+    instruction_budget: int
+    queued_at: float
+    on_exit: object = None
+
+
 class ProcessManager():
-    def __init__(self, owner) -> None:
+    def __init__(self, owner, scheduler: IScheduler = None, wakeup_preemption: bool = False, keep_ended: int = 64,
+                 process_history: int = 1024, admission: str = 'reject',
+                 budget_action: str = 'terminate', keep_alive: bool = False) -> None:
         self.owner = owner
 
-        self._processes: List[ProcessControlBlock] = []
-        self._pid_table: Dict[int, Any] = {}
+        self._processes = ProcessTable(keep_ended, process_history)
         self._pid_gen = count(0)
-        self.process_queue = Queue()
+        self.scheduler = make_scheduler(scheduler)  # Ready processes
+        # Processes whose I/O has finished take the CPU from the running process (see `poll_wakeups`)
+        self.wakeup_preemption = wakeup_preemption
+        self._preempting = False
+        self.wakeup_latency = LatencyStats()  # From the end of an I/O request until the process runs again
+        self.histograms = SchedulingHistograms()  # Of every process but the idle ones, see `_record`
+        self.context_switches = 0  # Processes that have entered the CPU
+
+        # What happens to a program that doesn't fit in the free frames: it's either rejected (`EOutOfMemory`) or
+        # queued until enough frames are freed
+        if admission not in ('reject', 'queue'):
+            raise ValueError(f'Unknown admission policy {admission!r}. Choose one of: reject, queue')
+        self.admission = admission
+        self.pending_admission: Deque[PendingAdmission] = deque()
+        self.admission_wait = LatencyStats()  # Time spent in the pending admission queue
+        self.admission_rejected = 0
+
+        # What happens to a process once it has used up its instruction budget: it's ended or demoted
+        if budget_action not in ('terminate', 'deprioritize'):
+            raise ValueError(f'Unknown budget action {budget_action!r}. Choose one of: terminate, deprioritize')
+        self.budget_action = budget_action
         self.blocked_processes: Dict[int, ProcessControlBlock] = {}
+        # Held by every scheduling operation, so that batched loads are seen by the scheduler all at once
+        self._lock = RLock()
+        # With `keep_alive`, the CPU waits for new processes once every process has ended, instead of shutting down,
+        # until `stop` is called
+        self.keep_alive = keep_alive
+        self._stopping = False
+        self._new_work = Condition(self._lock)
 
         self.create_process('system', ['STOP'])
-        self._curr_process = self._processes[0]
-        self.process_queue.queue.clear()
+        self._curr_process = self.scheduler.next()
+        self._curr_process.idle = True
+        self.current_quantum = self.scheduler.quantum(self._curr_process)
 
 
     def save(self, command, address, process = None):
@@ -165,16 +224,63 @@ class ProcessManager():
         else:
             proc = self._curr_process
 
-        try:
-            self.relative_to_absolute_address(address, proc)
-        except IndexError:  # Need to allocate more frames for this process
-            extra_words = ((address // self.owner.memory.page_size) - len(proc.frames)) * self.owner.memory.page_size + 1
-            new_frames = self.allocate(extra_words, proc.pid)
-            proc.frames.extend(new_frames)
+        self._reserve(address, proc)
         absolute_address = self.relative_to_absolute_address(address, proc)
         self.owner.memory.save(command, absolute_address)
 
 
+    def _reserve(self, address, process):
+        # Allocate more frames for the process if `address` isn't in any of its frames yet
+        if address // self.owner.memory.page_size < len(process.frames):
+            return
+        # I/O workers grow processes too (see `store_block`), so it's checked again and grown with the lock held
+        with self._lock:
+            page_size = self.owner.memory.page_size
+            if (extra_frames := address // page_size - len(process.frames) + 1) <= 0:
+                return
+            try:
+                new_frames = self.allocate(extra_frames * page_size, process.pid)
+            except EOutOfMemory as E:
+                self._event('out_of_memory', process, name=process.name, error=str(E))
+                raise EInvalidAddress(f'Address {address} is out of the bounds of process {process.pid}: {E}')
+            process.frames.extend(new_frames)
+
+
+    def store_block(self, address, values, process):
+        """Save `values` as `DATA` words, starting at the relative `address` of `process`
+
+        The words are written straight into the process's frames.
+        """
+
+        if address < 0:
+            raise EInvalidAddress(f'Address {address} is out of bounds')
+        if not values:
+            return
+        page_size = self.owner.memory.page_size
+        self._reserve(address + len(values) - 1, process)
+        frames = process.frames
+        for relative, value in enumerate(values, address):
+            command = Command_DATA(value)
+            command.original = f'DATA {value}'
+            frames[relative // page_size].addresses[relative % page_size].command = command
+
+
+    def load_block(self, address, count, process) -> List[int]:
+        """Read `count` `DATA` words, starting at the relative `address` of `process`"""
+
+        if address < 0 or count < 0 or (address + count - 1) // self.owner.memory.page_size >= len(process.frames):
+            raise EInvalidAddress(f'Block [{address}, {address + count}) is out of bounds')
+        page_size = self.owner.memory.page_size
+        frames = process.frames
+        values = []
+        for relative in range(address, address + count):
+            command = frames[relative // page_size].addresses[relative % page_size].command
+            if not isinstance(command, Command_DATA):
+                raise EInvalidCommand(f'Address {relative} does not contain any DATA')
+            values.append(command.p)
+        return values
+
+
     def access(self, address, process = None):
         if process:
             proc = process
@@ -190,122 +296,352 @@ class ProcessManager():
 
 
     def schedule_next_process(self):
-        process = self._curr_process
-        try:
-            if self.process_queue.qsize() > 0:
-                self.set_current_process(self.process_queue.get_nowait())
-            else:
-                if len(self.blocked_processes) > 0:
-                    # Busy wait...
-                    self.create_process('system', ['STOP'])
-                    self.set_current_process(self.process_queue.get_nowait())
+        with self._lock:
+            process = self._curr_process
+            # Every scheduling decision picks up the I/O requests that have been fulfilled since the last one
+            self.unblock_processes(self.owner.io_handler.completions.drain())
+            while self.keep_alive and not self._stopping and not len(self.scheduler) and not self.blocked_processes:
+                self._new_work.wait()
+            try:
+                if len(self.scheduler) > 0:
+                    self.set_current_process(self.scheduler.next())
                 else:
-                    logging.info('No more processes. Ending CPU loop.')
-                    self.owner.cpu.queue_interrupt(EShutdown())
-            logging.info(f'Process {process.name} has exited the CPU')
-            logging.info(f'Process {self._curr_process.name} has entered the CPU')
-        except Exception as E:
-            logging.fatal('A fatal exception has occurred. Ending CPU loop.')
-            self.owner.cpu.queue_interrupt(EShutdown(str(E)))
+                    if len(self.blocked_processes) > 0:
+                        # Busy wait...
+                        # The idle process can't wait for admission, there would be nothing to run in the meantime
+                        self._install(next(self._pid_gen), decode_program('system', ['STOP']), idle=True)
+                        self.set_current_process(self.scheduler.next())
+                    else:
+                        logging.info('No more processes. Ending CPU loop.')
+                        self.owner.cpu.queue_interrupt(EShutdown())
+                logging.info(f'Process {process.name} has exited the CPU')
+                logging.info(f'Process {self._curr_process.name} has entered the CPU')
+            except Exception as E:
+                logging.fatal('A fatal exception has occurred. Ending CPU loop.')
+                self.owner.cpu.queue_interrupt(EShutdown(str(E)))
 
 
     def set_current_process(self, next_process):
         self._curr_process = next_process
+        self.current_quantum = self.scheduler.quantum(next_process)
+        self._preempting = False
+        self.context_switches += 1
+        now = perf_counter()
+        if next_process.woken_at is not None:
+            self.wakeup_latency.record(now - next_process.woken_at)
+            next_process.woken_at = None
+        if next_process.ready_at is not None:
+            self._record(next_process, 'ready_wait', now - next_process.ready_at)
+            next_process.ready_at = None
+        if next_process.unblocked_at is not None:
+            self._record(next_process, 'wakeup', now - next_process.unblocked_at)
+            next_process.unblocked_at = None
         self._curr_process.resume(self.owner.cpu.pc, self.owner.cpu.registers)
+        self._event('scheduled', next_process)
 
 
     def cpu_schedule_next_process(self, should_increment_pc, blocked: bool = False):
-        # Suspend the current process
-        old_process = self._curr_process
-        old_process.suspend(self.owner.cpu.pc, self.owner.cpu.registers, should_increment_pc, blocked)
-
-        if blocked:
-            # Add process to blocked processes dictionary
-            self.blocked_processes[old_process.pid] = old_process
-        else:
-            # Add suspended process to the CPU queue
-            self.process_queue.put_nowait(old_process)
+        with self._lock:
+            # Suspend the current process
+            old_process = self._curr_process
+            old_process.suspend(self.owner.cpu.pc, self.owner.cpu.registers, should_increment_pc, blocked)
+
+            if blocked:
+                # Add process to blocked processes dictionary
+                self.blocked_processes[old_process.pid] = old_process
+                self._event('blocked', old_process)
+            elif self._preempting:
+                # The process gave way to a process that woke up
+                self._make_ready(old_process, ReadyReason.INTERRUPTED)
+            else:
+                # The process used up its time slice, give it back to the scheduler
+                self._make_ready(old_process, ReadyReason.PREEMPTED)
 
-        # Choose the next process from the ready queue
-        # Restore the CPU process of the next process
-        self.schedule_next_process()
+            # Choose the next process from the ready queue
+            # Restore the CPU process of the next process
+            self.schedule_next_process()
         # Give back control to the CPU
         return
 
 
-    def unblock_process(self, pid):
-        if proc := self.blocked_processes.get(pid):
-            if proc.state == ProcessState.BLOCKED:
-                self.blocked_processes.pop(pid)
-                self.process_queue.put_nowait(proc)
-                proc.state = ProcessState.READY
+    def unblock_process(self, pid) -> bool:
+        with self._lock:
+            if proc := self.blocked_processes.get(pid):
+                if proc.state == ProcessState.BLOCKED:
+                    self.blocked_processes.pop(pid)
+                    self._record(proc, 'io_wait', proc.unblock())
+                    if proc.io_error is not None:
+                        logging.warning(f'Process {proc.name} has ended, its I/O request failed: {proc.io_error}')
+                        self._end_process(proc, 'io_error')
+                        return False
+                    self._event('unblocked', proc)
+                    self._make_ready(proc, ReadyReason.UNBLOCKED, wake=self.wakeup_preemption)
+                    proc.unblocked_at = proc.ready_at
+                    return True
+            return False
+
+
+    def unblock_processes(self, pids) -> bool:
+        if not pids:
+            return False
+        with self._lock:
+            return any([self.unblock_process(pid) for pid in pids])
+
+
+    def poll_wakeups(self) -> bool:
+        """Unblock the processes whose I/O has finished
+
+        Called by the CPU after every instruction when `wakeup_preemption` is on.
+
+        Returns:
+            bool: Whether a process woke up, so that the running process should give way to it
+        """
+
+        if self.unblock_processes(self.owner.io_handler.completions.drain()):
+            self._preempting = True
+        return self._preempting
 
 
     def allocate(self, number_of_words, owner_pid):
         # "I wish to allocate this number of words"
         # First, check if there is enough free size on the memory
         # Then, return the list of allocated frames
-        from math import ceil
-
-        needed_frames = ceil(number_of_words / self.owner.memory.page_size)
-        try:
+        # Frames are taken and freed with the lock held, since I/O workers allocate too
+        needed_frames = self.frames_needed(number_of_words)
+        with self._lock:
+            if needed_frames > (free := self.owner.memory.free_frames()):
+                raise EOutOfMemory(f'{needed_frames} frames are needed but only {free} are free')
             frames = [self.owner.memory.get_next_free_frame() for _ in range(needed_frames)]
-        except Exception as E:
-            # There is not enough memory to allocate this process
-            logging.fatal(E)
-            return
+            for frame in frames:
+                frame.owner = owner_pid
 
         # Zero the memory
         for frame in frames:
-            frame.owner = owner_pid
             self.owner.memory.zero_memory_in_frame(frame)
 
         return frames
 
 
+    def frames_needed(self, number_of_words) -> int:
+        return ceil(number_of_words / self.owner.memory.page_size)
+
+
     def relative_to_absolute_address(self, address: int, process) -> int:
         page = address // self.owner.memory.page_size
         offset = address % self.owner.memory.page_size
         return (process.frames[page].index * self.owner.memory.page_size) + offset
 
 
-    def create_process(self, process_name, code):
-        pid = next(self._pid_gen)
-        commands = []
-        for line in code:
-            if command := to_word(line.lstrip(' ').lstrip('\t')):
-                commands.append(command)
-        process_size = len(commands)
-        process_frames = self.allocate(process_size, pid)
+    def create_process(self, process_name, code, priority=0):
+        return self.install_image(decode_program(process_name, code), priority=priority)
+
+
+    def install_image(self, image: ProgramImage, stdin=None, stdout=None, priority=0, instruction_budget=None,
+                      on_exit=None):
+        """Install a decoded program into memory and queue its new process
+
+        Args:
+            image (ProgramImage): The decoded program
+            stdin (IInputDevice): Input device of the process. Defaults to the VM's
+            stdout (IOutputDevice): Output device of the process. Defaults to the VM's
+            priority (int): Scheduling priority of the process, higher runs first (see `PriorityScheduler`)
+            instruction_budget (int): Instructions the process may execute before `budget_action` is taken. None for
+                no limit
+            on_exit (Callable[[ProcessControlBlock], None]): Called on the CPU's thread when the process ends, before
+                its frames are freed
+
+        Returns:
+            int: The PID of the new process. If the program is waiting for admission (see `admission`), the process
+            is created with this PID once it's admitted
+
+        Raises:
+            EOutOfMemory: The program doesn't fit in the free frames and the admission policy is `reject`, or it
+            doesn't fit in the whole memory
+        """
+
+        with self._lock:
+            needed, free = self.frames_needed(len(image.words)), self.owner.memory.free_frames()
+            if needed > self.owner.memory.frame_amount or (needed > free and self.admission == 'reject'):
+                self.admission_rejected += 1
+                error = EOutOfMemory(f'Not enough memory to load {image.name}: it needs {needed} frames and '
+                                     f'{free} out of {self.owner.memory.frame_amount} are free')
+                if self.owner.events.active:
+                    self.owner.events.publish('out_of_memory', name=image.name, error=str(error))
+                raise error
+
+            pid = next(self._pid_gen)
+            # Programs are admitted in order, so nothing jumps ahead of the ones already waiting
+            if needed > free or self.pending_admission:
+                self.pending_admission.append(PendingAdmission(pid, image, stdin, stdout, priority, instruction_budget,
+                                                               perf_counter(), on_exit))
+                return pid
+            return self._install(pid, image, stdin, stdout, priority, instruction_budget, on_exit).pid
+
+
+    def _install(self, pid, image: ProgramImage, stdin=None, stdout=None, priority=0,
+                 instruction_budget=None, on_exit=None, idle=False) -> ProcessControlBlock:
+        with self._lock:
+            commands = image.words
+            process_size = len(commands)
+            process_frames = self.allocate(process_size, pid)
+
+            # Load code into memory
+
+            def divide_chunks(_list, _chunk_size):
+                for i in range(0, len(_list), _chunk_size):
+                    yield _list[i: i + _chunk_size]
+
+            divided_commands = list(divide_chunks(commands, self.owner.memory.page_size))
+
+            # Load commands into the memory frames
+            # Commands are copied because the CPU binds them to the running process, and images may be shared
+            for frame, commands_per_frame in zip(process_frames, divided_commands):
+                for address, word in zip(frame.addresses, commands_per_frame):
+                    address.command = copy(word.command)
+
+            process = ProcessControlBlock(f'{image.name.replace(" ", "")}_{pid}', pid, process_frames, process_size)
+            process.optimization = image.optimization
+            process.stdin = stdin
+            process.stdout = stdout
+            process.priority = priority
+            process.instruction_budget = instruction_budget
+            process.on_exit = on_exit
+            process.idle = idle
+            self._processes.add(process)
+            process.state = ProcessState.READY
+            self._make_ready(process, ReadyReason.NEW)
+            self._new_work.notify()
+            self._event('created', process, name=process.name)
+            return process
+
+    def _make_ready(self, process, reason, wake = False):
+        # Hand a process to the scheduler, `wake` it with wake-up preemption
+        process.ready_at = perf_counter()
+        if wake:
+            self.scheduler.wake(process)
+        else:
+            self.scheduler.add(process, reason)
+
+    def _record(self, process, histogram, value):
+        # Record a latency of `process`, and of every process. Idle processes only run while nothing else can
+        if not process.idle:
+            getattr(process.histograms, histogram).record(value)
+            getattr(self.histograms, histogram).record(value)
+
+    def end_time_slice(self, instructions):
+        """Record how much of its time slice the running process has used, as it leaves the CPU"""
+
+        if self.current_quantum:
+            self._record(self._curr_process, 'quantum_use', min(1.0, instructions / self.current_quantum))
+
+    def _event(self, kind, process, **data):
+        # Publish an event about a process, unless nobody is listening (see `source.vm.events`)
+        events = self.owner.events
+        if events.active and not process.idle:
+            events.publish(kind, process.pid, **data)
+
+    def stop(self):
+        """Let the CPU shut down once it runs out of processes, even with `keep_alive`"""
+
+        with self._lock:
+            self._stopping = True
+            self._new_work.notify()
+
+
+    def _admit_pending(self):
+        # Install the programs waiting for admission, in order, while they fit in the free frames
+        while self.pending_admission:
+            pending = self.pending_admission[0]
+            if self.frames_needed(len(pending.image.words)) > self.owner.memory.free_frames():
+                break
+            self.pending_admission.popleft()
+            self.admission_wait.record(perf_counter() - pending.queued_at)
+            try:
+                self._install(pending.pid, pending.image, pending.stdin, pending.stdout, pending.priority,
+                              pending.instruction_budget, pending.on_exit)
+            except Exception as E:
+                logging.error(f'Could not install {pending.image.name}: {E}')
 
-        # Load code into memory
 
-        def divide_chunks(_list, _chunk_size):
-            for i in range(0, len(_list), _chunk_size):
-                yield _list[i: i + _chunk_size]
+    def admission_stats(self):
+        with self._lock:
+            return {
+                'policy': self.admission,
+                'pending': len(self.pending_admission),
+                'rejected': self.admission_rejected,
+                'free_frames': self.owner.memory.free_frames(),
+                'wait': self.admission_wait.as_dict(),
+            }
 
-        divided_commands = list(divide_chunks(commands, self.owner.memory.page_size))
 
-        # Load commands into the memory frames
-        for frame, commands_per_frame in zip(process_frames, divided_commands):
-            for address, word in zip(frame.addresses, commands_per_frame):
-                address.command = word.command
+    def install_images(self, images: List[ProgramImage], stdin=None, stdout=None, priority=0,
+                       instruction_budget=None) -> List[int]:
+        """Install a batch of decoded programs
 
-        process = ProcessControlBlock(f'{process_name.replace(" ", "")}_{pid}', pid, process_frames, process_size)
-        self._processes.append(process)
-        self._pid_table[process.pid] = len(self._processes) - 1
-        self.process_queue.put(process)
-        process.state = ProcessState.READY
-        return process.pid
+        The scheduler can't run in between installs, so it either sees none or all of the new processes.
+        Images that could not be installed get a PID of -1.
+        """
 
+        pids = []
+        with self._lock:
+            for image in images:
+                try:
+                    pids.append(self.install_image(image, stdin, stdout, priority, instruction_budget))
+                except Exception as E:
+                    logging.error(f'Could not install {image.name}: {E}')
+                    pids.append(-1)
+        return pids
+
+
+    def enforce_budget(self) -> bool:
+        """Take the budget action if the running process has used up its instruction budget
+
+        Called by the CPU at the end of every time slice.
+
+        Returns:
+            bool: Whether the process has been terminated
+        """
 
-    def end_current_process(self):
         process = self._curr_process
-        p_name = process.name
-        logging.info(f'Process {p_name} has ended')
-        self.schedule_next_process()
-        self.owner.memory.deallocate(process.frames)
-        process.state = ProcessState.ENDED
+        if not process.over_budget or process.demoted:
+            return False
+        if self.budget_action == 'terminate':
+            logging.warning(f'Process {process.name} has used up its budget of {process.instruction_budget} '
+                            f'instructions. Ending it.')
+            self.end_current_process('budget')
+            return True
+        logging.warning(f'Process {process.name} has used up its budget of {process.instruction_budget} '
+                        f'instructions. Demoting it.')
+        process.demoted = True
+        return False
+
+
+    def end_current_process(self, reason='stop'):
+        with self._lock:
+            self._end_process(self._curr_process, reason)
+            self.schedule_next_process()
+
+    def _end_process(self, process, reason):
+        # Everything but giving the CPU to the next process, since `process` may not be running
+        with self._lock:
+            p_name = process.name
+            logging.info(f'Process {p_name} has ended')
+            process.end(reason)
+            self._event('ended', process, name=p_name, reason=reason, instructions=process.instructions)
+            if process.stdout is not None:
+                process.stdout.flush()
+            if process.on_exit is not None:
+                try:
+                    process.on_exit(process)
+                except Exception as E:
+                    logging.error(f'Exit callback of {p_name} failed: {E}')
+            self.owner.memory.deallocate(process.frames)
+            self.scheduler.discard(process)
+            # Idle processes are of no interest once they're done
+            self._processes.ended(process, keep=not process.idle)
+            # The freed frames may let waiting programs in, before the scheduler decides whether there is anything
+            # left to run
+            self._admit_pending()
 
     def dump_list(self):
         process_begin = '-------------------------------- BEGIN PROCESS ---------------------------------\n'
@@ -315,6 +651,7 @@ class ProcessManager():
             pcb_data.append(process_begin)
             pcb_data.extend(process.dump())
             pcb_data.append(process_end)
+        pcb_data.append(f'---- {self._processes.reaped} ENDED PROCESSES REAPED ----\n')
         pcb_data.append('\n---- ---- ----\n\n')
 
         return pcb_data
@@ -322,6 +659,28 @@ class ProcessManager():
     def dump(self, file):
         file.writelines(self.dump_list())
 
+    def input_device(self, process):
+        return process.stdin if process.stdin is not None else self.owner.stdin
+
+    def output_device(self, process):
+        return process.stdout if process.stdout is not None else self.owner.stdout
+
+    def block_device(self, number):
+        try:
+            return self.owner.block_devices[number]
+        except KeyError:
+            raise EInvalidCommand(f'There is no block device {number}')
+
+    def process(self, pid) -> ProcessControlBlock:
+        """Control block of a process that hasn't been reaped yet. Raises `KeyError` otherwise"""
+
+        return self._processes[pid]
+
+    def summary(self, pid) -> ProcessSummary:
+        """Summary of any process, reaped or not. None if it is too old to be remembered"""
+
+        return self._processes.summary(pid)
+
     @property
     def current_process(self):
         return self._curr_process
@@ -1,10 +1,14 @@
 from abc import ABC, abstractmethod
-from queue import Queue
-from typing import List, TextIO, Any, Dict
+from typing import Callable, List, TextIO, Any, Dict, Optional
 
 from source.vm.virtual_machine import IVirtualMachine
 from source.word.word import IWord
 from source.memory.frame import Frame
+from source.memory.histogram import SchedulingHistograms
+from source.memory.process import ProcessControlBlock
+from source.memory.process_table import ProcessSummary, ProcessTable
+from source.memory.program import ProgramImage
+from source.memory.scheduler import IScheduler, LatencyStats
 
 
 class IMemory(ABC):
@@ -43,9 +47,8 @@ class IMemoryManager(IMemory):
     @abstractmethod
     def allocate(self, number_of_words: int, owner_pid: int) -> List[Frame]: ...
 
-    @staticmethod
     @abstractmethod
-    def deallocate(frames): ...
+    def deallocate(self, frames): ...
 
     @property
     @abstractmethod
@@ -68,11 +71,14 @@ class MemoryManager(IMemoryManager, Memory):
     _frames: List[Frame]
     _frame_amount: int
     _page_size: int
-    _processes: List
+    _processes: ProcessTable
     _pid_gen: Any
-    _pid_table: Dict
     _curr_process: Any
-    process_queue: Queue
+    scheduler: IScheduler
+    current_quantum: int
+    wakeup_preemption: bool
+    wakeup_latency: LatencyStats
+    histograms: SchedulingHistograms
 
     def __init__(self, owner: IVirtualMachine, memory_length: int, page_size: int): ...
 
@@ -82,12 +88,46 @@ class MemoryManager(IMemoryManager, Memory):
 
     def get_next_free_frame(self) -> Frame: ...
 
+    def free_frames(self) -> int: ...
+
     def end_current_process(self): ...
 
     def set_current_process(self, next_process): ...
 
 class IProcessManager:
-    def create_process(self, process_name: str, code: List[str]) -> int: ...
+    def create_process(self, process_name: str, code: List[str], priority: int = 0) -> int: ...
+
+    def install_image(self, image: ProgramImage, stdin=None, stdout=None, priority: int = 0,
+                      instruction_budget: int = None,
+                      on_exit: Callable[[ProcessControlBlock], None] = None) -> int: ...
+
+    def install_images(self, images: List[ProgramImage], stdin=None, stdout=None, priority: int = 0,
+                       instruction_budget: int = None) -> List[int]: ...
+
+    def store_block(self, address: int, values: List[int], process: ProcessControlBlock) -> None: ...
+
+    def load_block(self, address: int, count: int, process: ProcessControlBlock) -> List[int]: ...
 
 class ProcessManager():
-    def __init__(self, owner) -> None: ...
+    def __init__(self, owner, scheduler: IScheduler = None, wakeup_preemption: bool = False, keep_ended: int = 64,
+                 process_history: int = 1024, admission: str = 'reject',
+                 budget_action: str = 'terminate', keep_alive: bool = False) -> None: ...
+
+    def stop(self) -> None: ...
+
+    context_switches: int
+    histograms: SchedulingHistograms
+
+    def end_time_slice(self, instructions: int) -> None: ...
+
+    def enforce_budget(self) -> bool: ...
+
+    def admission_stats(self) -> Dict[str, Any]: ...
+
+    def process(self, pid: int) -> ProcessControlBlock: ...
+
+    def summary(self, pid: int) -> Optional[ProcessSummary]: ...
+
+    def unblock_processes(self, pids: List[int]) -> bool: ...
+
+    def poll_wakeups(self) -> bool: ...
@@ -0,0 +1,402 @@
+"""Load-time optimizer
+
+Builds a control-flow graph over a decoded program and runs a forward constant propagation over registers and memory
+followed by a backward register liveness pass. With that information:
+
+    - `LDD`/`LDX` from addresses that provably hold a constant become `LDI`
+    - arithmetic with a constant result becomes `LDI`
+    - register (and memory) jumps with a constant target become `JMP`, `JMPG`, `JMPL` or `JMPE`
+    - conditional jumps with a constant condition become unconditional jumps or are dropped
+    - writes to registers that are never read again are dropped
+
+Addresses must not move, because jump targets and data addresses are absolute inside the process. Dropped
+instructions are therefore replaced by empty words (`____`) instead of being removed from the program.
+
+Programs that may write over their own code are left untouched, since the analysis can't tell which instruction would
+run in that case.
+"""
+
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from source.command.command import to_word
+
+import logging
+
+logging.basicConfig(level=logging.WARN)
+
+REGISTERS = frozenset(f'r{i}' for i in range(10))
+
+# Instructions without side effects besides writing to their destination register(s)
+PURE = {'LDI', 'ADDI', 'SUBI', 'ADD', 'SUB', 'MULT', 'SWAP'}
+
+UNKNOWN = object()  # Successor of a jump whose target couldn't be resolved
+
+
+class OptimizationReport(NamedTuple):
+    removed: int = 0
+    simplified: int = 0
+    skipped: bool = False
+
+    def __str__(self):
+        if self.skipped:
+            return 'not optimized (the program may modify its own code)'
+        return f'{self.removed} instructions removed, {self.simplified} simplified'
+
+
+class AtLeast(NamedTuple):
+    """A value that is only known to be greater than or equal to `bound`"""
+
+    bound: int
+
+
+def _lower(value):
+    return value if isinstance(value, int) else value.bound
+
+
+def _join_value(a, b, widen_from=None):
+    if a == b:
+        return a
+    if a is None or b is None:
+        return None
+    joined = AtLeast(min(_lower(a), _lower(b)))
+    if isinstance(widen_from, AtLeast) and joined.bound < widen_from.bound:
+        # The lower bound keeps going down (e.g. a decrementing loop counter), give up on it
+        return None
+    return joined
+
+
+def _compare(value, opcode):
+    """Evaluate a jump condition, returns None if it can't be decided"""
+
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return {'G': value > 0, 'L': value < 0, 'E': value == 0}[opcode]
+    if value.bound > 0:
+        return {'G': True, 'L': False, 'E': False}[opcode]
+    if value.bound == 0:
+        return {'G': None, 'L': False, 'E': None}[opcode]
+    return None
+
+
+class State:
+    def __init__(self, registers: Dict[str, object], memory: Dict[int, int]):
+        self.registers = registers
+        self.memory = memory  # Only addresses known to hold a constant
+
+    def copy(self):
+        return State(dict(self.registers), dict(self.memory))
+
+    def join(self, other: 'State') -> 'State':
+        registers = {r: _join_value(self.registers[r], other.registers[r], self.registers[r]) for r in REGISTERS}
+        memory = {a: v for a, v in self.memory.items() if other.memory.get(a) == v}
+        return State(registers, memory)
+
+    def __eq__(self, other):
+        return self.registers == other.registers and self.memory == other.memory
+
+    def reg(self, name):
+        return self.registers[name.lower()]
+
+    def store(self, address, value):
+        """Record a store to `address`, which may be a constant, a lower bound, or unknown"""
+
+        if isinstance(address, int):
+            if isinstance(value, int):
+                self.memory[address] = value
+            else:
+                self.memory.pop(address, None)
+        elif address is None:
+            self.memory.clear()
+        else:
+            self.memory = {a: v for a, v in self.memory.items() if a < address.bound}
+
+
+def _transfer(command, pc, state: State):
+    """Return the `(successors, stores)` of `command`, at address `pc`, updating `state` in place
+
+    `successors` are addresses (or `UNKNOWN`), `stores` the addresses written to memory.
+    """
+
+    op = command.opcode
+    regs = state.registers
+    nxt = [pc + 1]
+    stores = []
+
+    if op in ('DATA', '____'):
+        pass
+    elif op == 'STOP':
+        nxt = []
+    elif op == 'JMP':
+        nxt = [command.p]
+    elif op == 'JMPI':
+        target = state.reg(command.r1)
+        nxt = [target if isinstance(target, int) else UNKNOWN]
+    elif op in ('JMPIG', 'JMPIL', 'JMPIE', 'JMPG', 'JMPL', 'JMPE', 'JMPIGM', 'JMPILM', 'JMPIEM'):
+        if op.endswith('M'):
+            target = state.memory.get(command.p)
+        elif op.startswith('JMPI'):
+            target = state.reg(command.r1)
+        else:
+            target = command.p
+        target = target if isinstance(target, int) else UNKNOWN
+        taken = _compare(state.reg(command.r2), op.rstrip('M')[-1])
+        if taken is None:
+            nxt = [target, pc + 1]
+        elif taken:
+            nxt = [target]
+    elif op == 'JMPIM':
+        target = state.memory.get(command.p)
+        nxt = [target if isinstance(target, int) else UNKNOWN]
+    elif op == 'LDI':
+        regs[command.r1.lower()] = command.p
+    elif op in ('ADDI', 'SUBI'):
+        value = state.reg(command.r1)
+        p = command.p if op == 'ADDI' else -command.p
+        if isinstance(value, int):
+            value = value + p
+        elif value is not None:
+            value = AtLeast(value.bound + p)
+        regs[command.r1.lower()] = value
+    elif op in ('ADD', 'SUB', 'MULT'):
+        a, b = state.reg(command.r1), state.reg(command.r2)
+        if isinstance(a, int) and isinstance(b, int):
+            value = {'ADD': a + b, 'SUB': a - b, 'MULT': a * b}[op]
+        elif op == 'ADD' and a is not None and b is not None:
+            value = AtLeast(_lower(a) + _lower(b))
+        elif op == 'SUB' and a is not None and isinstance(b, int):
+            value = AtLeast(_lower(a) - b)
+        else:
+            value = None
+        regs[command.r1.lower()] = value
+    elif op == 'LDD':
+        regs[command.r1.lower()] = state.memory.get(command.p)
+    elif op == 'LDX':
+        address = state.reg(command.r2)
+        regs[command.r1.lower()] = state.memory.get(address) if isinstance(address, int) else None
+    elif op == 'STD':
+        stores.append(command.p)
+        state.store(command.p, state.reg(command.r1))
+    elif op == 'STX':
+        address = state.reg(command.r1)
+        stores.append(address)
+        state.store(address, state.reg(command.r2))
+    elif op == 'SWAP':
+        a, b = command.r1.lower(), command.r2.lower()
+        regs[a], regs[b] = regs[b], regs[a]
+    elif op == 'TRAP':
+        call, address = state.reg(command.r1), state.reg(command.r2)
+        if call not in (2, 4):  # Everything but OUT and BLOCK WRITE may write to memory
+            if call != 1 and address is not None:  # BLOCK READ (or an unknown call) writes from R9 onwards
+                address = AtLeast(_lower(address))
+            stores.append(address)
+            state.store(address, None)
+    else:
+        # Unknown instruction, assume the worst
+        nxt = [UNKNOWN]
+        stores.append(None)
+        state.store(None, None)
+
+    # A jump to itself doesn't move PC, so the CPU moves on to the next instruction
+    return [pc + 1 if succ == pc else succ for succ in nxt], stores
+
+
+class _Analysis:
+    def __init__(self, words):
+        self.commands = [word.command for word in words]
+        self.size = len(self.commands)
+        self.code_addresses = [i for i, c in enumerate(self.commands) if c.opcode not in ('DATA', '____')]
+
+    def initial_state(self):
+        # Registers are zeroed when a process first enters the CPU
+        memory = {i: c.p for i, c in enumerate(self.commands) if c.opcode == 'DATA'}
+        return State({r: 0 for r in REGISTERS}, memory)
+
+    def may_overwrite_code(self, address):
+        if isinstance(address, int):
+            return address < 0 or (address < self.size and self.commands[address].opcode != 'DATA')
+        if address is None or address.bound < 0:
+            return True
+        return any(a >= address.bound for a in self.code_addresses)
+
+    def run(self) -> Optional[List[Optional[State]]]:
+        """Forward constant propagation, returns the state before each instruction (None if unreachable)
+
+        Returns None if the program may write over its own code.
+        """
+
+        states: List[Optional[State]] = [None] * self.size
+        states[0] = self.initial_state()
+        worklist = [0]
+        while worklist:
+            pc = worklist.pop()
+            state = states[pc].copy()
+            successors, stores = _transfer(self.commands[pc], pc, state)
+            if any(self.may_overwrite_code(address) for address in stores):
+                return None
+            if UNKNOWN in successors:
+                successors = range(self.size)
+            for succ in successors:
+                if not 0 <= succ < self.size:
+                    continue
+                new = state if states[succ] is None else states[succ].join(state)
+                if states[succ] is None or new != states[succ]:
+                    states[succ] = new
+                    worklist.append(succ)
+        return states
+
+
+def _uses_defs(command):
+    op = command.opcode
+    r1 = getattr(command, 'r1', '')
+    r2 = getattr(command, 'r2', '')
+    r1 = r1.lower() if isinstance(r1, str) else ''
+    r2 = r2.lower() if isinstance(r2, str) else ''
+    return {
+        'LDI': (set(), {r1}),
+        'ADDI': ({r1}, {r1}),
+        'SUBI': ({r1}, {r1}),
+        'ADD': ({r1, r2}, {r1}),
+        'SUB': ({r1, r2}, {r1}),
+        'MULT': ({r1, r2}, {r1}),
+        'LDD': (set(), {r1}),
+        'STD': ({r1}, set()),
+        'LDX': ({r2}, {r1}),
+        'STX': ({r1, r2}, set()),
+        'SWAP': ({r1, r2}, {r1, r2}),
+        'JMPI': ({r1}, set()),
+        'JMPIG': ({r1, r2}, set()),
+        'JMPIL': ({r1, r2}, set()),
+        'JMPIE': ({r1, r2}, set()),
+        'JMPG': ({r2}, set()),
+        'JMPL': ({r2}, set()),
+        'JMPE': ({r2}, set()),
+        'JMPIGM': ({r2}, set()),
+        'JMPILM': ({r2}, set()),
+        'JMPIEM': ({r2}, set()),
+        # System calls read their arguments from the saved registers
+        'TRAP': (set(REGISTERS), set()),
+    }.get(op, (set(), set()))
+
+
+def _successors(command, pc):
+    op = command.opcode
+    if op == 'STOP':
+        return []
+    if op == 'JMP':
+        successors = [command.p]
+    elif op in ('JMPG', 'JMPL', 'JMPE'):
+        successors = [command.p, pc + 1]
+    elif op.startswith('JMP'):
+        return [UNKNOWN]
+    else:
+        return [pc + 1]
+    return [pc + 1 if succ == pc else succ for succ in successors]
+
+
+def _rewrite(command, pc, state: State) -> Optional[str]:
+    """Return the simplified form of `command` given the `state` before it, or None"""
+
+    op = command.opcode
+    if op in ('LDD', 'LDX'):
+        address = command.p if op == 'LDD' else state.reg(command.r2)
+        value = state.memory.get(address) if isinstance(address, int) else None
+        if value is not None:
+            return f'LDI {command.r1}, {value}'
+    elif op in ('ADDI', 'SUBI', 'ADD', 'SUB', 'MULT'):
+        after = state.copy()
+        _transfer(command, pc, after)
+        value = after.reg(command.r1)
+        if isinstance(value, int):
+            return f'LDI {command.r1}, {value}'
+    elif op in ('JMPI', 'JMPIM'):
+        target = state.reg(command.r1) if op == 'JMPI' else state.memory.get(command.p)
+        if isinstance(target, int):
+            return f'JMP {target}'
+    elif op in ('JMPIG', 'JMPIL', 'JMPIE', 'JMPIGM', 'JMPILM', 'JMPIEM', 'JMPG', 'JMPL', 'JMPE'):
+        if op.endswith('M'):
+            target = state.memory.get(command.p)
+        elif op.startswith('JMPI'):
+            target = state.reg(command.r1)
+        else:
+            target = command.p
+        condition = op.rstrip('M')[-1]
+        taken = _compare(state.reg(command.r2), condition)
+        if taken is False:
+            return '____'
+        if isinstance(target, int):
+            return f'JMP {target}' if taken else f'JMP{condition} {target}, {command.r2}'
+        if taken and op.startswith('JMPI') and not op.endswith('M'):
+            return f'JMPI {command.r1}'
+    return None
+
+
+def _dead_stores(commands) -> Set[int]:
+    """Backward register liveness, returns the addresses of pure instructions whose results are never read"""
+
+    size = len(commands)
+    successors = [_successors(c, pc) for pc, c in enumerate(commands)]
+    uses_defs = [_uses_defs(c) for c in commands]
+    live_in: List[Set[str]] = [set() for _ in range(size)]
+
+    def live_out(pc):
+        live = set()
+        for succ in successors[pc]:
+            if succ is UNKNOWN or not 0 <= succ < size:
+                return set(REGISTERS)
+            live |= live_in[succ]
+        return live
+
+    def is_dead(pc, live):
+        return commands[pc].opcode in PURE and not (uses_defs[pc][1] & live)
+
+    changed = True
+    while changed:
+        changed = False
+        for pc in reversed(range(size)):
+            live = live_out(pc)
+            uses, defs = uses_defs[pc]
+            # A dead instruction doesn't make its operands live either
+            new = live if is_dead(pc, live) else uses | (live - defs)
+            if new != live_in[pc]:
+                live_in[pc] = new
+                changed = True
+
+    return {pc for pc in range(size) if is_dead(pc, live_out(pc))}
+
+
+def optimize(image):
+    """Optimize a decoded program
+
+    Args:
+        image (ProgramImage): Program to optimize. It is not modified
+
+    Returns:
+        ProgramImage: The optimized program, with its `OptimizationReport` in `optimization`
+    """
+
+    if not image.words:
+        return image._replace(optimization=OptimizationReport())
+
+    states = _Analysis(image.words).run()
+    if states is None:
+        logging.info(f'Optimizer: skipping {image.name}, it may modify its own code')
+        return image._replace(optimization=OptimizationReport(skipped=True))
+
+    words = list(image.words)
+    simplified = set()
+    for pc, state in enumerate(states):
+        if state is None:
+            continue
+        if (text := _rewrite(words[pc].command, pc, state)) is not None:
+            words[pc] = to_word(f'{text} ; {words[pc].original.strip()}')
+            simplified.add(pc)
+
+    removed = {pc for pc, word in enumerate(words) if word.command.opcode == '____' and pc in simplified}
+    removed |= _dead_stores([word.command for word in words])
+    for pc in removed:
+        words[pc] = to_word(f'; {image.words[pc].original.strip()}')
+
+    report = OptimizationReport(removed=len(removed), simplified=len(simplified - removed))
+    logging.info(f'Optimizer: {image.name}: {report}')
+    return image._replace(words=words, optimization=report)
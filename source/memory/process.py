@@ -1,5 +1,8 @@
 from typing import List
 from enum import Enum
+from time import perf_counter
+
+from source.memory.histogram import SchedulingHistograms
 
 ProcessState = Enum('ProcessState', 'READY RUNNING BLOCKED ENDED')
 
@@ -17,6 +20,32 @@ class ProcessControlBlock(Process):
         self.current_offset = 0  # Goes from 0 to `page_size`
         self.process_size = size  # For debugging
         self.frames = frames
+        self.optimization = None  # OptimizationReport of the program, if it was optimized on load
+        self.priority = 0  # Higher runs first, used by the priority scheduler
+        self.woken_at = None  # When its last I/O request finished (`perf_counter()`), until it runs again
+        self.idle = False  # Idle processes are created by the process manager when every other process is blocked
+
+        # Accounting
+        self.instructions = 0  # Instructions executed
+        self.context_switches = 0  # Times it has entered the CPU
+        self.run_time = 0.0  # Seconds spent on the CPU
+        self.blocked_time = 0.0  # Seconds spent waiting for I/O
+        self.exit_reason = None  # `stop`, `budget` or `io_error`, once the process has ended
+        self.io_error = None  # Why its last I/O request failed, which ends it
+        self.histograms = SchedulingHistograms()  # Kept by the process manager
+        self.ready_at = None  # When it last became ready (`perf_counter()`), until it enters the CPU
+        self.unblocked_at = None  # When it was last unblocked (`perf_counter()`), until it enters the CPU
+        self._resumed_at = None
+        self._blocked_at = None
+
+        # Budget
+        self.instruction_budget = None  # Instructions it may execute, None for no limit
+        self.demoted = False  # Schedulers run demoted processes only when nothing else is ready
+        # I/O devices of this process, the VM's devices are used when they are None
+        self.stdin = None
+        self.stdout = None
+        # Called with the process when it ends, before its frames are freed (see `source.vm.jobs`)
+        self.on_exit = None
 
         self.saved_pc_value = 0
         self.saved_register_values = {}
@@ -29,8 +58,11 @@ class ProcessControlBlock(Process):
         for register in registers.items():
             self.saved_register_values[register[0]] = register[1].value
 
+        now = perf_counter()
+        self._stop_running(now)
         if blocked:
             self.state = ProcessState.BLOCKED
+            self._blocked_at = now
         else:
             self.state = ProcessState.READY
 
@@ -41,12 +73,43 @@ class ProcessControlBlock(Process):
         for register in self.saved_register_values.items():
             registers[register[0]].value = register[1]
         self.state = ProcessState.RUNNING
+        self.context_switches += 1
+        self._resumed_at = perf_counter()
+
+    def unblock(self) -> float:
+        # Returns the seconds it has been blocked for
+        blocked = 0.0
+        if self._blocked_at is not None:
+            blocked = perf_counter() - self._blocked_at
+            self.blocked_time += blocked
+            self._blocked_at = None
+        self.state = ProcessState.READY
+        return blocked
+
+    def end(self, reason = 'stop'):
+        self._stop_running(perf_counter())
+        self.state = ProcessState.ENDED
+        self.exit_reason = reason
+
+    def _stop_running(self, now):
+        if self._resumed_at is not None:
+            self.run_time += now - self._resumed_at
+            self._resumed_at = None
+
+    @property
+    def over_budget(self) -> bool:
+        return self.instruction_budget is not None and self.instructions >= self.instruction_budget
 
     def dump(self) -> List[str]:
         return [
             f'|\tNAME: {self.name:<69}|\n',
             f'|\tPID: {self.pid:<70}|\n',
             f'|\tSIZE: {self.process_size:<69}|\n',
+            f'|\tPRIORITY: {self.priority:<65}|\n',
+            f'|\tINSTRUCTIONS: {self.instructions:<61}|\n',
+            f'|\tCONTEXT SWITCHES: {self.context_switches:<57}|\n',
+            f'|\tRUN TIME: {self.run_time:<65.6f}|\n',
+            f'|\tBLOCKED TIME: {self.blocked_time:<61.6f}|\n',
             f'|\tNUM. FRAMES: {len(self.frames):<62}|\n',
             f'|\tCURRENT_FRAME: {self.current_frame:<60}|\n',
             f'|\tCURRENT_OFFSET: {self.current_offset:<59}|\n',
@@ -0,0 +1,81 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterator, NamedTuple, Optional
+
+from source.memory.process import ProcessControlBlock
+
+
+class ProcessSummary(NamedTuple):
+    """What is kept of a process after it has been reaped"""
+
+    pid: int
+    name: str
+    state: str
+    exit_reason: Optional[str]  # See `ProcessControlBlock.exit_reason`
+    instructions: int  # Instructions executed
+    context_switches: int
+    run_time: float  # Seconds spent on the CPU
+    blocked_time: float  # Seconds spent waiting for I/O
+
+    @classmethod
+    def of(cls, process: ProcessControlBlock) -> 'ProcessSummary':
+        return cls(process.pid, process.name, process.state.name, process.exit_reason, process.instructions,
+                   process.context_switches, process.run_time, process.blocked_time)
+
+
+class ProcessTable:
+    """Every process that hasn't been reaped, by PID
+
+    Ended processes are kept as zombies, so that they can still be inspected (and dumped), until more than `keep_ended`
+    processes have ended. The oldest one is then reaped: its control block is dropped and only a `ProcessSummary` is
+    kept, for the last `history` reaped processes. Memory use is bounded no matter how many processes have run.
+    """
+
+    def __init__(self, keep_ended: int = 64, history: int = 1024):
+        self.keep_ended = keep_ended
+        self.history = history
+        self._processes: Dict[int, ProcessControlBlock] = {}
+        self._zombies: Deque[int] = deque()  # PIDs of ended processes, oldest first
+        self._summaries: 'OrderedDict[int, ProcessSummary]' = OrderedDict()
+        self.reaped = 0
+
+    def add(self, process: ProcessControlBlock):
+        self._processes[process.pid] = process
+
+    def __getitem__(self, pid: int) -> ProcessControlBlock:
+        return self._processes[pid]
+
+    def get(self, pid: int, default=None) -> Optional[ProcessControlBlock]:
+        return self._processes.get(pid, default)
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self._processes
+
+    def __len__(self) -> int:
+        return len(self._processes)
+
+    def __iter__(self) -> Iterator[ProcessControlBlock]:
+        return iter(list(self._processes.values()))
+
+    def ended(self, process: ProcessControlBlock, keep: bool = True):
+        """Mark `process` as ended. If `keep` is False, it's reaped right away"""
+
+        if not keep:
+            self.reap(process.pid)
+            return
+        self._zombies.append(process.pid)
+        while len(self._zombies) > self.keep_ended:
+            self.reap(self._zombies.popleft())
+
+    def reap(self, pid: int):
+        process = self._processes.pop(pid)
+        self.reaped += 1
+        self._summaries[pid] = ProcessSummary.of(process)
+        while len(self._summaries) > self.history:
+            self._summaries.popitem(last=False)
+
+    def summary(self, pid: int) -> Optional[ProcessSummary]:
+        """Summary of a process, whether it has been reaped or not. None if it isn't known (anymore)"""
+
+        if (process := self._processes.get(pid)) is not None:
+            return ProcessSummary.of(process)
+        return self._summaries.get(pid)
@@ -0,0 +1,99 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Any, Iterable, List, NamedTuple, Union
+import os
+
+from source.command.command import to_word
+from source.memory import optimizer
+from source.word.word import Word
+
+
+class ProgramImage(NamedTuple):
+    """Decoded program, ready to be installed into memory
+
+    Each word's index is its relative address inside the process.
+    """
+
+    name: str
+    words: List[Word]
+    optimization: Any = None  # OptimizationReport, if the optimizer ran on this program
+
+
+def decode_program(name, code) -> ProgramImage:
+    """Convert the lines of an assembly program to a `ProgramImage`
+
+    Args:
+        name (str): Program name
+        code (Iterable[str]): Program lines
+
+    Raises:
+        EInvalidCommand: A line could not be converted to a command
+    """
+
+    words = []
+    for line in code:
+        if word := to_word(line.lstrip(' ').lstrip('\t')):
+            words.append(word)
+    return ProgramImage(name, words)
+
+
+def decode_file(file: Path, optimize: bool = False) -> ProgramImage:
+    """Read and decode a program file
+
+    Args:
+        file (Path): Program file
+        optimize (bool): Run the load-time optimizer on the decoded program (see `source.memory.optimizer`)
+    """
+
+    with open(file, 'r') as f:
+        source = f.read()
+    return decode_source(file.name, source, optimize)
+
+
+def decode_source(name: str, source: str, optimize: bool = False) -> ProgramImage:
+    """Decode the source of a program, such as one uploaded through the shell socket
+
+    Args:
+        name (str): Program name
+        source (str): Program source
+        optimize (bool): Run the load-time optimizer on the decoded program (see `source.memory.optimizer`)
+    """
+
+    image = decode_program(name, source.splitlines(keepends=True))
+    if optimize:
+        image = optimizer.optimize(image)
+    return image
+
+
+def _decode_file_or_error(file: Path, optimize: bool = False) -> Union[ProgramImage, Exception]:
+    # Exceptions are returned instead of raised so a single bad file doesn't discard the whole batch
+    try:
+        return decode_file(file, optimize)
+    except Exception as E:
+        return E
+
+
+def decode_files(files: Iterable[Path], workers: int = None,
+                 optimize: bool = False) -> List[Union[ProgramImage, Exception]]:
+    """Decode many program files, in parallel worker processes when possible
+
+    Results are returned in the same order as `files`. A file that could not be read or decoded has its exception
+    returned in place of the image.
+
+    Args:
+        files (Iterable[Path]): Program files
+        workers (int): Number of worker processes. Defaults to the number of CPUs
+        optimize (bool): Run the load-time optimizer on each decoded program, inside the workers
+    """
+
+    decode = partial(_decode_file_or_error, optimize=optimize)
+    files = list(files)
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    if workers <= 1:
+        # Not worth paying for the pool start-up
+        return [decode(file) for file in files]
+
+    chunk_size = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(decode, files, chunksize=chunk_size))
@@ -0,0 +1,221 @@
+"""Scheduling policies
+
+A scheduler holds the ready processes and decides which one runs next and for how long. The `ProcessManager` tells it
+why each process became ready (see `ReadyReason`), so that policies can tell CPU-bound processes, which use up their
+time slice, apart from I/O-bound ones, which give the CPU away by blocking.
+
+Every policy runs demoted processes (`ProcessControlBlock.demoted`, see `ProcessManager.budget_action`) only when no
+other process is ready.
+
+The process manager's lock is held around every call, so schedulers don't need to be thread-safe.
+"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+from enum import Enum
+from heapq import heappop, heappush
+from itertools import count
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Sequence
+
+from source.command.command import ESignalVirtualAlarm
+from source.memory.process import ProcessControlBlock
+
+# PREEMPTED: used up its time slice. INTERRUPTED: gave way to a process that woke up before its time slice ended
+ReadyReason = Enum('ReadyReason', 'NEW PREEMPTED INTERRUPTED UNBLOCKED')
+
+
+class IScheduler(ABC):
+    @abstractmethod
+    def add(self, process: ProcessControlBlock, reason: ReadyReason = ReadyReason.NEW): ...
+
+    @abstractmethod
+    def next(self) -> Optional[ProcessControlBlock]:
+        """Remove and return the process that runs next. None if there are no ready processes"""
+
+    @abstractmethod
+    def __len__(self) -> int: ...
+
+    def quantum(self, process: ProcessControlBlock) -> int:
+        """Number of instructions `process` runs before it is preempted"""
+
+        return ESignalVirtualAlarm.SIGVTALRM_THRESHOLD
+
+    def wake(self, process: ProcessControlBlock):
+        """Make a process whose I/O has finished ready, ahead of the others as far as the policy allows
+
+        Used with wake-up preemption. Defaults to `add`.
+        """
+
+        self.add(process, ReadyReason.UNBLOCKED)
+
+    def discard(self, process: ProcessControlBlock):
+        """Forget about a process that has ended"""
+
+
+class RoundRobinScheduler(IScheduler):
+    """First come, first served, with every process preempted after the same time slice"""
+
+    def __init__(self, quantum: int = ESignalVirtualAlarm.SIGVTALRM_THRESHOLD):
+        self._quantum = quantum
+        self._ready: Deque[ProcessControlBlock] = deque()
+        self._demoted: Deque[ProcessControlBlock] = deque()
+
+    def add(self, process, reason=ReadyReason.NEW):
+        (self._demoted if process.demoted else self._ready).append(process)
+
+    def next(self):
+        if self._ready:
+            return self._ready.popleft()
+        return self._demoted.popleft() if self._demoted else None
+
+    def wake(self, process):
+        (self._demoted if process.demoted else self._ready).appendleft(process)
+
+    def __len__(self):
+        return len(self._ready) + len(self._demoted)
+
+    def quantum(self, process):
+        return self._quantum
+
+
+class PriorityScheduler(IScheduler):
+    """Static priorities: the ready process with the highest `priority` runs first
+
+    Processes with the same priority take turns. Lower priority processes only run when no higher priority process is
+    ready.
+    """
+
+    def __init__(self, quantum: int = ESignalVirtualAlarm.SIGVTALRM_THRESHOLD):
+        self._quantum = quantum
+        self._ready: List = []  # Heap of (demoted, -priority, not woken, arrival, process)
+        self._arrival = count()
+
+    def add(self, process, reason=ReadyReason.NEW):
+        heappush(self._ready, (process.demoted, -process.priority, True, next(self._arrival), process))
+
+    def wake(self, process):
+        # Ahead of the other processes with the same priority
+        heappush(self._ready, (process.demoted, -process.priority, False, next(self._arrival), process))
+
+    def next(self):
+        return heappop(self._ready)[-1] if self._ready else None
+
+    def __len__(self):
+        return len(self._ready)
+
+    def quantum(self, process):
+        return self._quantum
+
+
+class MLFQScheduler(IScheduler):
+    """Multilevel feedback queue
+
+    New processes start at the top level. A process that uses up its time slice is moved down a level, where slices
+    are longer, and a process that blocks for I/O before its slice ends is moved up a level. So interactive, I/O-bound
+    processes stay on top and get the CPU as soon as they are ready, while CPU-bound ones sink and run in longer
+    slices when nothing else is ready.
+
+    Every `boost_interval` scheduling decisions, every process is moved back to the top level so that processes at the
+    bottom never starve.
+    """
+
+    def __init__(self, quanta: Sequence[int] = (5, 10, 20), boost_interval: int = 1000):
+        """
+        Args:
+            quanta (Sequence[int]): Time slice of each level, from the top level down
+            boost_interval (int): Scheduling decisions between priority boosts. 0 disables boosts
+        """
+
+        self.quanta = list(quanta)
+        self.boost_interval = boost_interval
+        self._levels: List[Deque[ProcessControlBlock]] = [deque() for _ in self.quanta]
+        self._level_of: Dict[int, int] = {}  # Current level by PID
+        self._decisions = 0
+
+    def level(self, process: ProcessControlBlock) -> int:
+        return self._level_of.get(process.pid, 0)
+
+    def add(self, process, reason=ReadyReason.NEW):
+        level = self.level(process)
+        if process.demoted:  # Stuck at the bottom
+            level = len(self._levels) - 1
+        elif reason == ReadyReason.NEW:
+            level = 0
+        elif reason == ReadyReason.PREEMPTED:
+            level = min(level + 1, len(self._levels) - 1)
+        elif reason == ReadyReason.UNBLOCKED:
+            level = max(level - 1, 0)
+        self._level_of[process.pid] = level
+        self._levels[level].append(process)
+
+    def wake(self, process):
+        level = len(self._levels) - 1 if process.demoted else max(self.level(process) - 1, 0)
+        self._level_of[process.pid] = level
+        self._levels[level].appendleft(process)
+
+    def next(self):
+        self._decisions += 1
+        if self.boost_interval and self._decisions % self.boost_interval == 0:
+            self._boost()
+
+        for level in self._levels:
+            if level:
+                return level.popleft()
+        return None
+
+    def _boost(self):
+        top = self._levels[0]
+        for level in self._levels[1:]:
+            top.extend(level)
+            level.clear()
+        self._level_of.clear()
+
+    def __len__(self):
+        return sum(len(level) for level in self._levels)
+
+    def discard(self, process):
+        self._level_of.pop(process.pid, None)
+
+    def quantum(self, process):
+        return self.quanta[self.level(process)]
+
+
+class LatencyStats:
+    """Count, average and maximum of a latency, in seconds"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency: float):
+        with self._lock:
+            self.count += 1
+            self.total += latency
+            self.max = max(self.max, latency)
+
+    def as_dict(self) -> Dict[str, float]:
+        with self._lock:
+            return {'count': self.count, 'avg': self.total / (self.count or 1), 'max': self.max}
+
+
+SCHEDULERS = {
+    'round-robin': RoundRobinScheduler,
+    'priority': PriorityScheduler,
+    'mlfq': MLFQScheduler,
+}
+
+
+def make_scheduler(scheduler=None) -> IScheduler:
+    """Get a scheduler from a policy name (see `SCHEDULERS`), or an `IScheduler` itself. Defaults to round-robin"""
+
+    if scheduler is None:
+        return RoundRobinScheduler()
+    if isinstance(scheduler, IScheduler):
+        return scheduler
+    try:
+        return SCHEDULERS[scheduler]()
+    except KeyError:
+        raise ValueError(f'Unknown scheduler {scheduler!r}. Choose one of: {", ".join(SCHEDULERS)}')
@@ -0,0 +1,478 @@
+"""Programmatic clients of the shell socket
+
+`AsyncClient` (for coroutines) and `Client` (for everything else) keep a pool of persistent connections to one or
+more VMs (or dispatchers), pipeline requests over them, and reconnect when a connection is lost. VMs are given by
+address, over TCP or Unix domain sockets (see `parse_address`):
+
+    with Client(['localhost:8899', 'unix:/run/vm1.sock']) as client:
+        pids = client.upload_files(paths)
+        print(client.stats())
+        for event in client.subscribe(['output']):
+            print(event)
+"""
+
+import asyncio
+import json
+import queue
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+from source.vm.protocol import (DEFAULT_ADDRESS, HEADER, Address, EProtocolError, Frame, FrameKind, decode_header,
+                                encode_frame, encode_upload, parse_address)
+
+
+class EConnectionLost(ConnectionError):
+    """The connection was lost before the reply to a request arrived
+
+    `sent` tells whether the request may have reached the VM. If it did, the VM may have acted on it.
+    """
+
+    def __init__(self, message: str, sent: bool):
+        super().__init__(message)
+        self.sent = sent
+
+
+class ESubscriptionDropped(Exception):
+    """The VM dropped an event subscription because its events weren't read fast enough. Some were lost"""
+
+
+class AsyncConnection:
+    """A pipelined connection to a VM's shell socket, for coroutines
+
+    Any number of coroutines can make requests at once: each one is written right away and a single reader matches
+    the replies to their requests by ID.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._streams: Dict[int, asyncio.Queue] = {}  # Replies of event subscriptions
+        self._replies = asyncio.ensure_future(self._read_replies())
+
+    @classmethod
+    async def connect(cls, address: Union[Address, int] = DEFAULT_ADDRESS) -> 'AsyncConnection':
+        """Connect to a TCP or Unix domain socket. See `parse_address`"""
+
+        address = parse_address(address)
+        if isinstance(address, str):
+            return cls(*await asyncio.open_unix_connection(address))
+        return cls(*await asyncio.open_connection(*address))
+
+    @property
+    def closed(self) -> bool:
+        return self._replies.done()
+
+    async def request(self, kind: FrameKind, payload: bytes) -> Frame:
+        """Send a request and wait for its reply
+
+        Raises:
+            EProtocolError: The VM replied with an `ERROR` frame
+            EConnectionLost: The connection was lost
+        """
+
+        if self.closed:
+            raise EConnectionLost('Connection closed by the VM', sent=False)
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        reply = self._pending[self._next_id] = asyncio.get_running_loop().create_future()
+        try:
+            self._writer.write(encode_frame(self._next_id, kind, payload))
+            await self._writer.drain()
+        except ConnectionError as E:
+            self._pending.pop(self._next_id, None)
+            raise EConnectionLost(f'Connection lost: {E!r}', sent=True)
+        frame = await reply
+        if frame.kind == FrameKind.ERROR:
+            raise EProtocolError(frame.text())
+        return frame
+
+    async def command(self, command: str) -> str:
+        """Send a shell command and return its reply"""
+
+        return (await self.request(FrameKind.COMMAND, command.encode('utf-8'))).text()
+
+    async def upload(self, name: str, source: bytes, priority: int = 0) -> str:
+        """Upload a program in binary form and return the reply"""
+
+        return (await self.request(FrameKind.UPLOAD, encode_upload(name, source, priority))).text()
+
+    async def subscribe(self, kinds: Iterable[str] = ()) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the VM's events, of every kind by default (see `source.vm.events`)
+
+        The subscription lasts until the iteration is stopped and the connection closed, or until the VM shuts down.
+
+        Raises:
+            ValueError: Unknown event kind
+            ESubscriptionDropped: The events weren't read fast enough
+            EConnectionLost: The connection was lost
+        """
+
+        if self.closed:
+            raise EConnectionLost('Connection closed by the VM', sent=False)
+        replies: asyncio.Queue = asyncio.Queue()
+        self._next_id = request_id = (self._next_id + 1) & 0xFFFFFFFF
+        self._streams[request_id] = replies
+        try:
+            self._writer.write(encode_frame(request_id, FrameKind.COMMAND,
+                                            ' '.join(['subscribe', *kinds]).encode('utf-8')))
+            try:
+                await self._writer.drain()
+            except ConnectionError as E:
+                raise EConnectionLost(f'Connection lost: {E!r}', sent=True)
+            while (frame := await replies.get()) is not None:
+                if frame.kind == FrameKind.ERROR:
+                    raise EProtocolError(frame.text())
+                reply = json.loads(frame.text())
+                if isinstance(reply, list):
+                    for event in reply:
+                        yield event
+                elif 'error' in reply:
+                    raise ValueError(reply['error'])
+                elif reply.get('dropped'):
+                    raise ESubscriptionDropped(reply['end'])
+                else:
+                    return
+            raise EConnectionLost('Connection closed by the VM', sent=True)
+        finally:
+            self._streams.pop(request_id, None)
+
+    @property
+    def pending(self) -> int:
+        """Requests waiting for their reply"""
+
+        return len(self._pending)
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        await asyncio.gather(self._replies, return_exceptions=True)
+
+    async def _read_replies(self):
+        error: Optional[Exception] = None
+        try:
+            while True:
+                length, request_id, kind = decode_header(await self._reader.readexactly(HEADER.size))
+                frame = Frame(request_id, kind, await self._reader.readexactly(length))
+                if (stream := self._streams.get(request_id)) is not None:
+                    stream.put_nowait(frame)
+                elif (reply := self._pending.pop(request_id, None)) is not None and not reply.done():
+                    reply.set_result(frame)
+        except (asyncio.IncompleteReadError, ConnectionError) as E:
+            error = EConnectionLost(f'Connection closed by the VM: {E!r}', sent=True)
+        except Exception as E:
+            error = E
+        finally:
+            for reply in self._pending.values():
+                if not reply.done():
+                    reply.set_exception(error or EConnectionLost('Connection closed', sent=True))
+            self._pending.clear()
+            for stream in self._streams.values():
+                stream.put_nowait(None)
+
+
+def _pid(reply: str) -> Union[int, str]:
+    # New process PID: <pid>. Dispatchers name processes <worker>:<pid>
+    pid = reply.rpartition(' ')[2]
+    try:
+        return int(pid)
+    except ValueError:
+        return pid
+
+
+class AsyncClient:
+    """Pool of pipelined connections to one or more VMs, for coroutines
+
+    Connections are opened when they're first needed and kept open. Each request goes over the connection, of any VM,
+    with the fewest requests in flight. Requests that only read (`ps`, `stats`, ...) go to the first VM,
+    unless an `address` is given.
+
+    A lost connection is reopened and the request retried, up to `retries` times. Requests that load programs are only
+    retried if they can't have reached the VM, so they never run twice.
+    """
+
+    def __init__(self, addresses: Sequence[Union[Address, int]] = (DEFAULT_ADDRESS,), pool_size: int = 2,
+                 retries: int = 3, retry_delay: float = 0.1):
+        """
+        Args:
+            addresses (Sequence[Union[str, Tuple[str, int]]]): VMs (or dispatchers) to connect to, such as
+                `('localhost', 8899)`, `'localhost:8899'` or `'unix:/run/vm.sock'`
+            pool_size (int): Connections per VM
+            retries (int): How many times a request is retried when its connection is lost
+            retry_delay (float): Seconds before a retry, doubled on every retry
+        """
+
+        self.addresses = [parse_address(address) for address in addresses]
+        self.pool_size = max(1, pool_size)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pools: Dict[Address, List[Optional[AsyncConnection]]] = {
+            address: [None] * self.pool_size for address in self.addresses}
+        self._load: Dict[Address, List[int]] = {address: [0] * self.pool_size for address in self.addresses}
+        self._connecting: Dict[Tuple[Address, int], asyncio.Future] = {}
+        self.reconnects = 0
+
+    def _pick(self, address: Address = None) -> Tuple[Address, int]:
+        # The slot, of `address` or of any VM, with the fewest requests in flight
+        addresses = [parse_address(address)] if address is not None else self.addresses
+        _, address, slot = min((load, a, slot) for a in addresses for slot, load in enumerate(self._load[a]))
+        return address, slot
+
+    async def _connection(self, address: Address, slot: int) -> AsyncConnection:
+        connection = self._pools[address][slot]
+        if connection is None or connection.closed:
+            connection = await self._open(address, slot)
+        return connection
+
+    async def _open(self, address: Address, slot: int) -> AsyncConnection:
+        # Concurrent requests that need the same slot share a single attempt
+        key = (address, slot)
+        if (opening := self._connecting.get(key)) is None:
+            opening = self._connecting[key] = asyncio.ensure_future(AsyncConnection.connect(address))
+            if self._pools[address][slot] is not None:
+                self.reconnects += 1
+        try:
+            connection = await opening
+        finally:
+            self._connecting.pop(key, None)
+        self._pools[address][slot] = connection
+        return connection
+
+    async def request(self, kind: FrameKind, payload: bytes, address: Address = None,
+                      idempotent: bool = True) -> Frame:
+        """Send a request, retrying on connection loss, and return its reply
+
+        Args:
+            address (Tuple[str, int]): VM to send it to. Defaults to the least busy connection of any VM
+            idempotent (bool): Whether the request may be retried after it may have reached the VM
+        """
+
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            picked, slot = self._pick(address)
+            self._load[picked][slot] += 1
+            try:
+                connection = await self._connection(picked, slot)
+                return await connection.request(kind, payload)
+            except OSError as E:  # Including `EConnectionLost`
+                if attempt == self.retries or (isinstance(E, EConnectionLost) and E.sent and not idempotent):
+                    raise
+            finally:
+                self._load[picked][slot] -= 1
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def command(self, command: str, address: Address = None, idempotent: bool = True) -> str:
+        return (await self.request(FrameKind.COMMAND, command.encode('utf-8'), address, idempotent)).text()
+
+    async def _status(self, command: str, address: Address = None):
+        return json.loads(await self.command(command, address or self.addresses[0]))
+
+    async def load(self, path: str, priority: int = 0) -> Union[int, str]:
+        """Load a program file on the VM's machine. Returns its PID, -1 if it could not be loaded"""
+
+        return _pid(await self.command(f'load {path} {priority}', idempotent=False))
+
+    async def upload(self, name: str, source: Union[str, bytes], priority: int = 0) -> Union[int, str]:
+        """Load a program from its source. Returns its PID, -1 if it could not be loaded"""
+
+        source = source.encode('utf-8') if isinstance(source, str) else source
+        return _pid((await self.request(FrameKind.UPLOAD, encode_upload(name, source, priority),
+                                        idempotent=False)).text())
+
+    async def upload_files(self, files: Iterable[Path], priority: int = 0) -> List[Union[int, str]]:
+        """Upload program files, all at once. Returns their PIDs, in order"""
+
+        return list(await asyncio.gather(*(self.upload(Path(file).name, Path(file).read_bytes(), priority)
+                                           for file in files)))
+
+    async def job(self, program: Union[Path, str], inputs: Iterable[int] = (),
+                  memory: Iterable[Tuple[int, int]] = (), name: str = 'job', priority: int = 0) -> Dict[str, Any]:
+        """Run a program as a job and return its result. See `VirtualMachine.submit`
+
+        Raises:
+            RuntimeError: The job failed
+        """
+
+        if isinstance(program, Path):
+            name, program = program.name, program.read_text()
+        request = {'name': name, 'source': program, 'inputs': list(inputs), 'memory': [list(r) for r in memory],
+                   'priority': priority}
+        result = json.loads(await self.command(f'job {json.dumps(request)}', idempotent=False))
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+        return result
+
+    async def ps(self, address: Address = None) -> List[Dict[str, Any]]:
+        return await self._status('ps', address)
+
+    async def mem(self, address: Address = None) -> Dict[str, Any]:
+        return await self._status('mem', address)
+
+    async def stats(self, address: Address = None) -> Dict[str, Any]:
+        return await self._status('stats', address)
+
+    async def proc(self, pid: Union[int, str], address: Address = None) -> Dict[str, Any]:
+        return await self._status(f'proc {pid}', address)
+
+    async def subscribe(self, kinds: Iterable[str] = (), address: Address = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the events of a VM, the first one by default. See `AsyncConnection.subscribe`
+
+        The subscription has a connection of its own, so that a burst of events doesn't hold back other requests.
+        It isn't retried: events sent while reconnecting would be lost.
+        """
+
+        connection = await AsyncConnection.connect(address if address is not None else self.addresses[0])
+        try:
+            async for event in connection.subscribe(kinds):
+                yield event
+        finally:
+            await connection.close()
+
+    async def shutdown(self):
+        """Shut every VM down"""
+
+        await asyncio.gather(*(self.command('shutdown', address) for address in self.addresses),
+                             return_exceptions=True)
+
+    async def close(self):
+        connections = [connection for pool in self._pools.values() for connection in pool if connection is not None]
+        await asyncio.gather(*(connection.close() for connection in connections), return_exceptions=True)
+        self._pools = {address: [None] * self.pool_size for address in self.addresses}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+
+class Client:
+    """Pool of pipelined connections to one or more VMs, for synchronous code
+
+    Runs an `AsyncClient` on an event loop of its own, on a background thread. Every method blocks until its reply
+    arrives, except `job`, which returns a future, and `subscribe`, which returns an iterator. Calls from several
+    threads, and `upload_files`, are pipelined.
+    """
+
+    def __init__(self, addresses: Sequence[Union[Address, int]] = (DEFAULT_ADDRESS,), pool_size: int = 2,
+                 retries: int = 3, retry_delay: float = 0.1, timeout: float = None):
+        """
+        Args:
+            timeout (float): Seconds to wait for a reply. None waits forever
+            See `AsyncClient` for the others
+        """
+
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='shell-client')
+        self._thread.start()
+        self.client: AsyncClient = self._call(self._create(addresses, pool_size, retries, retry_delay))
+        self._subscriptions: Set[Future] = set()
+
+    @staticmethod
+    async def _create(*args) -> AsyncClient:
+        return AsyncClient(*args)  # On the loop, where its futures belong
+
+    def _submit(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def _call(self, coroutine):
+        return self._submit(coroutine).result(self.timeout)
+
+    def command(self, command: str, address: Address = None, idempotent: bool = True) -> str:
+        return self._call(self.client.command(command, address, idempotent))
+
+    def load(self, path: str, priority: int = 0) -> Union[int, str]:
+        return self._call(self.client.load(path, priority))
+
+    def upload(self, name: str, source: Union[str, bytes], priority: int = 0) -> Union[int, str]:
+        return self._call(self.client.upload(name, source, priority))
+
+    def upload_files(self, files: Iterable[Path], priority: int = 0) -> List[Union[int, str]]:
+        return self._call(self.client.upload_files(files, priority))
+
+    def job(self, program: Union[Path, str], inputs: Iterable[int] = (), memory: Iterable[Tuple[int, int]] = (),
+            name: str = 'job', priority: int = 0) -> Future:
+        """Run a program as a job. Returns a future of its result"""
+
+        return self._submit(self.client.job(program, inputs, memory, name, priority))
+
+    def ps(self, address: Address = None) -> List[Dict[str, Any]]:
+        return self._call(self.client.ps(address))
+
+    def mem(self, address: Address = None) -> Dict[str, Any]:
+        return self._call(self.client.mem(address))
+
+    def stats(self, address: Address = None) -> Dict[str, Any]:
+        return self._call(self.client.stats(address))
+
+    def proc(self, pid: Union[int, str], address: Address = None) -> Dict[str, Any]:
+        return self._call(self.client.proc(pid, address))
+
+    def subscribe(self, kinds: Iterable[str] = (), address: Address = None) -> Iterator[Dict[str, Any]]:
+        """Stream the events of a VM. See `AsyncClient.subscribe`
+
+        The subscription ends when the iterator is closed (or garbage collected) or when the VM shuts down.
+        """
+
+        # Bounded, so that a consumer that can't keep up stops reading the socket and the VM drops it, as it would
+        # drop a slow `AsyncClient` subscriber
+        events: queue.Queue = queue.Queue(1024)
+        done = object()
+
+        async def put(item):
+            try:
+                events.put_nowait(item)
+            except queue.Full:
+                await asyncio.get_running_loop().run_in_executor(None, events.put, item)
+
+        async def pump():
+            try:
+                async for event in self.client.subscribe(kinds, address):
+                    await put(event)
+            except asyncio.CancelledError:  # The iterator, or the client, has been closed
+                try:
+                    events.put_nowait(done)
+                except queue.Full:
+                    pass
+                raise
+            except Exception as E:
+                await put(E)
+                return
+            await put(done)
+
+        task = self._submit(pump())
+        self._subscriptions.add(task)
+        task.add_done_callback(self._subscriptions.discard)
+        try:
+            while (event := events.get()) is not done:
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            task.cancel()
+            while not events.empty():  # Let a blocked `put` finish
+                events.get_nowait()
+
+    def shutdown(self):
+        self._call(self.client.shutdown())
+
+    def close(self):
+        if self._thread.is_alive():
+            for subscription in list(self._subscriptions):
+                subscription.cancel()
+            self._call(self.client.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,16 +1,34 @@
+from pathlib import Path
 from pyfiglet import figlet_format
-from typing import Callable, Dict
+from typing import Callable, Dict, Iterable, List
+import json
 import socket
+import sys
+
+from source.vm.protocol import (DEFAULT_ADDRESS, Address, Frame, FrameDecoder, FrameKind, encode_frame, encode_upload,
+                                format_address, parse_address)
 
 
 class CommandHandler:
     def __init__(self, sock) -> None:
         self.sock = sock
+        self._decoder = FrameDecoder()
+        self._next_id = 0
+        self._replies: Dict[int, Frame] = {}  # Replies received while waiting for another one
 
         self._funcs: Dict[str, Callable] = {
             'help': self.help,
             'shutdown': self.shutdown,
             'load': self.load_program,
+            'upload': self.upload_programs,
+            'ps': self.ps,
+            'mem': self.mem,
+            'stats': self.stats,
+            'proc': self.proc,
+            'job': self.job,
+            'watch': self.watch,
+            'profile': self.profile,
+            'trace': self.trace,
             'echo': self.echo,
             'exit': lambda _: exit(0),
         }
@@ -62,16 +80,164 @@ class CommandHandler:
 
         Args:
             path (str): the program file path
+            priority (int): optional scheduling priority, higher runs first
         """
 
-        file: str = args[0][0][0]
+        file, _, priority = args[0][0][0].strip().rpartition(' ')
+        if not priority.lstrip('-').isdigit():
+            file, priority = args[0][0][0].strip(), ''
 
         if not file or file.endswith('/') or file.endswith('\\') or \
             not file.endswith('.asm'):
             print('Invalid file')
             return
 
-        self.send(f'load {file}')
+        self.send(f'load {file} {priority}'.rstrip())
+
+    def upload_programs(self, *args):
+        """
+        Uploads programs from this machine into the VM's memory
+
+        The programs are all sent at once, without waiting for each reply.
+
+        Args:
+            paths (str): the program file paths, separated by spaces
+            priority (int): optional scheduling priority of every program, higher runs first
+        """
+
+        files = args[0][0][0].split()
+        priority = int(files.pop()) if files and files[-1].lstrip('-').isdigit() else 0
+        if not files or not all(file.endswith('.asm') for file in files):
+            print('Invalid file')
+            return
+
+        for reply in self.upload(files, priority):
+            print(reply)
+
+    def upload(self, files: Iterable[Path], priority: int = 0) -> List[str]:
+        """Upload program files, pipelined, and return the reply to each one in the same order"""
+
+        ids = [self.request(FrameKind.UPLOAD, encode_upload(Path(file).name, Path(file).read_bytes(), priority))
+               for file in files]
+        return [self.reply(request_id).text() for request_id in ids]
+
+    def ps(self, *args):
+        """
+        Lists the VM's processes
+
+        Prints the PID, name, state, priority, instructions executed and frames of every process.
+        """
+
+        print(f'{"PID":>6} {"NAME":<24} {"STATE":<8} {"PRIO":>4} {"INSTRUCTIONS":>12} {"FRAMES":>6}')
+        for process in self.query('ps'):
+            print('{pid:>6} {name:<24} {state:<8} {priority:>4} {instructions:>12} {frames:>6}'.format(**process))
+
+    def mem(self, *args):
+        """
+        Shows the VM's memory usage
+
+        Prints the page size, the number of frames and how many are free.
+        """
+
+        self.print_json(self.query('mem'))
+
+    def stats(self, *args):
+        """
+        Shows the VM's metrics
+
+        Prints instructions and context switches per second (since the previous `stats`), the run queue length,
+        the blocked processes, I/O queue depths and latencies.
+        """
+
+        self.print_json(self.query('stats'))
+
+    def proc(self, *args):
+        """
+        Shows the details of a process
+
+        Args:
+            pid (int): the process ID
+        """
+
+        self.print_json(self.query(f'proc {args[0][0][0].strip()}'))
+
+    def job(self, *args):
+        """
+        Runs a program from this machine as a job and waits for its result
+
+        Prints the program's outputs once it has ended.
+
+        Args:
+            path (str): the program file path
+            inputs (int): optional values the program reads, separated by spaces
+        """
+
+        file, *inputs = args[0][0][0].split()
+        if not file.endswith('.asm'):
+            print('Invalid file')
+            return
+
+        request = {'name': Path(file).name, 'source': Path(file).read_text(), 'inputs': [int(i) for i in inputs]}
+        self.print_json(self.query(f'job {json.dumps(request)}'))
+
+    def profile(self, *args):
+        """
+        Shows the VM's execution profile
+
+        Prints the instructions and time per opcode, the hottest instruction addresses and the time spent on context
+        switches, interruptions and address translation. The VM has to be started with `--profile`.
+
+        Args:
+            top (int): optional number of hot spots to show, 20 by default
+        """
+
+        self.print_json(self.query(f'profile {args[0][0][0].strip()}'.strip()))
+
+    def trace(self, *args):
+        """
+        Writes the VM's execution trace to a file
+
+        The trace holds the last instructions the CPU ran, and can be read with `python3 -m source.cpu.trace FILE`.
+        The VM has to be started with `--trace`.
+
+        Args:
+            file (str): optional path of the trace file, on the VM's side. The VM's `trace_file` by default
+        """
+
+        self.print_json(self.query(f'trace {args[0][0][0].strip()}'.strip()))
+
+    def watch(self, *args):
+        """
+        Streams the VM's events until Ctrl+C is pressed
+
+        Prints one event per line, as it happens.
+
+        Args:
+            kinds (str): optional event kinds, separated by spaces: created, scheduled, blocked, unblocked, ended,
+                output, out_of_memory, invalid_address and fault. Every kind by default
+        """
+
+        # The subscription lasts as long as its connection, so it gets one of its own
+        peer = self.sock.getpeername()
+        with connect(peer if isinstance(peer, str) else peer[:2]) as sock:
+            watcher = CommandHandler(sock)
+            request_id = watcher.request(FrameKind.COMMAND, f'subscribe {args[0][0][0]}'.strip().encode('utf-8'))
+            try:
+                while isinstance(reply := json.loads(watcher.reply(request_id).text()), list):
+                    for event in reply:
+                        print(json.dumps(event))
+                self.print_json(reply)
+            except KeyboardInterrupt:
+                pass
+
+    def query(self, command: str):
+        """Send a status command and return its decoded reply"""
+
+        return json.loads(self.reply(self.request(FrameKind.COMMAND, command.encode('utf-8'))).text())
+
+    @staticmethod
+    def print_json(value):
+        print(json.dumps(value, indent=4))
 
     def handle(self, command: str, *args):
         """
@@ -89,19 +255,47 @@ class CommandHandler:
             print(f'An error has occurred. {E}')
 
     def send(self, *args):
-        encoded_msg = args[0].encode('ascii')
-        self.sock.sendall(encoded_msg)
-        print(self.sock.recv(4096).decode('ascii'))
+        print(self.reply(self.request(FrameKind.COMMAND, args[0].encode('utf-8'))).text())
+
+    def request(self, kind: FrameKind, payload: bytes) -> int:
+        """Send a request without waiting for its reply. Returns the request ID"""
+
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        self.sock.sendall(encode_frame(self._next_id, kind, payload))
+        return self._next_id
+
+    def reply(self, request_id: int) -> Frame:
+        """Wait for the reply to a request"""
+
+        while request_id not in self._replies:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('Connection closed by the VM')
+            for frame in self._decoder.feed(data):
+                self._replies[frame.request_id] = frame
+        return self._replies.pop(request_id)
+
+
+def connect(address: Address) -> socket.socket:
+    """Connect to a VM's shell socket, TCP or Unix domain"""
+
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    return sock
 
 
 if __name__ == '__main__':
     print(figlet_format('DBSH', font='univers'))
 
+    # python3 -m source.user.shell [host:port | port | unix:<path>]
+    address = parse_address(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ADDRESS
     try:
-        sock = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        sock.connect(('localhost', 8899))
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock = connect(address)
+        print(f'\tConnected to {format_address(address)}')
 
         handler = CommandHandler(sock)
         print('\tWelcome to DBSH - DeBem Shell\n\tType \'help\' to get started')
@@ -115,5 +309,5 @@ if __name__ == '__main__':
                 handler.handle(command, args)
         except KeyboardInterrupt:
             handler.handle('exit')
-    except ConnectionRefusedError:
+    except (ConnectionRefusedError, FileNotFoundError):
         print('Could not connect to the server')
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import perf_counter
+from typing import Callable, Dict
+
+from source.memory.process import ProcessControlBlock
+from source.vm.io_handler import CompletionBuffer, DeviceStats, IIOHandler, IOHandler, IORequest
+
+
+class AsyncIOHandler(IIOHandler):
+    """asyncio-based I/O subsystem
+
+    Every I/O request is a coroutine on a single event loop, running on its own thread, so thousands of requests can be
+    outstanding without a thread each. Requests to non-blocking devices (such as in-memory ones) run on the loop
+    itself; blocking ones, such as reading from the terminal, run on a small, bounded thread pool.
+
+    Each device limits how many of its requests run at once (`stdin` runs one at a time), and the requests of a
+    process always run in the order they were made.
+
+    The loop can host other coroutines as well, such as the shell socket server (see `run_coroutine`). It runs until
+    `close`, which stops it and the thread pool.
+    """
+
+    def __init__(self, owner, workers: int = 2, device_workers: Dict[str, int] = None, executor_workers: int = 4,
+                 batch_size: int = 16, batch_delay: float = 0.005):
+        """
+        Args:
+            owner (VirtualMachine): The VM this handler belongs to
+            workers (int): Number of concurrent requests of each device not listed in `device_workers`
+            device_workers (Dict[str, int]): Number of concurrent requests per device name
+            executor_workers (int): Number of threads that run blocking requests
+            batch_size (int): See `CompletionBuffer`
+            batch_delay (float): See `CompletionBuffer`
+        """
+
+        self.owner = owner
+        self.completions = CompletionBuffer(owner, batch_size, batch_delay)
+        self.workers = workers
+        self.device_workers = {**IOHandler.DEFAULT_WORKERS, **(device_workers or {})}
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run_loop, daemon=True, name='io-asyncio')
+        self._executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='io-blocking')
+
+        # Only touched from the loop's thread
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._tails: Dict[int, asyncio.Task] = {}  # Last request of each process
+        self._stats: Dict[str, DeviceStats] = {}
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+
+    def run_coroutine(self, coroutine):
+        """Schedule `coroutine` on the I/O loop from any thread
+
+        Returns:
+            concurrent.futures.Future: The coroutine's result
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def queue_operation(self, proc: ProcessControlBlock, request: Callable, device='stdout'):
+        name = getattr(device, 'name', device)
+        iorequest = IORequest(proc, request, name, perf_counter(), getattr(device, 'blocking', True))
+        self.loop.call_soon_threadsafe(self._submit, iorequest)
+
+    def _submit(self, iorequest: IORequest):
+        stats = self._stats.setdefault(iorequest.device, DeviceStats())
+        stats.queued()
+
+        pid = iorequest.process.pid
+        task = self.loop.create_task(self._service(iorequest, stats, self._tails.get(pid)))
+        self._tails[pid] = task
+        task.add_done_callback(lambda t: self._tails.pop(pid) if self._tails.get(pid) is t else None)
+
+    async def _service(self, iorequest: IORequest, stats: DeviceStats, previous: asyncio.Task = None):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        device = iorequest.device
+        if (semaphore := self._semaphores.get(device)) is None:
+            semaphore = self._semaphores[device] = asyncio.Semaphore(self.device_workers.get(device, self.workers))
+
+        async with semaphore:
+            start = perf_counter()
+            # `execute` catches what the request raises, see `IORequest.execute`
+            if iorequest.blocking:
+                await self.loop.run_in_executor(self._executor, iorequest.execute)
+            else:
+                iorequest.execute()
+            end = perf_counter()
+
+        stats.serviced(start - iorequest.queued_at, end - start)
+        self.complete(iorequest)
+
+    def stats(self):
+        return {name: stats.as_dict() for name, stats in list(self._stats.items())}
+
+    def close(self, timeout: float = 5):
+        if not self._thread.is_alive():
+            return
+        try:
+            self.run_coroutine(self._finish()).result(timeout)
+            finished = True
+        except Exception as E:
+            logging.error(f'Could not finish the queued I/O requests: {E!r}')
+            finished = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self.loop.close()
+        # Unless a request is stuck, such as a read from the terminal, which lets its thread go once it returns
+        self._executor.shutdown(wait=finished, cancel_futures=True)
+        self.completions.close(timeout)
+
+    async def _finish(self):
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()))
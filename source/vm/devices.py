@@ -0,0 +1,294 @@
+"""I/O devices used by the `TRAP` system calls
+
+Input devices feed the values read by `TRAP` IN (R8 = 1) and output devices receive the values written by `TRAP` OUT
+(R8 = 2). A device can be attached to the whole VM or to a single process (see `VirtualMachine.load_from_file`).
+
+Block devices are read and written many words at a time by `TRAP` block read and write (R8 = 3 and 4). They are
+declared in the VM configuration (`VirtualMachine(block_devices=...)`) and referred to by number.
+
+Devices are used by the I/O workers, possibly from several threads at once, so every device is thread-safe.
+"""
+
+from abc import ABC, abstractmethod
+from array import array
+from collections import defaultdict
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, List, TextIO, Tuple, Union
+import mmap
+import os
+import sys
+
+
+class IInputDevice(ABC):
+    name: str
+    blocking: bool = True  # Whether `read()` may block, e.g. waiting on a terminal
+
+    @abstractmethod
+    def read(self, pid: int) -> int: ...
+
+    def close(self): ...
+
+
+class IOutputDevice(ABC):
+    name: str
+    blocking: bool = True
+
+    @abstractmethod
+    def write(self, pid: int, value: int): ...
+
+    def flush(self): ...
+
+    def close(self): ...
+
+
+class IBlockDevice(ABC):
+    name: str
+    blocking: bool = True
+
+    @abstractmethod
+    def read_block(self, offset: int, count: int) -> List[int]: ...
+
+    @abstractmethod
+    def write_block(self, offset: int, values: List[int]): ...
+
+    def flush(self): ...
+
+
+class ConsoleInput(IInputDevice):
+    """Reads each value from the terminal"""
+
+    name = 'stdin'
+
+    def read(self, pid):
+        # In a real system, this would call the keyboard driver
+        return int(input(f'PROCESS {pid} INPUT: '))
+
+
+class ListInput(IInputDevice):
+    """Reads values from an in-memory sequence
+
+    Raises `EOFError` once every value has been read.
+    """
+
+    name = 'memory-in'
+    blocking = False
+
+    def __init__(self, values: Iterable[int]):
+        self._values = iter(values)
+        self._lock = Lock()
+
+    def read(self, pid):
+        with self._lock:
+            try:
+                return int(next(self._values))
+            except StopIteration:
+                raise EOFError('No more input values')
+
+
+class StreamInput(IInputDevice):
+    """Reads whitespace-separated values from a text stream
+
+    Raises `EOFError` once the stream has ended.
+    """
+
+    name = 'stream-in'
+
+    def __init__(self, stream: TextIO, owned: bool = False):
+        """
+        Args:
+            owned (bool): Whether `close` closes the stream
+        """
+
+        self._stream = stream
+        self._owned = owned
+        self._tokens: List[str] = []
+        self._lock = Lock()
+
+    def read(self, pid):
+        with self._lock:
+            while not self._tokens:
+                line = self._stream.readline()
+                if not line:
+                    raise EOFError('No more input values')
+                self._tokens = line.split()[::-1]
+            return int(self._tokens.pop())
+
+    def close(self):
+        if self._owned:
+            self._stream.close()
+
+
+class FileInput(StreamInput):
+    """Reads whitespace-separated values from a file"""
+
+    blocking = False
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        super().__init__(open(path, 'r'), owned=True)
+        self.name = f'file:{path}'
+
+
+class PipeInput(StreamInput):
+    """Reads whitespace-separated values from a pipe, given as a file descriptor or a text stream"""
+
+    name = 'pipe-in'
+
+    def __init__(self, pipe: Union[int, TextIO]):
+        super().__init__(os.fdopen(pipe, 'r') if isinstance(pipe, int) else pipe, owned=isinstance(pipe, int))
+
+
+class ConsoleOutput(IOutputDevice):
+    """Prints each value to the terminal as soon as it is written"""
+
+    name = 'stdout'
+
+    def write(self, pid, value):
+        # In a real system, this would call the graphics card driver
+        print(f'PROCESS {pid} OUTPUT: {value}')
+
+
+class BufferedOutput(IOutputDevice):
+    """Writes values to a text stream in batches
+
+    The buffer is flushed once it holds `max_lines` lines, on the first write after `max_delay` seconds have passed
+    since the oldest buffered line, or when `flush()` is called (the VM flushes its devices when it stops).
+    """
+
+    name = 'buffered-out'
+
+    def __init__(self, stream: TextIO = None, max_lines: int = 1024, max_delay: float = 1.0,
+                 line_format: str = 'PROCESS {pid} OUTPUT: {value}\n', owned: bool = False):
+        """
+        Args:
+            owned (bool): Whether `close` closes the stream
+        """
+
+        self._stream = stream if stream is not None else sys.stdout
+        self._owned = owned
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.line_format = line_format
+        self._buffer: List[str] = []
+        self._oldest = 0.0
+        self._lock = Lock()
+
+    def write(self, pid, value):
+        with self._lock:
+            if not self._buffer:
+                self._oldest = monotonic()
+            self._buffer.append(self.line_format.format(pid=pid, value=value))
+            if len(self._buffer) >= self.max_lines or monotonic() - self._oldest >= self.max_delay:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._stream.write(''.join(self._buffer))
+            self._buffer.clear()
+        self._stream.flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._owned:
+                self._stream.close()
+
+
+class FileOutput(BufferedOutput):
+    """Writes values to a file in batches (see `BufferedOutput`)"""
+
+    blocking = False
+
+    def __init__(self, path: Union[str, os.PathLike], **kwargs):
+        super().__init__(open(path, 'w'), owned=True, **kwargs)
+        self.name = f'file:{path}'
+
+
+class MemoryOutput(IOutputDevice):
+    """Collects every written value in memory"""
+
+    name = 'memory-out'
+    blocking = False
+
+    def __init__(self):
+        self.values: List[Tuple[int, int]] = []  # (PID, value), in the order they were written
+        self._lock = Lock()
+
+    def write(self, pid, value):
+        with self._lock:
+            self.values.append((pid, value))
+
+    def by_process(self) -> Dict[int, List[int]]:
+        with self._lock:
+            values = defaultdict(list)
+            for pid, value in self.values:
+                values[pid].append(value)
+            return dict(values)
+
+
+class MappedBlockDevice(IBlockDevice):
+    """A file of 64-bit signed words, memory-mapped
+
+    Blocks are copied with a single slice of the mapping, without a system call per word.
+    """
+
+    WORD_SIZE = 8
+
+    def __init__(self, path: Union[str, os.PathLike], words: int = None):
+        """
+        Args:
+            path (PathLike): Backing file. Created if it doesn't exist, which takes `words`
+            words (int): Size of the device, in words. The file is grown to fit it. Defaults to the file's size
+
+        Raises:
+            ValueError: The file is empty and `words` isn't given, or its size isn't a whole number of words
+        """
+
+        self.name = f'block:{path}'
+        self._file = open(path, 'a+b')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if words is not None and size < words * self.WORD_SIZE:
+                size = words * self.WORD_SIZE
+                self._file.truncate(size)
+            if not size:
+                raise ValueError(f'{path} is empty, the size of the block device (in words) is needed to create it')
+            if size % self.WORD_SIZE:
+                raise ValueError(f'{path} is {size} bytes long, which is not a whole number of '
+                                 f'{self.WORD_SIZE}-byte words')
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+        except BaseException:
+            self._file.close()
+            raise
+        self._words = memoryview(self._mmap).cast('q')
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._words)
+
+    def _check(self, offset, count):
+        if offset < 0 or count < 0 or offset + count > len(self._words):
+            raise IndexError(f'Block [{offset}, {offset + count}) is out of the bounds of {self.name} '
+                             f'({len(self._words)} words)')
+
+    def read_block(self, offset, count):
+        self._check(offset, count)
+        with self._lock:  # Never half of a block that's being written
+            return self._words[offset:offset + count].tolist()
+
+    def write_block(self, offset, values):
+        self._check(offset, len(values))
+        with self._lock:
+            self._words[offset:offset + len(values)] = array('q', values)
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._words.release()
+        self._mmap.close()
+        self._file.close()
@@ -0,0 +1,323 @@
+"""Multi-VM dispatcher
+
+A VM runs every process on a single CPU thread, so it uses a single core. The `Dispatcher` starts a VM per worker
+process, each with its own shell socket, and spreads programs and jobs over them: every request goes to the least
+loaded worker, by run queue length (plus the blocked processes, the programs waiting for admission and the requests
+sent since its load was last polled), then by free frames, taking turns when they're tied. It speaks the shell
+protocol too (see `serve`), so clients can use it as a single, bigger VM, except that they can't `subscribe` to its
+events: they subscribe to each worker instead (see `Worker.address`).
+
+Processes are named `<worker>:<pid>` by the dispatcher, since PIDs are only unique within a worker.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from source.user.client import AsyncConnection
+from source.vm.protocol import DEFAULT_ADDRESS, Address, decode_upload_command, parse_address
+
+
+def _worker_file(path: Union[str, Path], index: int) -> Path:
+    # memory.trace -> memory-<index>.trace, so the workers don't overwrite each other's files
+    path = Path(path)
+    return path.with_name(f'{path.stem}-{index}{path.suffix}')
+
+
+def _worker_main(conn, vm_options: Dict[str, Any], address: Address):
+    # Entry point of a worker process: a VM that keeps running until it's told to shut down
+    from source.vm.virtual_machine import VirtualMachine
+
+    vm = VirtualMachine(**{'mem_size': 4096, **vm_options, 'keep_alive': True, 'create_shell_sock': True,
+                           'shell_endpoint': address})
+    conn.send(vm.shell_address)
+    conn.close()
+    vm.start()
+    vm.join()
+
+
+class Worker:
+    """A VM worker process and the dispatcher's connection to it"""
+
+    def __init__(self, index: int, process: multiprocessing.Process, address: Address):
+        self.index = index
+        self.process = process
+        self.address = address
+        self.connection: Optional[AsyncConnection] = None
+        self.stats: Dict[str, Any] = {}  # Last polled `stats`
+        self.sent = 0  # Programs sent since `stats` was last polled
+        self.outstanding_jobs = 0
+
+    @property
+    def load(self) -> Tuple[int, int]:
+        """Sort key, the least loaded worker comes first"""
+
+        stats = self.stats
+        queued = (stats.get('run_queue', 0) + len(stats.get('blocked', ()))
+                  + stats.get('admission', {}).get('pending', 0))
+        return queued + self.sent + self.outstanding_jobs, -stats.get('free_frames', 0)
+
+
+class Dispatcher:
+    """Shards programs and jobs over VMs in local worker processes"""
+
+    def __init__(self, workers: int = None, vm_options: Dict[str, Any] = None, poll_interval: float = 0.1,
+                 socket_dir: Union[str, Path] = None):
+        """
+        Args:
+            workers (int): Number of VM worker processes. Defaults to the number of CPUs
+            vm_options (Dict[str, Any]): Keyword arguments of every worker's `VirtualMachine`
+            poll_interval (float): Seconds between polls of the workers' load
+            socket_dir (Union[str, Path]): Directory for the workers' shell sockets, `vm-<index>.sock`, which are Unix
+                domain sockets then. By default the workers listen on free TCP ports of localhost
+        """
+
+        self.worker_count = workers or os.cpu_count() or 1
+        self.vm_options = vm_options or {}
+        self.poll_interval = poll_interval
+        self.socket_dir = socket_dir
+        self.workers: List[Worker] = []
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='dispatcher')
+        self._poller: Optional[asyncio.Task] = None
+        self._server = None
+        self._turn = 0  # Which worker goes first among equally loaded ones
+
+    def start(self, timeout: float = 30) -> 'Dispatcher':
+        """Start the workers and connect to them. Returns once every worker is ready"""
+
+        context = multiprocessing.get_context('spawn')  # Forking a process with threads running isn't safe
+        pipes = []
+        for index in range(self.worker_count):
+            receiver, sender = context.Pipe(duplex=False)
+            address = str(Path(self.socket_dir, f'vm-{index}.sock')) if self.socket_dir else ('localhost', 0)
+            options = {**self.vm_options,
+                       'trace_file': _worker_file(self.vm_options.get('trace_file', 'memory.trace'), index)}
+            process = context.Process(target=_worker_main, args=(sender, options, address), daemon=True,
+                                      name=f'vm-worker-{index}')
+            process.start()
+            sender.close()
+            pipes.append((index, process, receiver))
+        for index, process, receiver in pipes:
+            if not receiver.poll(timeout) or (address := receiver.recv()) is None:
+                self.close()
+                raise RuntimeError(f'VM worker {index} did not start')
+            self.workers.append(Worker(index, process, parse_address(address)))
+
+        self._thread.start()
+        self._call(self._connect(), timeout)
+        return self
+
+    async def _connect(self):
+        for worker in self.workers:
+            worker.connection = await AsyncConnection.connect(worker.address)
+        await self._poll()
+        self._poller = asyncio.ensure_future(self._poll_forever())
+
+    async def _poll_forever(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._poll()
+            except Exception as E:
+                logging.error(f'Could not poll the VM workers: {E}')
+
+    async def _poll(self):
+        stats = await asyncio.gather(*(worker.connection.command('stats') for worker in self.workers))
+        for worker, worker_stats in zip(self.workers, stats):
+            worker.stats = json.loads(worker_stats)
+            worker.sent = 0
+
+    def _pick(self) -> Worker:
+        self._turn = (self._turn + 1) % len(self.workers)
+        worker = min(self.workers, key=lambda w: (w.load, (w.index - self._turn) % len(self.workers)))
+        worker.sent += 1
+        return worker
+
+    def _call(self, coroutine, timeout: float = None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    # Python API
+
+    def submit(self, program: Union[Path, str], inputs: Iterable[int] = (), memory: Iterable[Tuple[int, int]] = (),
+               name: str = 'job', priority: int = 0) -> Future:
+        """Run a program as a job on the least loaded worker. See `VirtualMachine.submit`
+
+        Returns:
+            Future: Completes with the job's result, as a dictionary, with the `worker` that ran it
+        """
+
+        if isinstance(program, Path):
+            name, program = program.name, program.read_text()
+        request = {'name': name, 'source': program, 'inputs': list(inputs), 'memory': [list(r) for r in memory],
+                   'priority': priority}
+        return asyncio.run_coroutine_threadsafe(self._run_job(json.dumps(request)), self.loop)
+
+    def upload(self, name: str, source: str, priority: int = 0) -> str:
+        """Load a program on the least loaded worker. Returns its `<worker>:<pid>`"""
+
+        return self._call(self._upload(name, source, priority)).rpartition(' ')[2]
+
+    def stats(self) -> Dict[str, Any]:
+        """Metrics of every worker, and their totals"""
+
+        return self._call(self._stats())
+
+    # Shell protocol, see `ShellServer`
+
+    def handle_shell_command(self, message: str) -> Union[str, Future]:
+        command, _, args = message.partition(' ')
+        handler = {
+            'load': self._load,
+            'upload': lambda args: self._upload(*decode_upload_command(args)),
+            'job': self._job,
+            'ps': self._ps,
+            'stats': lambda _: self._stats(json_reply=True),
+            'mem': lambda _: self._mem(),
+            'proc': self._proc,
+            'profile': self._profile,
+            'trace': self._trace,
+            'shutdown': lambda _: self._shutdown(),
+        }.get(command)
+        if command == 'subscribe':
+            return json.dumps({'error': 'The dispatcher has no events, subscribe to its workers instead'})
+        if handler is None:
+            return f'Unknown command: {command}'
+        return asyncio.run_coroutine_threadsafe(handler(args), self.loop)
+
+    def handle_shell_upload(self, name: str, source: str, priority: int = 0) -> Future:
+        return asyncio.run_coroutine_threadsafe(self._upload(name, source, priority), self.loop)
+
+    def serve(self, address: Union[Address, int] = DEFAULT_ADDRESS) -> 'Dispatcher':
+        """Serve the shell protocol, on the dispatcher's event loop. See `parse_address` for the `address`"""
+
+        from source.vm.shell_server import ShellServer
+
+        self._server = ShellServer(self, parse_address(address), loop=self.loop).start()
+        return self
+
+    @property
+    def address(self):
+        return self._server.address if self._server is not None else None
+
+    # Requests, on the dispatcher's loop
+
+    @staticmethod
+    def _rename(worker: Worker, reply: str) -> str:
+        # New process PID: <pid> -> New process PID: <worker>:<pid>
+        prefix, _, pid = reply.rpartition(' ')
+        return f'{prefix} {worker.index}:{pid}' if pid.lstrip('-').isdigit() and pid != '-1' else reply
+
+    async def _load(self, args: str) -> str:
+        worker = self._pick()
+        return self._rename(worker, await worker.connection.command(f'load {args}'))
+
+    async def _upload(self, name: str, source: str, priority: int = 0) -> str:
+        worker = self._pick()
+        return self._rename(worker, await worker.connection.upload(name, source.encode('utf-8'), priority))
+
+    async def _run_job(self, request: str) -> Dict[str, Any]:
+        worker = self._pick()
+        worker.outstanding_jobs += 1
+        try:
+            reply = json.loads(await worker.connection.command(f'job {request}'))
+        finally:
+            worker.outstanding_jobs -= 1
+        return {**reply, 'worker': worker.index}
+
+    async def _job(self, request: str) -> str:
+        return json.dumps(await self._run_job(request), separators=(',', ':'))
+
+    async def _gather(self, command: str) -> List[Any]:
+        replies = await asyncio.gather(*(worker.connection.command(command) for worker in self.workers))
+        return [json.loads(reply) for reply in replies]
+
+    async def _ps(self, _) -> str:
+        processes = []
+        for worker, worker_processes in zip(self.workers, await self._gather('ps')):
+            processes.extend({**process, 'pid': f'{worker.index}:{process["pid"]}', 'worker': worker.index}
+                             for process in worker_processes)
+        return json.dumps(processes, separators=(',', ':'))
+
+    async def _mem(self) -> str:
+        return json.dumps(await self._gather('mem'), separators=(',', ':'))
+
+    async def _proc(self, args: str) -> str:
+        worker, _, pid = args.strip().partition(':')
+        try:
+            return await self.workers[int(worker)].connection.command(f'proc {pid}')
+        except (ValueError, IndexError):
+            return json.dumps({'error': f'Invalid process: {args.strip()} (expected <worker>:<pid>)'})
+
+    async def _profile(self, args: str) -> str:
+        return json.dumps(await self._gather(f'profile {args}'.strip()), separators=(',', ':'))
+
+    async def _trace(self, args: str) -> str:
+        # Each worker writes a file of its own
+        commands = [f'trace {_worker_file(args.strip(), worker.index)}' if args.strip() else 'trace'
+                    for worker in self.workers]
+        replies = await asyncio.gather(*(worker.connection.command(command)
+                                         for worker, command in zip(self.workers, commands)))
+        return json.dumps([json.loads(reply) for reply in replies], separators=(',', ':'))
+
+    async def _stats(self, json_reply: bool = False) -> Union[str, Dict[str, Any]]:
+        stats = await self._gather('stats')
+        total = {key: sum(worker_stats[key] for worker_stats in stats)
+                 for key in ('instructions', 'instructions_per_second', 'context_switches',
+                             'context_switches_per_second', 'processes', 'run_queue', 'free_frames',
+                             'io_queue_depth')}
+        result = {'workers': stats, 'total': total}
+        return json.dumps(result, separators=(',', ':')) if json_reply else result
+
+    async def _shutdown(self) -> str:
+        if self._poller is not None:
+            self._poller.cancel()
+        await asyncio.gather(*(worker.connection.command('shutdown') for worker in self.workers),
+                             return_exceptions=True)
+        return 'Halting...'
+
+    # Shutdown
+
+    def wait(self):
+        """Wait for every worker to exit, such as after a `shutdown` shell command"""
+
+        for worker in self.workers:
+            worker.process.join()
+
+    def close(self, timeout: float = 10):
+        """Shut every worker down and wait for them"""
+
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._thread.is_alive():
+            try:
+                self._call(self._close(), timeout)
+            except Exception as E:
+                logging.error(f'Could not shut the VM workers down: {E}')
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    async def _close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        connected = [worker for worker in self.workers if worker.connection is not None]
+        await asyncio.gather(*(worker.connection.command('shutdown') for worker in connected),
+                             return_exceptions=True)
+        await asyncio.gather(*(worker.connection.close() for worker in connected), return_exceptions=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,209 @@
+"""Push-based event stream of a running VM
+
+The process manager, the CPU and the `TRAP` system calls publish what happens to processes on the VM's `EventBus`, and
+every subscriber gets the events it's interested in, in order. Publishing must never slow the CPU down:
+
+* With no subscribers, publishers skip building the event altogether (they check `EventBus.active` first).
+* Each subscriber has a bounded queue. A subscriber that lets it fill up is dropped, rather than making the CPU wait
+  or losing events silently.
+
+Event kinds:
+
+* `created`: A process has been created (`name`)
+* `scheduled`: A process has entered the CPU
+* `blocked`: A process has left the CPU to wait for I/O
+* `unblocked`: A process's I/O has finished and it's ready to run again
+* `ended`: A process has ended (`name`, `reason`, `instructions`)
+* `output`: A process has written a value with `TRAP` (`value`)
+* `out_of_memory`: A program or a process's growth didn't fit in the free memory (`name`, `error`)
+* `invalid_address`: A process has accessed an address outside of its memory, the CPU stops (`error`)
+* `fault`: Any other interruption that stops the CPU (`interrupt`, `error`)
+
+PIDs are -1 for events that don't belong to a process (yet).
+"""
+
+import json
+from collections import deque
+from threading import Lock
+from threading import Event as Flag
+from time import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import logging
+
+EVENT_KINDS = ('created', 'scheduled', 'blocked', 'unblocked', 'ended', 'output', 'out_of_memory', 'invalid_address',
+               'fault')
+
+
+class Event(NamedTuple):
+    time: float  # Seconds since the epoch
+    kind: str
+    pid: int
+    data: Dict[str, Any]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'time': self.time, 'event': self.kind, 'pid': self.pid, **self.data}
+
+
+def encode_events(events: Iterable[Event]) -> str:
+    """JSON list of events, as streamed by the `subscribe` shell command"""
+
+    return json.dumps([event.as_dict() for event in events], separators=(',', ':'))
+
+
+class Subscription:
+    """A subscriber's queue of events
+
+    Events are taken with `drain` (non-blocking) or `get` (blocking). Instead of polling, a consumer on an event loop
+    sets `on_ready`, which is called, from the publisher's thread, whenever the queue stops being empty and when the
+    subscription ends.
+    """
+
+    def __init__(self, bus: 'EventBus', kinds: Optional[frozenset], max_queue: int):
+        self.bus = bus
+        self.kinds = kinds  # None for every kind
+        self.max_queue = max_queue
+        self.dropped = False  # Whether the bus gave up on this subscriber because its queue was full
+        self.closed = False
+        self.reason = ''  # Why the subscription has ended
+        self._events: Deque[Event] = deque()
+        self._lock = Lock()
+        self._ready = Flag()
+        self._on_ready: Optional[Callable[[], None]] = None
+
+    @property
+    def on_ready(self) -> Optional[Callable[[], None]]:
+        return self._on_ready
+
+    @on_ready.setter
+    def on_ready(self, callback: Optional[Callable[[], None]]):
+        with self._lock:
+            self._on_ready = callback
+            pending = bool(self._events) or self.closed
+        if pending and callback is not None:
+            callback()
+
+    def _put(self, event: Event) -> bool:
+        # Called by the bus. False if the queue is full
+        with self._lock:
+            if self.closed:
+                return True
+            if len(self._events) >= self.max_queue:
+                return False
+            self._events.append(event)
+            if len(self._events) > 1:  # The consumer has already been told
+                return True
+            self._ready.set()
+            callback = self._on_ready
+        if callback is not None:
+            callback()
+        return True
+
+    def drain(self) -> List[Event]:
+        """Take every queued event"""
+
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+            if not self.closed:
+                self._ready.clear()
+        return events
+
+    def get(self, timeout: float = None) -> List[Event]:
+        """Wait for events and take them. Empty on timeout, or once the subscription has ended"""
+
+        self._ready.wait(timeout)
+        return self.drain()
+
+    def _end(self, reason: str, dropped: bool = False):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.dropped = dropped
+            self.reason = reason
+            self._ready.set()
+            callback = self._on_ready
+        if callback is not None:
+            try:
+                callback()
+            except Exception:  # The consumer is already gone
+                pass
+
+    def close(self):
+        """Unsubscribe"""
+
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """Fans the VM's events out to its subscribers"""
+
+    def __init__(self, max_queue: int = 4096):
+        """
+        Args:
+            max_queue (int): Default number of events a subscriber may have queued before it's dropped
+        """
+
+        self.max_queue = max_queue
+        self.active = False  # Whether there are any subscribers. Publishers check it before building an event
+        self.dropped = 0  # Subscribers dropped for being too slow
+        self._subscribers: Tuple[Subscription, ...] = ()  # Replaced, never changed, so publishing takes no lock
+        self._lock = Lock()
+
+    def subscribe(self, kinds: Iterable[str] = None, max_queue: int = None) -> Subscription:
+        """
+        Args:
+            kinds (Iterable[str]): Event kinds to subscribe to (see `EVENT_KINDS`). Every kind if empty or None
+            max_queue (int): Events the subscriber may have queued before it's dropped. Defaults to the bus's
+
+        Raises:
+            ValueError: Unknown event kind
+        """
+
+        kinds = frozenset(kinds or ())
+        if unknown := kinds.difference(EVENT_KINDS):
+            raise ValueError(f'Unknown event kind {", ".join(sorted(unknown))}. Choose from: {", ".join(EVENT_KINDS)}')
+        subscription = Subscription(self, kinds or None, max_queue or self.max_queue)
+        with self._lock:
+            self._subscribers += (subscription,)
+            self.active = True
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription, reason: str = 'Unsubscribed', dropped: bool = False):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscription)
+            self.active = bool(self._subscribers)
+        subscription._end(reason, dropped)
+
+    def publish(self, kind: str, pid: int = -1, **data):
+        """Queue an event for every subscriber to its kind"""
+
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        event = Event(time(), kind, pid, data)
+        for subscription in subscribers:
+            if subscription.kinds is not None and kind not in subscription.kinds:
+                continue
+            try:
+                if subscription._put(event):
+                    continue
+                reason = f'Dropped: more than {subscription.max_queue} events queued'
+            except Exception as E:  # Its `on_ready` failed, the consumer is gone
+                reason = f'Dropped: {E!r}'
+            logging.warning(f'Event subscriber {reason.lower()}')
+            self.dropped += 1
+            self.unsubscribe(subscription, reason, dropped=True)
+
+    def close(self, reason: str = 'The VM has shut down'):
+        """End every subscription"""
+
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, ()
+            self.active = False
+        for subscription in subscribers:
+            subscription._end(reason)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
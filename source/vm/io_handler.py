@@ -1,37 +1,304 @@
+import logging
+from abc import ABC, abstractmethod
 from source.memory.process import ProcessControlBlock
-from threading import Thread
+from threading import Condition, Lock, Thread
+from time import monotonic, perf_counter
 from queue import Queue
-from typing import Callable, NamedTuple
+from typing import Any, Callable, Dict, List, NamedTuple
 from source.command.command import EIOOperationComplete
 
 
 class IORequest(NamedTuple):
     process: ProcessControlBlock
     request: Callable
+    device: str = 'stdout'  # Device name
+    queued_at: float = 0.0
+    blocking: bool = True  # Whether the device may block (see `source.vm.devices`)
 
     def execute(self):
         try:
             return self.request()
-        except:
-            pass
+        except Exception as E:
+            # Such as input running out. The process is ended once it's unblocked, rather than resumed as if the
+            # request had succeeded (see `ProcessManager.unblock_process`)
+            logging.error(f'I/O request of process {self.process.name} on {self.device} failed: {E!r}')
+            self.process.io_error = str(E) or repr(E)
 
 
-class IOResponse(NamedTuple):
-    process_id: int
+class CompletionBuffer:
+    """Finished I/O requests waiting to be delivered to the CPU
 
+    Instead of an interruption per request, the PIDs of finished requests are collected here and the CPU unblocks them
+    all at once. The CPU drains the buffer on every scheduling decision, so a completion waits at most one time slice.
+    Only when `batch_size` completions are pending, or the oldest one has waited `max_delay` seconds, is a single
+    `EIOOperationComplete` interruption queued to get the CPU's attention sooner. The delay is kept by a timer thread,
+    so it holds even when no other completion follows. The timer runs until `close`.
+    """
 
-class IOHandler(Thread):
-    def __init__(self, owner):
-        Thread.__init__(self, daemon=True)
+    def __init__(self, owner, batch_size: int = 16, max_delay: float = 0.005):
+        """
+        Args:
+            owner (VirtualMachine): The VM whose CPU is notified
+            batch_size (int): Pending completions that trigger an interruption. 1 interrupts on every completion
+            max_delay (float): Seconds after which pending completions trigger an interruption
+        """
 
-        self.queue: Queue[IORequest] = Queue()
         self.owner = owner
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max_delay
+        self._lock = Lock()
+        self._due = Condition(self._lock)  # Notified when the oldest pending completion changes
+        self._timer = None
+        self._closed = False
+        self._pids: List[int] = []
+        self._oldest = 0.0
+        self._interrupt_pending = False
+        # Counters
+        self.completed = 0
+        self.drains = 0
+        self.interrupts = 0
 
-    def run(self):
+    def add(self, pid: int):
+        with self._lock:
+            if not self._pids:
+                self._oldest = monotonic()
+                if self._timer is None and not self._closed:
+                    self._timer = Thread(target=self._time_out, daemon=True, name='io-completions')
+                    self._timer.start()
+                self._due.notify()
+            self._pids.append(pid)
+            self.completed += 1
+            if self._interrupt_pending or (len(self._pids) < self.batch_size
+                                           and monotonic() - self._oldest < self.max_delay):
+                return
+            self._interrupt_pending = True
+            self.interrupts += 1
+        self.owner.cpu.queue_interrupt(EIOOperationComplete())
+
+    def _time_out(self):
+        # Interrupts the CPU once the oldest pending completion has waited `max_delay`, unless it's been drained first
         while True:
-            iorequest = self.queue.get()
+            with self._lock:
+                while True:
+                    if self._closed:
+                        return
+                    if not self._pids or self._interrupt_pending:
+                        self._due.wait()
+                    elif (remaining := self._oldest + self.max_delay - monotonic()) > 0:
+                        self._due.wait(remaining)
+                    else:
+                        break
+                self._interrupt_pending = True
+                self.interrupts += 1
+            self.owner.cpu.queue_interrupt(EIOOperationComplete())
+
+    def close(self, timeout: float = 5):
+        """Stop the timer thread. Completions are still collected, but only delivered when the CPU drains them"""
+
+        with self._lock:
+            self._closed = True
+            self._due.notify()
+            timer = self._timer
+        if timer is not None:
+            timer.join(timeout)
+
+    def drain(self) -> List[int]:
+        """Take every pending PID"""
+
+        if not self._pids:  # Cheap check, a completion that is missed now is picked up on the next drain
+            return []
+        with self._lock:
+            pids, self._pids = self._pids, []
+            self._interrupt_pending = False
+            self.drains += 1
+            return pids
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'pending': len(self._pids),
+                'completed': self.completed,
+                'drains': self.drains,
+                'interrupts': self.interrupts,
+                'avg_batch_size': (self.completed - len(self._pids)) / (self.drains or 1),
+            }
+
+
+class IIOHandler(ABC):
+    """I/O subsystem interface
+
+    Services the I/O requests made by user programs through `TRAP` and hands the finished ones to its
+    `CompletionBuffer` (`completions`), which the CPU drains.
+    """
+
+    completions: CompletionBuffer
+
+    @abstractmethod
+    def start(self): ...
+
+    @abstractmethod
+    def queue_operation(self, proc: ProcessControlBlock, request: Callable, device='stdout'):
+        """Queue an I/O request of `proc`
+
+        Args:
+            proc (ProcessControlBlock): The process making the request
+            request (Callable): The operation to execute
+            device (Union[str, IInputDevice, IOutputDevice]): The device, or device name, that services the request
+        """
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Dict[str, float]]: ...
+
+    def close(self, timeout: float = 5):
+        """Finish the queued requests and stop the I/O threads. Requests queued afterwards are never serviced
+
+        Args:
+            timeout (float): Seconds to wait for each thread, such as one blocked reading from the terminal
+        """
+
+    def complete(self, iorequest: IORequest):
+        # The completion buffer is thread-safe, so this is the hand-off point from any I/O thread
+        iorequest.process.woken_at = perf_counter()
+        self.completions.add(iorequest.process.pid)
+
+
+class DeviceStats:
+    """Queue depth and timing counters of a single device"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.depth = 0  # Requests queued or being serviced
+        self.max_depth = 0
+        self.completed = 0
+        self.total_wait_time = 0.0  # Time spent in the queue
+        self.total_service_time = 0.0  # Time spent executing
+        self.max_service_time = 0.0
+
+    def queued(self):
+        with self._lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def serviced(self, wait_time, service_time):
+        with self._lock:
+            self.depth -= 1
+            self.completed += 1
+            self.total_wait_time += wait_time
+            self.total_service_time += service_time
+            self.max_service_time = max(self.max_service_time, service_time)
+
+    def as_dict(self):
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'completed': self.completed,
+                'avg_wait_time': self.total_wait_time / completed,
+                'avg_service_time': self.total_service_time / completed,
+                'max_service_time': self.max_service_time,
+            }
+
+
+class IODevice:
+    """Request queues and worker threads of a single device
+
+    Each worker has its own queue (lane) and requests are routed to a lane by PID, so that the requests of a process
+    are always executed in the order they were made while different processes are serviced in parallel. A worker stops
+    once it takes None from its lane.
+    """
+
+    def __init__(self, handler: 'IOHandler', name: str, workers: int):
+        self.handler = handler
+        self.name = name
+        self.stats = DeviceStats()
+        self.lanes: List[Queue] = [Queue() for _ in range(max(1, workers))]
+        self.threads = [Thread(target=self._work, args=(lane,), daemon=True, name=f'io-{name}-{i}')
+                        for i, lane in enumerate(self.lanes)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, iorequest: IORequest):
+        self.stats.queued()
+        self.lanes[iorequest.process.pid % len(self.lanes)].put_nowait(iorequest)
+
+    def stop(self):
+        """Tell every worker to stop once it has executed the requests already in its lane"""
+
+        for lane in self.lanes:
+            lane.put_nowait(None)
+
+    def _work(self, lane: Queue):
+        while (iorequest := lane.get()) is not None:
+            start = perf_counter()
             iorequest.execute()
-            self.owner.cpu.queue_interrupt(EIOOperationComplete(IOResponse(iorequest.process.pid)))
+            end = perf_counter()
+            self.stats.serviced(start - iorequest.queued_at, end - start)
+            self.handler.complete(iorequest)
+
+
+class IOHandler(IIOHandler):
+    """Thread pool I/O subsystem
+
+    Every device (`stdin`, `stdout`, ...) has its own queues and workers, so a process waiting for input doesn't hold
+    back the output of the others. Devices are created on their first request.
+    """
+
+    # Reading from the terminal is inherently sequential
+    DEFAULT_WORKERS = {'stdin': 1}
+
+    def __init__(self, owner, workers: int = 2, device_workers: Dict[str, int] = None, batch_size: int = 16,
+                 batch_delay: float = 0.005):
+        """
+        Args:
+            owner (VirtualMachine): The VM this handler belongs to
+            workers (int): Number of workers of each device not listed in `device_workers`
+            device_workers (Dict[str, int]): Number of workers per device name
+            batch_size (int): See `CompletionBuffer`
+            batch_delay (float): See `CompletionBuffer`
+        """
+
+        self.owner = owner
+        self.completions = CompletionBuffer(owner, batch_size, batch_delay)
+        self.workers = workers
+        self.device_workers = {**self.DEFAULT_WORKERS, **(device_workers or {})}
+        self.devices: Dict[str, IODevice] = {}
+        self._lock = Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            self._started = True
+            for device in self.devices.values():
+                device.start()
+
+    def device(self, name: str) -> IODevice:
+        with self._lock:
+            if (device := self.devices.get(name)) is None:
+                device = IODevice(self, name, self.device_workers.get(name, self.workers))
+                self.devices[name] = device
+                if self._started:
+                    device.start()
+            return device
+
+    def queue_operation(self, proc: ProcessControlBlock, request: Callable, device='stdout'):
+        name = getattr(device, 'name', device)
+        self.device(name).put(IORequest(proc, request, name, perf_counter(), getattr(device, 'blocking', True)))
+
+    def stats(self):
+        with self._lock:
+            devices = list(self.devices.values())
+        return {device.name: device.stats.as_dict() for device in devices}
 
-    def queue_operation(self, proc: ProcessControlBlock, request: Callable):
-        self.queue.put_nowait(IORequest(proc, request))
+    def close(self, timeout: float = 5):
+        with self._lock:
+            started, self._started = self._started, False  # Devices created from now on have no workers
+            devices = list(self.devices.values())
+        if started:
+            for device in devices:
+                device.stop()
+            for thread in (thread for device in devices for thread in device.threads):
+                thread.join(timeout)
+        self.completions.close(timeout)
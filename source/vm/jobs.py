@@ -0,0 +1,152 @@
+import json
+from concurrent.futures import Future
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+
+from source.command.command import Command_DATA
+from source.memory.process import ProcessControlBlock
+from source.vm.devices import ListInput, MemoryOutput
+
+
+class JobResult(NamedTuple):
+    """What a job leaves behind once its process has ended"""
+
+    pid: int
+    name: str
+    exit_reason: str  # See `ProcessControlBlock.exit_reason`
+    outputs: List[int]  # Values written with `TRAP`, in order
+    memory: List[List[Optional[int]]]  # Words of each requested range. None for words that don't hold `DATA`, or that
+                                       # are outside the process's memory
+    instructions: int
+    run_time: float
+    io_error: Optional[str] = None  # Why its I/O failed, when `exit_reason` is `io_error`
+
+
+class Job(Future):
+    """Future of a `JobResult`
+
+    Its callbacks run on the CPU's thread, with the process manager's lock held, so they should be quick. Use
+    `asyncio.wrap_future` to await a job from a coroutine.
+    """
+
+    def __init__(self, memory: Sequence[Tuple[int, int]]):
+        super().__init__()
+        self.pid = -1
+        self.memory = [tuple(address_range) for address_range in memory]
+        for address_range in self.memory:
+            if len(address_range) != 2 or not 0 <= address_range[0] <= address_range[1]:
+                raise ValueError(f'Invalid memory range {list(address_range)}, expected [start, stop) with '
+                                 f'0 <= start <= stop')
+        self.inputs: Optional[ListInput] = None
+        self.outputs = MemoryOutput()
+
+
+class JobManager:
+    """Runs programs as jobs: each one gets its own input values and output device, and a `Job` that completes when
+    its process ends
+
+    Combined with `VirtualMachine(keep_alive=True)`, a single VM can serve a continuous stream of jobs.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self._lock = Lock()
+        self._running: Set[Job] = set()
+
+    def submit(self, program: Union[Path, str], inputs: Iterable[int] = (),
+               memory: Iterable[Tuple[int, int]] = (), name: str = 'job', priority: int = 0,
+               instruction_budget: int = None) -> Job:
+        """Load a program and return its job
+
+        Args:
+            program (Union[Path, str]): Program file, or program source
+            inputs (Iterable[int]): Values the program reads with `TRAP`
+            memory (Iterable[Tuple[int, int]]): Ranges of relative addresses, [start, stop), whose words are part
+                of the result. Words outside the process's memory are None
+            name (str): Program name, when `program` is its source
+            priority (int): Scheduling priority, higher runs first
+            instruction_budget (int): Instructions the process may execute. Defaults to the VM's
+
+        Returns:
+            Job: Completes with a `JobResult`, or with the exception that kept the program from being loaded
+
+        Raises:
+            ValueError: Invalid memory range
+        """
+
+        job = Job(memory)
+        job.inputs = ListInput(inputs)
+        with self._lock:
+            self._running.add(job)
+        job.add_done_callback(self._forget)
+        try:
+            image = self.vm.decode(program) if isinstance(program, Path) else self.vm.decode_text(name, program)
+            job.pid = self.vm.process_manager.install_image(image, job.inputs, job.outputs, priority,
+                                                            self.vm.budget(instruction_budget),
+                                                            lambda process: self._finish(job, process))
+        except Exception as E:
+            job.set_exception(E)
+        return job
+
+    def submit_json(self, request: str) -> Future:
+        """Submit a job described in JSON, for the `job` shell command
+
+        `request` has either a `path` (on the VM's machine) or a `source` and a `name`, and optionally `inputs`,
+        `memory` (a list of [start, stop] ranges) and `priority`.
+
+        Returns:
+            Future: Completes with the reply, the job's `JobResult` in JSON
+        """
+
+        reply = Future()
+        try:
+            args = json.loads(request)
+            program = Path(args['path']) if 'path' in args else args['source']
+            job = self.submit(program, args.get('inputs', ()), args.get('memory', ()), args.get('name', 'job'),
+                              args.get('priority', 0))
+        except (ValueError, KeyError, TypeError) as E:
+            reply.set_result(json.dumps({'error': f'Invalid job: {E!r}'}))
+            return reply
+
+        def done(job: Job):
+            try:
+                reply.set_result(json.dumps(job.result()._asdict(), separators=(',', ':')))
+            except Exception as E:
+                reply.set_result(json.dumps({'pid': job.pid, 'error': str(E) or repr(E)}))
+
+        job.add_done_callback(done)
+        return reply
+
+    def abort(self, reason: str = 'The VM has shut down'):
+        """Fail every job that hasn't completed yet"""
+
+        with self._lock:
+            jobs, self._running = self._running, set()
+        for job in jobs:
+            if not job.done():
+                job.set_exception(RuntimeError(reason))
+
+    def __len__(self) -> int:
+        return len(self._running)
+
+    def _forget(self, job: Job):
+        with self._lock:
+            self._running.discard(job)
+
+    def _finish(self, job: Job, process: ProcessControlBlock):
+        # Called by the process manager, while the process's frames are still allocated
+        try:
+            memory = [self._read(process, start, stop) for start, stop in job.memory]
+        except Exception as E:
+            job.set_exception(E)
+            return
+        job.set_result(JobResult(process.pid, process.name, process.exit_reason,
+                                 [value for _, value in job.outputs.values], memory, process.instructions,
+                                 process.run_time, process.io_error))
+
+    def _read(self, process: ProcessControlBlock, start: int, stop: int) -> List[Optional[int]]:
+        access = self.vm.process_manager.access
+        size = len(process.frames) * self.vm.memory.page_size
+        return [command.p if address < size and isinstance(command := access(address, process).command, Command_DATA)
+                else None for address in range(start, stop)]
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from hashlib import sha1
+from os import stat_result
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, Tuple
+
+from source.memory.program import ProgramImage
+
+
+class ProgramCache:
+    """Bounded LRU cache of decoded programs
+
+    Entries are keyed by the file's path and validated against its modification time and size, with a single `stat()`
+    call, before being reused. A file that changed on disk is decoded again. Programs that don't come from a file
+    (see `load_source`) are keyed by a digest of their source instead, so submitting the same program over and over
+    only decodes it once.
+
+    Cached images are shared, so they must never be installed into memory as they are (see
+    `ProcessManager.install_image`, which copies every command).
+    """
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self._entries: 'OrderedDict[str, Tuple[int, int, ProgramImage]]' = OrderedDict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, file: Path, decode: Callable[[Path], ProgramImage]) -> ProgramImage:
+        """Return the decoded program in `file`, calling `decode(file)` if it isn't cached or is stale"""
+
+        key = str(Path(file).resolve())
+        stat = Path(key).stat()  # Before reading the file, so that a concurrent write is caught by the next stat()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[:2] == self._signature(stat):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        image = decode(file)
+
+        with self._lock:
+            self._store(key, (*self._signature(stat), image))
+        return image
+
+    def load_source(self, name: str, source: str, decode: Callable[[str, str], ProgramImage]) -> ProgramImage:
+        """Return the decoded program `source`, calling `decode(name, source)` if it isn't cached"""
+
+        key = f'{name}\0{sha1(source.encode("utf-8")).hexdigest()}'
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        image = decode(name, source)
+
+        with self._lock:
+            self._store(key, (0, len(source), image))
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _store(self, key: str, entry: Tuple[int, int, ProgramImage]):
+        # Called with the lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def _signature(stat: stat_result) -> Tuple[int, int]:
+        return stat.st_mtime_ns, stat.st_size
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,166 @@
+"""Shell socket protocol
+
+Every message is a frame: a fixed header with the payload length, a request ID and the frame kind, followed by the
+payload. Replies carry the ID of the request they answer, so a client can send any number of requests without waiting
+for the replies and match them up as they arrive.
+
+Frame kinds:
+    COMMAND: A shell command line, such as `load <path> [priority]` or `shutdown`, in UTF-8. The `upload` command
+        carries a program inline: `upload <name> [priority]`, a newline, then the program source
+    UPLOAD: A program in binary form: a `UPLOAD_HEADER` (priority and name length), the name and the program source,
+        as raw bytes. Nothing needs escaping, so this is the cheapest way to submit programs in bulk
+    REPLY: The reply to a request, in UTF-8
+    ERROR: The request could not be understood, in UTF-8
+
+Most requests get a single reply. `subscribe [kind...]` gets a stream of them instead, all with its request ID: each
+one is a JSON list of events (see `source.vm.events`), and the last one is a JSON object, `{"end": <reason>, "dropped":
+<bool>}`, or `{"error": <reason>}` if the subscription could not be made.
+
+The socket is either TCP or, for lower latency between processes on the same machine, a Unix domain socket (see
+`parse_address`).
+"""
+
+import struct
+from enum import IntEnum
+from typing import List, NamedTuple, Tuple, Union
+
+HEADER = struct.Struct('!IIB')  # Payload length, request ID, kind
+UPLOAD_HEADER = struct.Struct('!iH')  # Priority, name length
+MAX_PAYLOAD = 16 * 1024 * 1024
+DEFAULT_ADDRESS = ('localhost', 8899)
+
+Address = Union[Tuple[str, int], str]  # (host, port) of a TCP socket, or the path of a Unix domain socket
+
+
+class FrameKind(IntEnum):
+    COMMAND = 0
+    UPLOAD = 1
+    REPLY = 2
+    ERROR = 3
+
+
+class EProtocolError(Exception):
+    """Malformed frame. The connection can't be trusted to be in sync anymore and should be closed"""
+
+
+class Frame(NamedTuple):
+    request_id: int
+    kind: FrameKind
+    payload: bytes
+
+    def text(self) -> str:
+        return self.payload.decode('utf-8')
+
+
+def parse_address(address: Union[Address, int, List]) -> Address:
+    """Shell socket address from its textual form
+
+    Accepts `host:port`, `:port` or just a port (on localhost), `[host]:port` for IPv6, `unix:<path>` or anything with
+    a `/` for a Unix domain socket, and addresses that are already parsed. Port 0 binds to any free port.
+
+    Raises:
+        ValueError: Not an address
+    """
+
+    if isinstance(address, int):
+        return 'localhost', address
+    if not isinstance(address, str):
+        host, port = address
+        return host, int(port)
+    if address.startswith('unix:'):
+        return address[len('unix:'):]
+    if '/' in address:
+        return address
+    host, _, port = address.rpartition(':')
+    try:
+        return host.strip('[]') or 'localhost', int(port)
+    except ValueError:
+        raise ValueError(f'Invalid shell socket address {address!r}. Expected host:port, a port or unix:<path>')
+
+
+def format_address(address: Address) -> str:
+    """The textual form of an address, as accepted by `parse_address`"""
+
+    if isinstance(address, str):
+        return f'unix:{address}'
+    host, port = address
+    return f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+
+
+def encode_frame(request_id: int, kind: FrameKind, payload: bytes) -> bytes:
+    if len(payload) > MAX_PAYLOAD:
+        raise EProtocolError(f'Payload of {len(payload)} bytes is larger than {MAX_PAYLOAD}')
+    return HEADER.pack(len(payload), request_id, kind) + payload
+
+
+def decode_header(header: bytes) -> Tuple[int, int, FrameKind]:
+    """Payload length, request ID and kind of a frame header"""
+
+    length, request_id, kind = HEADER.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise EProtocolError(f'Payload of {length} bytes is larger than {MAX_PAYLOAD}')
+    try:
+        return length, request_id, FrameKind(kind)
+    except ValueError:
+        raise EProtocolError(f'Unknown frame kind {kind}')
+
+
+def encode_upload(name: str, source: bytes, priority: int = 0) -> bytes:
+    """Payload of an `UPLOAD` frame"""
+
+    name = name.encode('utf-8')
+    return UPLOAD_HEADER.pack(priority, len(name)) + name + source
+
+
+def decode_upload(payload: bytes) -> Tuple[str, bytes, int]:
+    """Name, source and priority of an `UPLOAD` frame's payload"""
+
+    if len(payload) < UPLOAD_HEADER.size:
+        raise EProtocolError('Truncated upload')
+    priority, name_length = UPLOAD_HEADER.unpack_from(payload)
+    start = UPLOAD_HEADER.size
+    return payload[start:start + name_length].decode('utf-8'), payload[start + name_length:], priority
+
+
+def split_priority(text: str) -> Tuple[str, int]:
+    """Name (or path) and priority of a `<name> [priority]` argument, as taken by `load` and `upload`. Priority 0 if
+    it isn't given"""
+
+    text = text.strip()
+    name, _, priority = text.rpartition(' ')
+    try:
+        return name, int(priority)
+    except ValueError:
+        return text, 0
+
+
+def decode_upload_command(args: str) -> Tuple[str, str, int]:
+    """Name, source and priority of the arguments of an `upload` command: `<name> [priority]`, a newline, the source"""
+
+    header, _, source = args.partition('\n')
+    name, priority = split_priority(header)
+    return name, source, priority
+
+
+class FrameDecoder:
+    """Incremental decoder for the byte stream of a (blocking) socket
+
+    Feed it whatever `recv()` returns and it returns every frame that is now complete.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Frame]:
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= HEADER.size:
+            length, request_id, kind = decode_header(bytes(self._buffer[offset:offset + HEADER.size]))
+            end = offset + HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            frames.append(Frame(request_id, kind, bytes(self._buffer[offset + HEADER.size:end])))
+            offset = end
+        del self._buffer[:offset]
+        return frames
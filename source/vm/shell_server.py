@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import stat
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Set, Tuple, Union
+
+from source.vm.events import Subscription, encode_events
+from source.vm.protocol import (DEFAULT_ADDRESS, HEADER, Address, EProtocolError, Frame, FrameKind, decode_header,
+                                decode_upload, encode_frame, format_address)
+
+
+class ShellServer:
+    """Shell socket server
+
+    Accepting connections and talking to every client happens on a single asyncio event loop, so the server uses no
+    CPU while it's idle and each client costs a coroutine rather than a thread. Shell commands themselves run on the
+    loop's default thread pool, since loading a program reads and decodes a file.
+
+    Clients speak the framed protocol of `source.vm.protocol` and may pipeline requests: up to `max_pending` received
+    requests are queued per connection, and those are executed, in order, up to `max_batch` per trip to the thread
+    pool, with their replies written back in one go. Replies that aren't ready right away, such as the result of a
+    `job`, are written whenever they are, without holding back the requests that follow. The events of a `subscribe`
+    are streamed until the client disconnects, each batch in a single frame. While the client is slow to read them,
+    they pile up in the subscription's bounded queue, never in the CPU's way, until the VM drops the subscriber.
+
+    The socket is TCP, or a Unix domain socket when `address` is a path. A socket file left behind by a server that
+    didn't close is replaced, one that's still being served is not.
+
+    The loop is either given (the asyncio I/O subsystem shares its own) or run by the server on a thread of its own.
+
+    `vm` is anything with the `handle_shell_command` and `handle_shell_upload` methods of `VirtualMachine`, such as a
+    `Dispatcher`.
+    """
+
+    def __init__(self, vm, address: Address = DEFAULT_ADDRESS, loop: asyncio.AbstractEventLoop = None,
+                 max_pending: int = 1024, max_batch: int = 64):
+        self.vm = vm
+        self.endpoint = address  # Where to bind, see `address` for where it's bound
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self._own_loop = loop is None
+        self.loop = loop if loop is not None else asyncio.new_event_loop()
+        self._thread: Optional[threading.Thread] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._clients: Set[asyncio.Task] = set()
+        self._deferred: Set[asyncio.Task] = set()
+
+    def start(self, timeout: float = 5) -> 'ShellServer':
+        """Bind the socket and start serving. Returns once the socket is bound
+
+        Raises:
+            OSError: The socket could not be bound
+        """
+
+        if self._own_loop:
+            self._thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='shell-server')
+            self._thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._start(), self.loop).result(timeout)
+        except BaseException:
+            self._stop_loop()
+            raise
+        print(f'Shell socket bound to {format_address(self.address)}')
+        return self
+
+    async def _start(self):
+        if isinstance(self.endpoint, str):
+            self._remove_stale_socket(self.endpoint)
+            # Bound here, since asyncio would replace the socket file even if it's still being served
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.bind(self.endpoint)
+            except OSError:
+                sock.close()
+                raise
+            self._server = await asyncio.start_unix_server(self._client, sock=sock)
+        else:
+            self._server = await asyncio.start_server(self._client, *self.endpoint)
+
+    @staticmethod
+    def _remove_stale_socket(path: str):
+        try:
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                return  # Not ours to remove, binding fails
+        except FileNotFoundError:
+            return
+        with socket.socket(socket.AF_UNIX) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:  # Nobody is listening
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @property
+    def address(self) -> Address:
+        """Where the socket is bound: (host, port), with the port that was picked for port 0, or its path"""
+
+        address = self._server.sockets[0].getsockname()
+        return address if isinstance(address, str) else tuple(address[:2])
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Reading and executing are separate coroutines, so the client can keep sending requests while earlier ones
+        # run. Requests are executed in the order they arrive, in batches of whatever has been received meanwhile
+        self._writers.add(writer)
+        self._clients.add(asyncio.current_task())
+        requests: asyncio.Queue = asyncio.Queue(self.max_pending)
+        executor = asyncio.ensure_future(self._execute(requests, writer))
+        try:
+            while True:
+                length, request_id, kind = decode_header(await reader.readexactly(HEADER.size))
+                await requests.put(Frame(request_id, kind, await reader.readexactly(length)))
+        except asyncio.IncompleteReadError:
+            print('Shell connection closed')
+        except EProtocolError as E:
+            logging.error(f'Shell connection dropped: {E}')
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            await requests.put(None)
+            try:
+                await executor
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            self._writers.discard(writer)
+            self._clients.discard(asyncio.current_task())
+            writer.close()
+
+    async def _execute(self, requests: asyncio.Queue, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        deferred: Set[asyncio.Task] = set()  # Replies that aren't ready yet
+        streams: Set[asyncio.Task] = set()  # Event subscriptions
+        while True:
+            batch = [await requests.get()]
+            while not requests.empty() and len(batch) < self.max_batch:
+                batch.append(requests.get_nowait())
+            done = batch[-1] is None
+            batch = [frame for frame in batch if frame is not None]
+            if batch:
+                replies, later = await loop.run_in_executor(None, self._handle_batch, batch)
+                writer.write(replies)
+                for request_id, reply in later:
+                    if isinstance(reply, Subscription):
+                        task = asyncio.ensure_future(self._stream(request_id, reply, writer))
+                        streams.add(task)
+                        task.add_done_callback(streams.discard)
+                    else:
+                        task = asyncio.ensure_future(self._reply_later(request_id, reply, writer))
+                    deferred.add(task)
+                    self._deferred.add(task)
+                    task.add_done_callback(deferred.discard)
+                    task.add_done_callback(self._deferred.discard)
+                await writer.drain()
+            if done:
+                # The client may have only closed its side of the connection, it still gets every reply, but there is
+                # no end to a subscription
+                for task in streams:
+                    task.cancel()
+                await asyncio.gather(*deferred, return_exceptions=True)
+                return
+
+    async def _reply_later(self, request_id: int, future: Future, writer: asyncio.StreamWriter):
+        try:
+            frame = encode_frame(request_id, FrameKind.REPLY, (await asyncio.wrap_future(future)).encode('utf-8'))
+        except Exception as E:
+            frame = self._error(request_id, E)
+        writer.write(frame)
+        await writer.drain()
+
+    async def _stream(self, request_id: int, subscription: Subscription, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        subscription.on_ready = lambda: loop.call_soon_threadsafe(ready.set)
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                closed = subscription.closed  # Nothing is queued once it's closed, so the drain gets every event
+                if events := subscription.drain():
+                    writer.write(encode_frame(request_id, FrameKind.REPLY, encode_events(events).encode('utf-8')))
+                    # Waiting for a slow client lets the events queue up, until the subscriber is dropped
+                    await writer.drain()
+                if closed:
+                    end = {'end': subscription.reason, 'dropped': subscription.dropped}
+                    writer.write(encode_frame(request_id, FrameKind.REPLY, json.dumps(end).encode('utf-8')))
+                    await writer.drain()
+                    return
+        finally:
+            subscription.close()
+
+    def _handle_batch(self, frames) -> Tuple[bytes, List[Tuple[int, Union[Future, Subscription]]]]:
+        replies, later = [], []
+        for frame in frames:
+            reply = self._handle(frame)
+            if isinstance(reply, (Future, Subscription)):
+                later.append((frame.request_id, reply))
+            else:
+                replies.append(reply)
+        return b''.join(replies), later
+
+    def _handle(self, frame: Frame) -> Union[bytes, Future, Subscription]:
+        try:
+            if frame.kind == FrameKind.COMMAND:
+                reply = self.vm.handle_shell_command(frame.text())
+            elif frame.kind == FrameKind.UPLOAD:
+                name, source, priority = decode_upload(frame.payload)
+                reply = self.vm.handle_shell_upload(name, source.decode('utf-8'), priority)
+            else:
+                raise EProtocolError(f'Unexpected {frame.kind.name} frame')
+            if isinstance(reply, (Future, Subscription)):
+                return reply
+            return encode_frame(frame.request_id, FrameKind.REPLY, reply.encode('utf-8'))
+        except (EProtocolError, UnicodeDecodeError) as E:
+            return encode_frame(frame.request_id, FrameKind.ERROR, str(E).encode('utf-8'))
+        except Exception as E:
+            return self._error(frame.request_id, E)
+
+    @staticmethod
+    def _error(request_id: int, error: Exception) -> bytes:
+        # A request that failed still gets its reply, so the client isn't left waiting for it
+        logging.error(f'Shell request {request_id} failed: {error!r}')
+        return encode_frame(request_id, FrameKind.ERROR, (str(error) or repr(error)).encode('utf-8'))
+
+    def close(self, timeout: float = 5):
+        """Stop accepting connections, disconnect every client and free the socket
+
+        Can be called from any thread. Returns once the socket is closed, unless called from the loop itself.
+        """
+
+        if self._server is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+        if self._on_loop():  # The loop can't wait for itself
+            return
+        try:
+            future.result(timeout)
+        except Exception as E:
+            logging.error(f'Could not close the shell socket: {E}')
+        self._stop_loop()
+
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def _close(self):
+        server, self._server = self._server, None
+        if server is None:
+            return
+        server.close()
+        for task in list(self._deferred):
+            task.cancel()
+        for writer in list(self._writers):
+            writer.close()
+        await asyncio.gather(*self._clients, return_exceptions=True)
+        await server.wait_closed()
+        if isinstance(self.endpoint, str):
+            try:
+                os.unlink(self.endpoint)
+            except FileNotFoundError:
+                pass
+
+    def _stop_loop(self):
+        if self._own_loop and self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,107 @@
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Optional
+
+from source.memory.process import ProcessControlBlock
+
+
+class StatusReporter:
+    """Snapshots of a running VM, for the `ps`, `mem`, `stats` and `proc` shell commands
+
+    Everything is read from counters that the VM keeps up to date as it runs (free frames, instructions executed,
+    context switches, queue lengths, ...), without taking the process manager's lock or walking the memory, so polling
+    a VM every second doesn't slow it down. The numbers of a snapshot may therefore be a few instructions apart.
+
+    Rates (per second) are measured over the time since the previous `stats` snapshot, or since the VM was created
+    for the first one.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.created_at = monotonic()
+        self._lock = Lock()
+        self._last_sample = (self.created_at, 0, 0)  # Time, instructions, context switches
+
+    def ps(self) -> List[Dict[str, Any]]:
+        """Every process that hasn't been reaped"""
+
+        return [{
+            'pid': process.pid,
+            'name': process.name,
+            'state': process.state.name,
+            'priority': process.priority,
+            'instructions': process.instructions,
+            'frames': len(process.frames),
+        } for process in self.vm.process_manager._processes]
+
+    def mem(self) -> Dict[str, Any]:
+        memory = self.vm.memory
+        free = memory.free_frames()
+        return {
+            'page_size': memory.page_size,
+            'frames': memory.frame_amount,
+            'free_frames': free,
+            'used_frames': memory.frame_amount - free,
+            'pending_admission': len(self.vm.process_manager.pending_admission),
+        }
+
+    def proc(self, pid: int) -> Optional[Dict[str, Any]]:
+        """Details of a process. Only a summary is left of reaped processes. None if it isn't known (anymore)"""
+
+        process: ProcessControlBlock = self.vm.process_manager._processes.get(pid)
+        if process is None:
+            summary = self.vm.process_manager.summary(pid)
+            return {**summary._asdict(), 'reaped': True} if summary is not None else None
+        return {
+            'pid': process.pid,
+            'name': process.name,
+            'state': process.state.name,
+            'exit_reason': process.exit_reason,
+            'priority': process.priority,
+            'instructions': process.instructions,
+            'instruction_budget': process.instruction_budget,
+            'demoted': process.demoted,
+            'context_switches': process.context_switches,
+            'run_time': process.run_time,
+            'blocked_time': process.blocked_time,
+            'size': process.process_size,
+            'frames': [frame.index for frame in process.frames],
+            'pc': process.saved_pc_value,
+            'scheduling': process.histograms.as_dict(),
+            'reaped': False,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        vm = self.vm
+        process_manager = vm.process_manager
+        now = monotonic()
+        instructions = vm.cpu.instructions_executed + vm.cpu.current_process_instruction_count
+        context_switches = process_manager.context_switches
+        with self._lock:
+            then, last_instructions, last_context_switches = self._last_sample
+            self._last_sample = (now, instructions, context_switches)
+        elapsed = (now - then) or 1e-9
+
+        io_devices = vm.io_handler.stats()
+        return {
+            'uptime': now - self.created_at,
+            'instructions': instructions,
+            'instructions_per_second': (instructions - last_instructions) / elapsed,
+            'context_switches': context_switches,
+            'context_switches_per_second': (context_switches - last_context_switches) / elapsed,
+            'processes': len(process_manager._processes),
+            'reaped': process_manager._processes.reaped,
+            'run_queue': len(process_manager.scheduler),
+            'blocked': list(process_manager.blocked_processes),
+            'free_frames': vm.memory.free_frames(),
+            'io_queue_depth': sum(device['depth'] for device in io_devices.values()),
+            'io_devices': io_devices,
+            'io_completions': vm.io_handler.completions.stats(),
+            'wakeup_latency': process_manager.wakeup_latency.as_dict(),
+            'scheduling': process_manager.histograms.as_dict(),
+            'admission': {
+                'pending': len(process_manager.pending_admission),
+                'rejected': process_manager.admission_rejected,
+                'wait': process_manager.admission_wait.as_dict(),
+            },
+        }
@@ -1,15 +1,28 @@
 from source.command.command import EShutdown
+import json
 import threading
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
 from pathlib import Path
+from typing import Optional, Union
 
 from pyfiglet import figlet_format
 
 from source.cpu.cpu import Cpu
-from source.memory.memory import MemoryManager, ProcessManager
+from source.cpu.profiler import Profiler
+from source.cpu.trace import TraceBuffer
+from source.memory.memory import EOutOfMemory, MemoryManager, ProcessManager
+from source.memory.program import ProgramImage, decode_file, decode_files, decode_source
+from source.vm.async_io_handler import AsyncIOHandler
+from source.vm.devices import ConsoleInput, ConsoleOutput, IBlockDevice, MappedBlockDevice
+from source.vm.events import EventBus, Subscription
 from source.vm.io_handler import IOHandler
+from source.vm.jobs import Job, JobManager
+from source.vm.program_cache import ProgramCache
+from source.vm.protocol import DEFAULT_ADDRESS, decode_upload_command, parse_address, split_priority
+from source.vm.shell_server import ShellServer
+from source.vm.status import StatusReporter
 
-import socket
 
 
 class IVirtualMachine(ABC, threading.Thread):
@@ -37,7 +50,12 @@ class VirtualMachine(IVirtualMachine):
     Contains a CPU and a Memory modules, that each refer to this object as their "owner" (or parent).
     """
 
-    def __init__(self, mem_size, create_shell_sock = False, tk=None):
+    def __init__(self, mem_size, create_shell_sock = False, tk=None, optimize = False, program_cache_size = 32,
+                 io_workers = 2, io_backend = 'thread', stdin = None, stdout = None, io_batch_size = 16,
+                 io_batch_delay = 0.005, block_devices = None, scheduler = None, wakeup_preemption = False,
+                 keep_ended = 64, process_history = 1024, admission = 'reject',
+                 instruction_budget = None, budget_action = 'terminate', keep_alive = False, event_queue_size = 4096,
+                 shell_endpoint = DEFAULT_ADDRESS, profile = False, trace = 0, trace_file = 'memory.trace'):
         """Creates a new Virtual Machine thread
 
         Creates both a CPU object and a Memory object as well.
@@ -45,68 +63,180 @@ class VirtualMachine(IVirtualMachine):
         Args:
             mem_size (int): Total memory size
             tk (Text): Tkinter Text object
+            optimize (bool): Run the load-time optimizer on every loaded program
+            program_cache_size (int): How many decoded programs `load_from_file` keeps around. 0 disables the cache
+            io_workers (int): Number of I/O worker threads per device (`stdin` always has a single one)
+            io_backend (str): `thread` for a thread pool I/O subsystem or `asyncio` for an event loop based one.
+                With `asyncio` the shell socket is served from the I/O event loop too
+            stdin (IInputDevice): Default input device of every process. Defaults to the terminal
+            stdout (IOutputDevice): Default output device of every process. Defaults to the terminal
+            io_batch_size (int): Finished I/O requests that are delivered to the CPU in a single interruption. They are
+                also delivered on every context switch
+            io_batch_delay (float): Seconds after which finished I/O requests interrupt the CPU even if the batch is
+                not full
+            block_devices (Dict[int, Union[IBlockDevice, PathLike]]): Block devices available to `TRAP` block reads
+                and writes, by device number. Paths are memory-mapped (see `MappedBlockDevice`)
+            scheduler (Union[str, IScheduler]): Scheduling policy: `round-robin` (default), `priority`, `mlfq` or an
+                `IScheduler` instance (see `source.memory.scheduler`)
+            wakeup_preemption (bool): A process whose I/O has finished takes the CPU right away, instead of waiting
+                for its turn. The wake-to-run latency is kept in `process_manager.wakeup_latency` either way
+            keep_ended (int): Number of ended processes that are kept whole (for inspection and dumps) before the
+                oldest is reaped
+            process_history (int): Number of reaped processes whose summary is kept (see `ProcessManager.summary`)
+            admission (str): What happens to a program that doesn't fit in the free memory: `reject` fails the load,
+                `queue` loads it once enough memory is freed (see `ProcessManager.admission_stats`)
+            instruction_budget (int): Default number of instructions each process may execute. None for no limit
+            budget_action (str): What happens to a process that exceeds its budget: `terminate` ends it, `deprioritize`
+                only lets it run when no other process is ready
+            keep_alive (bool): Keep running, waiting for new processes, once every process has ended, until `shutdown`
+                is called. For serving jobs (see `submit`)
+            event_queue_size (int): Events an event subscriber may have queued before it's dropped (see `events`)
+            shell_endpoint (Union[str, int, Tuple[str, int]]): Address of the shell socket: `host:port`, a port (0
+                picks a free one, see `shell_address`) or `unix:<path>` for a Unix domain socket (see `parse_address`)
+            profile (bool): Count and time every instruction, context switch, interruption and address translation
+                (see `profiler`). Off, it costs nothing
+            trace (int): Keep a binary trace of the last `trace` instructions (see `source.cpu.trace`). 0 disables it
+            trace_file (PathLike): Where the trace is written, when the CPU stops on a fault or on `dump_trace`
         """
 
         threading.Thread.__init__(self, daemon=False)
 
+        self.optimize = optimize
+        self.instruction_budget = instruction_budget
+        self.stdin = stdin if stdin is not None else ConsoleInput()
+        self.stdout = stdout if stdout is not None else ConsoleOutput()
+        self.block_devices = {number: device if isinstance(device, IBlockDevice) else MappedBlockDevice(device)
+                              for number, device in (block_devices or {}).items()}
+        self.program_cache = ProgramCache(program_cache_size) if program_cache_size > 0 else None
+        self.events = EventBus(event_queue_size)
+        self.profiler = Profiler() if profile else None
+        self.tracer = TraceBuffer(trace) if trace else None
+        self.trace_file = Path(trace_file)
+
         self._cpu = Cpu(self)
         self._memory = MemoryManager(self, mem_size, 16)
-        self._process_manager = ProcessManager(self)
-        self._io_handler = IOHandler(self)
+        self._process_manager = ProcessManager(self, scheduler, wakeup_preemption, keep_ended, process_history,
+                                               admission, budget_action, keep_alive)
+        if io_backend == 'asyncio':
+            self._io_handler = AsyncIOHandler(self, io_workers, batch_size=io_batch_size, batch_delay=io_batch_delay)
+        else:
+            self._io_handler = IOHandler(self, io_workers, batch_size=io_batch_size, batch_delay=io_batch_delay)
         self._io_handler.start()
-        self.end_threads = False
+        self.shell_endpoint = parse_address(shell_endpoint)
+        self._shell_server = None
+        self._end_threads = False
+        self.status = StatusReporter(self)
+        self.jobs = JobManager(self)
 
         if create_shell_sock:
             self.create_shell_socket()
 
+    def handle_shell_command(self, message: str) -> Union[str, Future]:
+        """Execute a shell command and return the reply to be sent back to the client
+
+        Commands that complete later, such as `job`, return a future of the reply instead, and `subscribe` returns
+        the `Subscription` whose events are streamed to the client.
+        """
+
+        command, _, *args = message.partition(' ')
+        handler = {
+            'shutdown': lambda _: f'Halting... {self.shutdown() or ""}',
+            'load': lambda args: f'New process PID: {self._shell_load(args[0])}',
+            'upload': lambda args: f'New process PID: {self._shell_upload(args[0])}',
+            'ps': lambda _: self._json(self.status.ps()),
+            'mem': lambda _: self._json(self.status.mem()),
+            'stats': lambda _: self._json(self.status.stats()),
+            'proc': lambda args: self._shell_proc(args[0] if args else ''),
+            'job': lambda args: self.jobs.submit_json(args[0] if args else ''),
+            'subscribe': lambda args: self._shell_subscribe(args[0] if args else ''),
+            'profile': lambda args: self._shell_profile(args[0] if args else ''),
+            'trace': lambda args: self._shell_trace(args[0] if args else ''),
+        }.get(command)
+        if handler is None:
+            return f'Unknown command: {command}'
+        return handler(args)
+
+    def handle_shell_upload(self, name: str, source: str, priority: int = 0) -> Union[str, Future]:
+        """Load a program uploaded through the shell socket and return the reply"""
+
+        return f'New process PID: {self.load_source(name, source, priority=priority)}'
+
+    def _shell_load(self, args: str) -> int:
+        # load <path> [priority]
+        path, priority = split_priority(args)
+        return self.load_from_file(Path(path), priority=priority)
+
+    def _shell_upload(self, args: str) -> int:
+        # upload <name> [priority]\n<source>
+        name, source, priority = decode_upload_command(args)
+        return self.load_source(name, source, priority=priority)
+
+    def _shell_proc(self, args: str) -> str:
+        # proc <pid>
+        try:
+            pid = int(args)
+        except ValueError:
+            return self._json({'error': f'Invalid PID: {args.strip()}'})
+        if (details := self.status.proc(pid)) is None:
+            return self._json({'error': f'Unknown PID: {pid}'})
+        return self._json(details)
+
+    def _shell_subscribe(self, args: str) -> Union[str, Subscription]:
+        # subscribe [kind...]
+        try:
+            return self.events.subscribe(args.split())
+        except ValueError as E:
+            return self._json({'error': str(E)})
+
+    def _shell_profile(self, args: str) -> str:
+        # profile [top]
+        if self.profiler is None:
+            return self._json({'error': 'The VM is not being profiled'})
+        return self._json(self.profiler.as_dict(int(args) if args.strip().isdigit() else 20))
+
+    def _shell_trace(self, args: str) -> str:
+        # trace [path]
+        if self.tracer is None:
+            return self._json({'error': 'The VM is not being traced'})
+        file = Path(args.strip()) if args.strip() else self.trace_file
+        try:
+            return self._json({'file': str(file.resolve()), 'instructions': self.dump_trace(file)})
+        except OSError as E:
+            return self._json({'error': str(E)})
+
+    @staticmethod
+    def _json(value) -> str:
+        return json.dumps(value, separators=(',', ':'))
+
     def create_shell_socket(self):
-        def client(conn: socket.socket, vm):
-            conn.settimeout(30)
-            while True:
-                if vm.end_threads:
-                    break
-
-                try:
-                    data = conn.recv(4096)
-                    if not data:
-                        print('Shell connection closed')
-                        break
-                    command, _, *args = data.decode('ascii').partition(' ')
-                    ret = {
-                        'shutdown': lambda _: f'Halting... {vm.cpu.queue_interrupt(EShutdown()) or ""}',
-                        'load': lambda path: f'New process PID: {vm.load_from_file(Path(path[0]))}'
-                    }[command](args)
-                    conn.sendall(ret.encode('ascii'))
-                except BlockingIOError:
-                    continue
-                except socket.timeout:
-                    continue
-            conn.close()
-
-        def shell_sock(vm):
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-                s.bind(('localhost', 8899))
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-
-                print('Shell socket bound')
-                s.listen()
-                s.setblocking(False)
-                while True:
-                    if vm.end_threads:
-                        break
-
-                    try:
-                        c, _ = s.accept()
-                        proc = threading.Thread(target=client, daemon=True, args=(c, vm,))
-                        proc.start()
-                    except BlockingIOError:
-                        continue
-                s.close()
-            except OSError as E:
-                exit
-        shell_sock_proc = threading.Thread(target=shell_sock, daemon=True, args=(self,))
-        shell_sock_proc.start()
+        """Serve the shell socket. Returns once the socket is bound
+
+        With the `asyncio` I/O backend the server runs on the I/O event loop, otherwise on an event loop of its own.
+        The socket is closed when `end_threads` is set.
+        """
+
+        loop = self._io_handler.loop if isinstance(self._io_handler, AsyncIOHandler) else None
+        try:
+            self._shell_server = ShellServer(self, self.shell_endpoint, loop=loop).start()
+        except OSError as E:
+            print(f'Could not bind the shell socket: {E}')
+
+    @property
+    def shell_address(self):
+        """Address the shell socket is bound to, (host, port) or the path of a Unix domain socket. None if it isn't"""
+
+        return self._shell_server.address if self._shell_server is not None else None
+
+    @property
+    def end_threads(self):
+        return self._end_threads
+
+    @end_threads.setter
+    def end_threads(self, value):
+        self._end_threads = value
+        if value and self._shell_server is not None:
+            self._shell_server.close()
+            self._shell_server = None
 
     @property
     def memory(self):
@@ -116,6 +246,7 @@ class VirtualMachine(IVirtualMachine):
     def cpu(self):
         return self._cpu
     
+
     @property
     def process_manager(self):
         return self._process_manager
@@ -124,18 +255,135 @@ class VirtualMachine(IVirtualMachine):
     def io_handler(self):
         return self._io_handler
 
-    def load_from_file(self, file: Path, _print = True):
+    def decode(self, file: Path) -> ProgramImage:
+        """Decode a program file, through the program cache"""
+
+        if self.program_cache is not None:
+            return self.program_cache.load(file, lambda f: decode_file(f, self.optimize))
+        return decode_file(file, self.optimize)
+
+    def decode_text(self, name: str, source: str) -> ProgramImage:
+        """Decode the source of a program, through the program cache"""
+
+        decode = lambda n, s: decode_source(n, s, self.optimize)
+        if self.program_cache is not None:
+            return self.program_cache.load_source(name, source, decode)
+        return decode(name, source)
+
+    def budget(self, instruction_budget: Optional[int] = None) -> Optional[int]:
+        """Instruction budget of a new process: the given one, even if it's 0, or else the VM's"""
+
+        return instruction_budget if instruction_budget is not None else self.instruction_budget
+
+    def load_from_file(self, file: Path, _print = True, stdin = None, stdout = None, priority = 0,
+                       instruction_budget = None):
+        """Load a program into memory and create its process
+
+        Args:
+            file (Path): Program file
+            stdin (IInputDevice): Input device of the process. Defaults to the VM's
+            stdout (IOutputDevice): Output device of the process. Defaults to the VM's
+            priority (int): Scheduling priority of the process, higher runs first
+            instruction_budget (int): Instructions the process may execute. Defaults to the VM's `instruction_budget`
+
+        Returns:
+            int: The PID of the new process. -1 if the program could not be loaded
+        """
+
+        try:
+            image = self.decode(file)
+            pid = self._process_manager.install_image(image, stdin, stdout, priority, self.budget(instruction_budget))
+            if _print: self._print_loaded(image, pid)
+            return pid
+        except EOutOfMemory as E:
+            if _print: print(f'Could not load {Path(file).name}: {E}')
+            return -1
+        except:
+            return -1
+
+    def load_source(self, name: str, source: str, _print = True, stdin = None, stdout = None, priority = 0,
+                    instruction_budget = None):
+        """Load a program from its source, rather than from a file, and create its process
+
+        Used for programs uploaded through the shell socket. Decoded programs are cached by their source.
+
+        Args:
+            name (str): Program name
+            source (str): Program source
+            stdin (IInputDevice): Input device of the process. Defaults to the VM's
+            stdout (IOutputDevice): Output device of the process. Defaults to the VM's
+            priority (int): Scheduling priority of the process, higher runs first
+            instruction_budget (int): Instructions the process may execute. Defaults to the VM's `instruction_budget`
+
+        Returns:
+            int: The PID of the new process. -1 if the program could not be loaded
+        """
+
         try:
-            with open(file, 'r') as f:
-                lines = f.readlines()
-            # Close the file as soon as possible to free the disk
-            # Also use an auxiliary list to get its len()
-            pid = self._process_manager.create_process(file.name, lines)
-            if _print: print(f'Loaded process {file.name} into memory. PID: {pid}')
+            image = self.decode_text(name, source)
+            pid = self._process_manager.install_image(image, stdin, stdout, priority, self.budget(instruction_budget))
+            if _print: self._print_loaded(image, pid)
             return pid
+        except EOutOfMemory as E:
+            if _print: print(f'Could not load {name}: {E}')
+            return -1
         except:
             return -1
 
+    def load_many(self, files, workers=None, _print = True, stdin = None, stdout = None, priority = 0,
+                  instruction_budget = None):
+        """Load many programs at once
+
+        The files are read and decoded in parallel worker processes, then every decoded program is installed into
+        memory in a single batch.
+
+        Args:
+            files (Iterable[Path]): Program files
+            workers (int): Number of worker processes. Defaults to the number of CPUs
+            stdin (IInputDevice): Input device of the new processes. Defaults to the VM's
+            stdout (IOutputDevice): Output device of the new processes. Defaults to the VM's
+            priority (int): Scheduling priority of the new processes
+            instruction_budget (int): Instructions each new process may execute. Defaults to the VM's
+
+        Returns:
+            List[int]: The PID of each program, in the same order as `files`. -1 if a program could not be loaded
+        """
+
+        files = [Path(file) for file in files]
+        decoded = decode_files(files, workers, self.optimize)
+        images = [image for image in decoded if not isinstance(image, Exception)]
+        installed = iter(self._process_manager.install_images(images, stdin, stdout, priority,
+                                                              self.budget(instruction_budget)))
+
+        pids = []
+        for file, image in zip(files, decoded):
+            if isinstance(image, Exception):
+                pid = -1
+                if _print: print(f'Could not load {file.name}: {image}')
+            else:
+                pid = next(installed)
+                if _print: self._print_loaded(image, pid)
+            pids.append(pid)
+        return pids
+
+    def submit(self, program: Union[Path, str], inputs = (), memory = (), name = 'job', priority = 0,
+               instruction_budget = None) -> Job:
+        """Run a program as a job. See `JobManager.submit`
+
+        The job completes, with the program's outputs and the requested memory ranges, when its process ends, while
+        the VM keeps running the other processes.
+        """
+
+        return self.jobs.submit(program, inputs, memory, name, priority, instruction_budget)
+
+    def _print_loaded(self, image, pid):
+        if any(pending.pid == pid for pending in self._process_manager.pending_admission):
+            print(f'Not enough free memory for {image.name} yet, it will be loaded once there is. PID: {pid}')
+            return
+        print(f'Loaded process {image.name} into memory. PID: {pid}')
+        if image.optimization is not None:
+            print(f'Optimized {image.name}: {image.optimization}')
+
 
     def run(self):
         """
@@ -143,6 +391,19 @@ class VirtualMachine(IVirtualMachine):
         """
 
         self._cpu.loop()
+        self.jobs.abort()
+        self.events.close()
+        self.end_threads = True
+        self._io_handler.close()  # After the shell socket, which may be served from the I/O event loop
+        self.stdout.flush()
+        for device in self.block_devices.values():
+            device.flush()
+
+    def shutdown(self):
+        """Stop the CPU, even with `keep_alive`"""
+
+        self.cpu.queue_interrupt(EShutdown())
+        self._process_manager.stop()
 
     def dump(self, e=None, to_file=True):
         """
@@ -169,3 +430,12 @@ class VirtualMachine(IVirtualMachine):
                 # Dump memory
                 self.process_manager.dump(f)
                 self.memory.dump(f)
+
+    def dump_trace(self, file = None, reason = 'On demand') -> int:
+        """Write the execution trace to `file` (defaults to `trace_file`). Returns how many instructions it holds"""
+
+        def process_name(pid):
+            summary = self._process_manager.summary(pid)
+            return summary.name if summary is not None else None
+
+        return self.tracer.dump(file or self.trace_file, reason, process_name)
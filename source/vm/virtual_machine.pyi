@@ -1,10 +1,22 @@
 import threading
 from abc import ABC, abstractmethod
 from pathlib import Path
+from os import PathLike
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from tkinter import Text
 
 from source.cpu.cpu import ICpu
+from source.cpu.profiler import Profiler
+from source.cpu.trace import TraceBuffer
 from source.memory.memory import IMemoryManager
+from source.memory.program import ProgramImage
+from source.memory.scheduler import IScheduler
+from source.vm.devices import IBlockDevice, IInputDevice, IOutputDevice
+from source.vm.events import EventBus
+from source.vm.protocol import DEFAULT_ADDRESS, Address
+from source.vm.jobs import Job, JobManager
+from source.vm.status import StatusReporter
 
 
 class IVirtualMachine(ABC, threading.Thread):
@@ -24,8 +36,42 @@ class VirtualMachine(IVirtualMachine):
     _memory: IMemoryManager
     _cpu: ICpu
     tk: Text
+    stdin: IInputDevice
+    stdout: IOutputDevice
+    block_devices: Dict[int, IBlockDevice]
+    status: StatusReporter
+    jobs: JobManager
+    events: EventBus
+    profiler: Optional[Profiler]
+    tracer: Optional[TraceBuffer]
+    trace_file: Path
 
-    def __init__(self, mem_size: int, tk: Text = None): ...
+    def __init__(self, mem_size: int, create_shell_sock: bool = False, tk: Text = None, optimize: bool = False,
+                 program_cache_size: int = 32, io_workers: int = 2,
+                 io_backend: str = 'thread', stdin: IInputDevice = None, stdout: IOutputDevice = None,
+                 io_batch_size: int = 16, io_batch_delay: float = 0.005,
+                 block_devices: Dict[int, Union[IBlockDevice, PathLike]] = None,
+                 scheduler: Union[str, IScheduler] = None, wakeup_preemption: bool = False,
+                 keep_ended: int = 64, process_history: int = 1024, admission: str = 'reject',
+                 instruction_budget: int = None, budget_action: str = 'terminate', keep_alive: bool = False,
+                 event_queue_size: int = 4096, shell_endpoint: Union[str, int, Tuple[str, int]] = DEFAULT_ADDRESS,
+                 profile: bool = False, trace: int = 0,
+                 trace_file: Union[str, PathLike] = 'memory.trace'): ...
+
+    def handle_shell_command(self, message: str) -> Union[str, Future]: ...
+
+    def handle_shell_upload(self, name: str, source: str, priority: int = 0) -> Union[str, Future]: ...
+
+    def create_shell_socket(self) -> None: ...
+
+    @property
+    def shell_address(self) -> Optional[Address]: ...
+
+    @property
+    def end_threads(self) -> bool: ...
+
+    @end_threads.setter
+    def end_threads(self, value: bool) -> None: ...
 
     @property
     def memory(self) -> IMemoryManager: ...
@@ -39,8 +85,28 @@ class VirtualMachine(IVirtualMachine):
     @property
     def io_handler(self): ...
 
-    def load_from_file(self, file: Path) -> int: ...
+    def decode(self, file: Path) -> ProgramImage: ...
+
+    def decode_text(self, name: str, source: str) -> ProgramImage: ...
+
+    def budget(self, instruction_budget: Optional[int] = None) -> Optional[int]: ...
+
+    def load_from_file(self, file: Path, _print: bool = True, stdin: IInputDevice = None,
+                       stdout: IOutputDevice = None, priority: int = 0, instruction_budget: int = None) -> int: ...
+
+    def load_source(self, name: str, source: str, _print: bool = True, stdin: IInputDevice = None,
+                    stdout: IOutputDevice = None, priority: int = 0, instruction_budget: int = None) -> int: ...
+
+    def load_many(self, files: Iterable[Path], workers: int = None, _print: bool = True, stdin: IInputDevice = None,
+                  stdout: IOutputDevice = None, priority: int = 0, instruction_budget: int = None) -> List[int]: ...
+
+    def submit(self, program: Union[Path, str], inputs: Iterable[int] = (), memory: Iterable[Tuple[int, int]] = (),
+               name: str = 'job', priority: int = 0, instruction_budget: int = None) -> Job: ...
 
     def run(self) -> None: ...
 
+    def shutdown(self) -> None: ...
+
     def dump(self, e: Exception = None, to_file: bool = True) -> None: ...
+
+    def dump_trace(self, file: Union[str, PathLike] = None, reason: str = 'On demand') -> int: ...
@@ -1,4 +1,5 @@
 from time import sleep
+import tempfile
 import unittest
 from pathlib import Path
 
@@ -11,13 +12,42 @@ from source.vm.virtual_machine import VirtualMachine
 
 class AssemblyTest(unittest.TestCase):
     def setUp(self) -> None:
-        self.vm = VirtualMachine(mem_size=4096, create_shell_sock=True)
+        self.vm = VirtualMachine(mem_size=4096, create_shell_sock=True, shell_endpoint=0)
         self.path = ''
 
     def tearDown(self) -> None:
         self.vm.end_threads = True
         return super().tearDown()
 
+    def temporary_directory(self) -> Path:
+        """A directory that's removed once the test has ended"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return Path(directory.name)
+
+    def write_program(self, source: str, name: str = 'program.asm') -> Path:
+        """Write a program to a temporary file, removed once the test has ended"""
+
+        program = self.temporary_directory() / name
+        program.write_text(source)
+        return program
+
+    def keep_frames(self, vm: VirtualMachine, pids) -> None:
+        """Don't dealloc() the frames of the processes in `pids`, so that their memory can be checked once they've ended
+
+        The idle processes that run while every process waits for I/O are freed as usual, they'd fill the memory
+        otherwise.
+        """
+
+        deallocate = vm.memory.deallocate
+
+        def keep(frames):
+            if not any(frame.owner in pids for frame in frames):
+                deallocate(frames)
+
+        vm.memory.deallocate = keep
+
     def test_fibonacci(self):
         """
         Test the Fibonacci sequence generator assembly file
@@ -141,6 +171,38 @@ class AssemblyTest(unittest.TestCase):
 
         self.assertEqual(literal_array, [self.vm.process_manager.access(i).command.execute() for i in range(300, 350)])
 
+    @parameterized.expand([
+        (3,), (0,), (-2,)
+    ])
+    def test_optimizer(self, number):
+        """
+        Test that optimized programs compute the same results as the original ones
+        """
+
+        import math
+
+        vm = VirtualMachine(mem_size=4096, optimize=True)
+        p3_pid = vm.load_from_file(Path(self.path + 'example_programs/p3.asm'))
+        p3_traps_pid = vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'))
+
+        p3_report = vm.process_manager._processes[p3_pid].optimization
+        self.assertFalse(p3_report.skipped)
+        self.assertGreater(p3_report.removed, 0)
+        self.assertGreater(p3_report.simplified, 0)
+
+        self.keep_frames(vm, [p3_pid, p3_traps_pid])
+
+        with patch('builtins.input', return_value=number):
+            vm.start()
+            vm.join()
+
+        p3_proc = vm.process_manager._processes[p3_pid]
+        self.assertEqual(720, p3_proc.frames[-1].addresses[2].command.execute())
+
+        vm.process_manager._curr_process = vm.process_manager._processes[p3_traps_pid]
+        factorial = -1 if number < 0 else math.factorial(number)
+        self.assertEqual(factorial, vm.process_manager.access(50).command.execute())
+
     def test_multiple_processes(self):
         """
         Test loading multiple processes on the memory
@@ -194,6 +256,72 @@ class AssemblyTest(unittest.TestCase):
         self.assertEqual(720, last_frame.addresses[2].command.execute())
 
 
+    def test_load_many(self):
+        """
+        Test decoding several programs in parallel worker processes and installing them at once
+        """
+
+        files = [Path(self.path + 'example_programs/p3.asm')] * 4 + [Path(self.path + 'example_programs/missing.asm')]
+        pids = self.vm.load_many(files, workers=2)
+
+        self.assertEqual(-1, pids[-1])
+        self.assertEqual(len(set(pids[:-1])), 4)
+
+        def nothing(*args):
+            pass
+
+        # Don't dealloc() frames, don't zero the memory on alloc()
+        self.vm.memory.deallocate = nothing
+        self.vm.memory.zero_memory_in_frame = nothing
+
+        self.vm.start()
+        self.vm.join()
+
+        # DATA 720: 3rd pos in last frame
+        for pid in pids[:-1]:
+            with self.subTest(pid=pid):
+                last_frame = self.vm.process_manager._processes[pid].frames[-1]
+                self.assertEqual(720, last_frame.addresses[2].command.execute())
+
+    def test_program_cache(self):
+        """
+        Test that repeated loads reuse the decoded program until the file changes
+        """
+
+        import os
+
+        vm = VirtualMachine(mem_size=4096, program_cache_size=1)
+
+        p3 = self.write_program(Path(self.path + 'example_programs/p3.asm').read_text(), 'p3.asm')
+        p2 = self.write_program(Path(self.path + 'example_programs/p2.asm').read_text(), 'p2.asm')
+
+        pids = [vm.load_from_file(p3), vm.load_from_file(p3)]
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0},
+                         {k: vm.program_cache.stats()[k] for k in ('hits', 'misses', 'evictions')})
+
+        # Same size, newer modification time
+        os.utime(p3, ns=(os.stat(p3).st_atime_ns, os.stat(p3).st_mtime_ns + 10 ** 9))
+        pids.append(vm.load_from_file(p3))
+        self.assertEqual(2, vm.program_cache.misses)
+
+        vm.load_from_file(p2)
+        self.assertEqual(1, vm.program_cache.evictions)
+
+        def nothing(*args):
+            pass
+
+        # Don't dealloc() frames
+        vm.memory.deallocate = nothing
+
+        vm.start()
+        vm.join()
+
+        # DATA 720: 3rd pos in last frame
+        for pid in pids:
+            with self.subTest(pid=pid):
+                last_frame = vm.process_manager._processes[pid].frames[-1]
+                self.assertEqual(720, last_frame.addresses[2].command.execute())
+
     def test_input_scheduling(self):
         """
         Test various IO input calls from different processes
@@ -216,7 +344,7 @@ class AssemblyTest(unittest.TestCase):
             pass
 
         # Don't dealloc() frames, don't zero the memory on alloc()
-        self.vm.memory.deallocate = nothing
+        self.keep_frames(self.vm, pids)
         self.vm.memory.zero_memory_in_frame = nothing
 
         with patch('builtins.input', side_effect = factorials):
@@ -231,13 +359,533 @@ class AssemblyTest(unittest.TestCase):
             self.assertIn(result, results)
             results.remove(result)
 
+    def test_io_devices_in_parallel(self):
+        """
+        Test that a process waiting for input doesn't hold back another process's output
+        """
+
+        import threading
+
+        output_done = threading.Event()
+
+        def slow_input(*args):
+            # Only returns once the other process has printed, which can't happen if they share a queue
+            output_done.wait(timeout=5)
+            return 3
+
+        def fake_print(*args):
+            if 'OUTPUT: 7' in str(args[0]):
+                output_done.set()
+
+        out_program = self.write_program('LDI R0, 7\nSTD [20], R0\nLDI R8, 2\nLDI R9, 20\nTRAP R8, R9\nSTOP\n',
+                                         'out.asm')
+        in_pid = self.vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'))
+        self.vm.load_from_file(out_program)
+
+        self.keep_frames(self.vm, [in_pid])
+
+        with patch('builtins.input', side_effect=slow_input), patch('builtins.print', side_effect=fake_print):
+            self.vm.start()
+            self.vm.join()
+
+        self.assertTrue(output_done.is_set())
+        stats = self.vm.io_handler.stats()
+        self.assertEqual(1, stats['stdin']['completed'])
+        self.assertEqual(2, stats['stdout']['completed'])  # P3 Traps prints its result as well
+        self.assertEqual(0, stats['stdin']['depth'])
+
+        self.vm.process_manager._curr_process = self.vm.process_manager._processes[in_pid]
+        self.assertEqual(6, self.vm.process_manager.access(50).command.execute())
+
+    def test_asyncio_io_backend(self):
+        """
+        Test servicing TRAP I/O from many processes on the asyncio I/O subsystem
+        """
+
+        import math
+
+        vm = VirtualMachine(mem_size=4096, io_backend='asyncio')
+        pids = [vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm')) for _ in range(20)]
+
+        self.keep_frames(vm, pids)
+
+        with patch('builtins.input', return_value=5):
+            vm.start()
+            vm.join()
+
+        for pid in pids:
+            with self.subTest(pid=pid):
+                vm.process_manager._curr_process = vm.process_manager._processes[pid]
+                self.assertEqual(math.factorial(5), vm.process_manager.access(50).command.execute())
+
+        self.assertEqual(len(pids), vm.io_handler.stats()['stdin']['completed'])
+
+    @parameterized.expand([
+        ('thread',), ('asyncio',)
+    ])
+    def test_pluggable_devices(self, io_backend):
+        """
+        Test feeding TRAP input from memory and collecting the output of each process
+        """
+
+        import math
+        from source.vm.devices import ListInput, MemoryOutput
+
+        stdout = MemoryOutput()
+        vm = VirtualMachine(mem_size=4096, io_backend=io_backend, stdin=ListInput([4] * 10), stdout=stdout)
+        pids = [vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'), _print=False) for _ in range(10)]
+        # A process can have its own devices as well
+        own_stdout = MemoryOutput()
+        own_pid = vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'), _print=False,
+                                    stdin=ListInput([6]), stdout=own_stdout)
+
+        vm.start()
+        vm.join()
+
+        self.assertEqual({pid: [math.factorial(4)] for pid in pids}, stdout.by_process())
+        self.assertEqual({own_pid: [math.factorial(6)]}, own_stdout.by_process())
+        # Requests are queued by device name, so both in-memory outputs share a queue
+        self.assertEqual(11, vm.io_handler.stats()['memory-out']['completed'])
+
+    @parameterized.expand([
+        ('thread', 1), ('thread', 8), ('asyncio', 8)
+    ])
+    def test_io_completion_batches(self, io_backend, batch_size):
+        """
+        Test delivering finished I/O requests to the CPU in batches
+        """
+
+        import math
+        from source.vm.devices import ListInput, MemoryOutput
+
+        stdout = MemoryOutput()
+        vm = VirtualMachine(mem_size=8192, io_backend=io_backend, stdin=ListInput([3] * 40), stdout=stdout,
+                            io_batch_size=batch_size, io_batch_delay=1)
+        pids = [vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'), _print=False) for _ in range(40)]
+
+        vm.start()
+        vm.join()
+
+        self.assertEqual({pid: [math.factorial(3)] for pid in pids}, stdout.by_process())
+        stats = vm.io_handler.completions.stats()
+        self.assertEqual(80, stats['completed'])
+        self.assertEqual(0, stats['pending'])
+        # Completions are coalesced while an interruption is pending or until the next context switch
+        self.assertLessEqual(stats['interrupts'], 80 // batch_size)
+
+    def test_io_completion_delay(self):
+        """
+        Test that a lone finished I/O request interrupts the CPU once it has waited the batch delay
+        """
+
+        from unittest import mock
+        from source.vm.io_handler import CompletionBuffer
+
+        owner = mock.Mock()
+        completions = CompletionBuffer(owner, batch_size=16, max_delay=0.01)
+        completions.add(1)
+        owner.cpu.queue_interrupt.assert_not_called()
+        for _ in range(100):
+            if owner.cpu.queue_interrupt.called:
+                break
+            sleep(0.01)
+        owner.cpu.queue_interrupt.assert_called_once()
+        self.assertEqual([1], completions.drain())
+
+        # Drained before the delay, there is nothing to interrupt for
+        completions.add(2)
+        self.assertEqual([2], completions.drain())
+        sleep(0.05)
+        self.assertEqual(1, owner.cpu.queue_interrupt.call_count)
+
+    @parameterized.expand([
+        ('thread',), ('asyncio',)
+    ])
+    def test_block_io(self, io_backend):
+        """
+        Test copying a block of words from a memory-mapped device into memory and back
+        """
+
+        from array import array
+        from source.vm.devices import MappedBlockDevice
+
+        block_file = self.temporary_directory() / 'block.bin'
+        block_file.write_bytes(array('q', [*range(-5, 15), *[0] * 20]).tobytes())
+        # Read words 0-19 of device 0 into [40], then write them to words 20-39
+        program = self.write_program('LDI R5, 0\nLDI R6, 0\nLDI R7, 20\nLDI R8, 3\nLDI R9, 40\nTRAP R8, R9\n'
+                                     'LDI R6, 20\nLDI R8, 4\nTRAP R8, R9\nSTOP\n', 'block.asm')
+
+        device = MappedBlockDevice(block_file)
+        vm = VirtualMachine(mem_size=4096, io_backend=io_backend, block_devices={0: device})
+        pid = vm.load_from_file(program, _print=False)
+        self.keep_frames(vm, [pid])
+
+        vm.start()
+        vm.join()
+
+        process = vm.process_manager._processes[pid]
+        self.assertEqual(list(range(-5, 15)), vm.process_manager.load_block(40, 20, process))
+        self.assertEqual([*range(-5, 15)] * 2, device.read_block(0, 40))
+        device.close()
+        self.assertEqual(array('q', [*range(-5, 15)] * 2).tobytes(), block_file.read_bytes())
+        self.assertEqual(2, vm.io_handler.stats()[device.name]['completed'])
+
+        # The I/O threads stop with the VM
+        if io_backend == 'thread':
+            threads = [thread for io_device in vm.io_handler.devices.values() for thread in io_device.threads]
+        else:
+            threads = [vm.io_handler._thread, *vm.io_handler._executor._threads]
+            self.assertTrue(vm.io_handler.loop.is_closed())
+        self.assertFalse(any(thread.is_alive() for thread in [*threads, vm.io_handler.completions._timer]))
+
+    def test_block_device_files(self):
+        """
+        Test creating block devices and rejecting files that can't be one
+        """
+
+        from source.vm.devices import MappedBlockDevice
+
+        directory = self.temporary_directory()
+        with self.assertRaisesRegex(ValueError, 'size of the block device'):
+            MappedBlockDevice(directory / 'new.bin')
+        device = MappedBlockDevice(directory / 'new.bin', 16)
+        self.assertEqual([0] * 16, device.read_block(0, 16))
+        # Reads and writes of whole blocks exclude each other
+        with patch.object(device, '_lock') as lock:
+            device.write_block(0, [1] * 8)
+            device.read_block(0, 16)
+        self.assertEqual(2, lock.__enter__.call_count)
+        device.close()
+        self.assertEqual(128, (directory / 'new.bin').stat().st_size)
+
+        (directory / 'odd.bin').write_bytes(b'\0' * 12)
+        with self.assertRaisesRegex(ValueError, 'whole number'):
+            MappedBlockDevice(directory / 'odd.bin')
+
+    def test_concurrent_frame_allocation(self):
+        """
+        Test that processes grown by block reads on I/O workers and programs loaded meanwhile never share a frame
+        """
+
+        from array import array
+        from source.vm.devices import MappedBlockDevice
+
+        block_file = self.temporary_directory() / 'block.bin'
+        block_file.write_bytes(array('q', range(64)).tobytes())
+        device = MappedBlockDevice(block_file)
+        self.addCleanup(device.close)
+        # Reads the whole device past the end of the program, which grows the process by 17 frames
+        source = 'LDI R5, 0\nLDI R6, 0\nLDI R7, 64\nLDI R8, 3\nLDI R9, 200\nTRAP R8, R9\nSTOP\n'
+        vm = VirtualMachine(mem_size=16384, keep_alive=True, io_workers=4, block_devices={0: device})
+        self.addCleanup(vm.join)
+        self.addCleanup(vm.shutdown)
+        memory = vm.memory
+
+        def slow_next_free_frame():
+            frame = next(frame for frame in memory.frames if frame.is_free)
+            sleep(0.0001)  # Between finding a free frame and taking it, where another thread could take it too
+            frame.is_free = False
+            memory._free_frames -= 1
+            return frame
+
+        memory.get_next_free_frame = slow_next_free_frame
+        vm.start()
+
+        jobs = [vm.submit(source, memory=[(200, 264)], name=f'reader{i}') for i in range(40)]
+        results = [job.result(10) for job in jobs]
+
+        self.assertEqual([[list(range(64))]] * 40, [result.memory for result in results])
+        self.assertEqual(sum(frame.is_free for frame in memory.frames), memory.free_frames())
+        self.assertEqual(memory.frame_amount, memory.free_frames())
+
+    @parameterized.expand([
+        ('round-robin',), ('priority',), ('mlfq',)
+    ])
+    def test_schedulers(self, scheduler):
+        """
+        Test running a mix of CPU and I/O-bound programs with every scheduling policy
+        """
+
+        import math
+        from source.vm.devices import ListInput, MemoryOutput
+
+        stdout = MemoryOutput()
+        vm = VirtualMachine(mem_size=4096, scheduler=scheduler, stdin=ListInput([5] * 5), stdout=stdout)
+        fibonacci_pid = vm.load_from_file(Path(self.path + 'example_programs/fibonacci.asm'), _print=False)
+        pids = [vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'), _print=False, priority=i)
+                for i in range(5)]
+
+        ended = []
+        end_current_process = vm.process_manager.end_current_process
+
+        def record_end():
+            ended.append(vm.process_manager.current_process.pid)
+            end_current_process()
+
+        vm.process_manager.end_current_process = record_end
+        self.keep_frames(vm, [fibonacci_pid, *pids])
+
+        vm.start()
+        vm.join()
+
+        self.assertEqual({pid: [math.factorial(5)] for pid in pids}, stdout.by_process())
+        # Idle 'system' processes end too
+        ended = [pid for pid in ended if pid in (fibonacci_pid, *pids)]
+        self.assertCountEqual([fibonacci_pid, *pids], ended)
+        vm.process_manager._curr_process = vm.process_manager._processes[fibonacci_pid]
+        self.assertEqual(34, vm.process_manager.access(59).command.execute())
+
+    def test_priority_scheduler(self):
+        """
+        Test that CPU-bound processes with a higher priority run to completion first
+        """
+
+        vm = VirtualMachine(mem_size=4096, scheduler='priority')
+        pids = [vm.load_from_file(Path(self.path + 'example_programs/fibonacci.asm'), _print=False, priority=priority)
+                for priority in (0, 2, 1)]
+
+        ended = []
+        end_current_process = vm.process_manager.end_current_process
+
+        def record_end():
+            ended.append(vm.process_manager.current_process.pid)
+            end_current_process()
+
+        vm.process_manager.end_current_process = record_end
+        vm.start()
+        vm.join()
+
+        self.assertEqual([pids[1], pids[2], pids[0]], [pid for pid in ended if pid in pids])
+
+    def test_mlfq_scheduler(self):
+        """
+        Test that the MLFQ scheduler favors processes that block over the ones that use up their time slice
+        """
+
+        from source.memory.process import ProcessControlBlock
+        from source.memory.scheduler import MLFQScheduler, ReadyReason
+
+        scheduler = MLFQScheduler(quanta=(2, 4, 8), boost_interval=0)
+        cpu_bound, io_bound = ProcessControlBlock('cpu', 1, [], 0), ProcessControlBlock('io', 2, [], 0)
+        scheduler.add(cpu_bound)
+        scheduler.add(io_bound)
+
+        self.assertIs(cpu_bound, scheduler.next())
+        scheduler.add(cpu_bound, ReadyReason.PREEMPTED)
+        self.assertEqual(4, scheduler.quantum(cpu_bound))
+        self.assertIs(io_bound, scheduler.next())
+        scheduler.add(io_bound, ReadyReason.UNBLOCKED)
+        self.assertEqual(2, scheduler.quantum(io_bound))
+
+        # The I/O-bound process goes first even though it became ready last
+        self.assertIs(io_bound, scheduler.next())
+        self.assertIs(cpu_bound, scheduler.next())
+        self.assertIsNone(scheduler.next())
+
+    @parameterized.expand([
+        ('round-robin',), ('mlfq',)
+    ])
+    def test_wakeup_preemption(self, scheduler):
+        """
+        Test that processes whose I/O has finished take the CPU from CPU-bound processes
+        """
+
+        import math
+        from source.vm.devices import ListInput, MemoryOutput
+
+        stdout = MemoryOutput()
+        vm = VirtualMachine(mem_size=8192, scheduler=scheduler, wakeup_preemption=True, stdin=ListInput([5] * 5),
+                            stdout=stdout)
+        for _ in range(10):
+            vm.load_from_file(Path(self.path + 'example_programs/fibonacci.asm'), _print=False)
+        pids = [vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'), _print=False) for _ in range(5)]
+
+        woken = []
+        set_current_process = vm.process_manager.set_current_process
+
+        def record_woken(process):
+            # The process that runs right after a wake-up preemption is the one that woke up
+            if vm.process_manager._preempting:
+                woken.append(process.pid)
+            set_current_process(process)
+
+        vm.process_manager.set_current_process = record_woken
+        vm.start()
+        vm.join()
+
+        self.assertEqual({pid: [math.factorial(5)] for pid in pids}, stdout.by_process())
+        self.assertTrue(set(woken) <= set(pids))
+        # Every I/O request has woken its process up once
+        self.assertEqual(10, vm.process_manager.wakeup_latency.as_dict()['count'])
+
+    def test_scheduling_histograms(self):
+        """
+        Test the per-process and aggregate scheduling latency histograms
+        """
+
+        import json
+        import math
+        from source.memory.histogram import Histogram
+        from source.vm.devices import ListInput, MemoryOutput
+
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record(0.0005)
+        histogram.record(1.5)
+        latency = histogram.as_dict()
+        self.assertEqual(100, latency['count'])
+        self.assertEqual(0.000512, latency['p50'])
+        self.assertEqual(0.000512, latency['p99'])
+        self.assertEqual(1.5, latency['max'])
+        self.assertEqual({'0.000512': 99, '2.09715': 1}, latency['buckets'])
+
+        stdout = MemoryOutput()
+        vm = VirtualMachine(mem_size=8192, stdin=ListInput([5] * 2), stdout=stdout)
+        cpu_bound = [vm.load_from_file(Path(self.path + 'example_programs/fibonacci.asm'), _print=False)
+                     for _ in range(3)]
+        io_bound = [vm.load_from_file(Path(self.path + 'example_programs/p3_traps.asm'), _print=False)
+                    for _ in range(2)]
+        vm.start()
+        vm.join()
+        self.assertEqual({pid: [math.factorial(5)] for pid in io_bound}, stdout.by_process())
+
+        process_manager = vm.process_manager
+        processes = [process_manager.process(pid) for pid in cpu_bound + io_bound]
+        for process in processes:
+            with self.subTest(pid=process.pid):
+                histograms = process.histograms
+                # Every time it entered the CPU, it came from the ready queue
+                self.assertEqual(process.context_switches, histograms.ready_wait.count)
+                self.assertEqual(2 if process.pid in io_bound else 0, histograms.io_wait.count)
+                self.assertEqual(histograms.io_wait.count, histograms.wakeup.count)
+                self.assertGreaterEqual(histograms.quantum_use.count, 1)
+                self.assertLessEqual(histograms.quantum_use.max, 1.0)
+        # CPU-bound processes use up their time slices
+        self.assertEqual(1.0, process_manager.process(cpu_bound[0]).histograms.quantum_use.percentile(50))
+
+        # The aggregate is every process's, and is reported by `stats`
+        stats = json.loads(vm.handle_shell_command('stats'))['scheduling']
+        for name in ('ready_wait', 'io_wait', 'wakeup', 'quantum_use'):
+            with self.subTest(histogram=name):
+                self.assertEqual(sum(getattr(process.histograms, name).count for process in processes),
+                                 stats[name]['count'])
+                self.assertEqual(stats[name]['count'], sum(stats[name]['buckets'].values()))
+        self.assertLessEqual(stats['io_wait']['p50'], stats['io_wait']['p99'])
+        proc = json.loads(vm.handle_shell_command(f'proc {io_bound[0]}'))
+        self.assertEqual(2, proc['scheduling']['io_wait']['count'])
+
+    def test_process_table(self):
+        """
+        Test that ended processes are reaped into summaries and that the process table stays bounded
+        """
+
+        vm = VirtualMachine(mem_size=4096, keep_ended=4, process_history=50)
+        program = self.write_program('LDI R0, 1\nSTOP\n', 'short.asm')
+        pids = vm.load_many([program] * 100, workers=1, _print=False)
+
+        vm.start()
+        vm.join()
+
+        # The idle process is reaped right away, only the last `keep_ended` processes are kept whole
+        self.assertEqual(pids[-4:], [process.pid for process in vm.process_manager._processes])
+        self.assertEqual(2, vm.process_manager.process(pids[-1]).instructions)
+        with self.assertRaises(KeyError):
+            vm.process_manager.process(pids[0])
+
+        summary = vm.process_manager.summary(pids[-10])
+        self.assertEqual(('ENDED', 'stop', 2), (summary.state, summary.exit_reason, summary.instructions))
+        self.assertIsNone(vm.process_manager.summary(pids[0]))
+
+    @parameterized.expand([
+        ('reject',), ('queue',)
+    ])
+    def test_admission_control(self, admission):
+        """
+        Test loading more programs than fit in memory at once
+        """
+
+        from source.memory.memory import EOutOfMemory
+        from source.memory.program import decode_program
+
+        # 4 frames of 16 words. The system process takes one until the VM starts
+        vm = VirtualMachine(mem_size=64, admission=admission)
+        # 2 frames
+        program = self.write_program('LDI R0, 7\nSTD [20], R0\nSTOP\n' + 'DATA 0\n' * 20, 'big.asm')
+        pids = [vm.load_from_file(program, _print=False) for _ in range(3)]
+
+        # Never fits, whatever the policy
+        with self.assertRaises(EOutOfMemory):
+            vm.process_manager.install_image(decode_program('huge', ['DATA 0'] * 100))
+
+        stats = vm.process_manager.admission_stats()
+        if admission == 'reject':
+            self.assertEqual(-1, pids[1])
+            self.assertEqual(-1, pids[2])
+            self.assertEqual(0, stats['pending'])
+        else:
+            self.assertNotIn(-1, pids)
+            self.assertEqual(2, stats['pending'])
+
+        vm.start()
+        vm.join()
+
+        for pid in (pid for pid in pids if pid != -1):
+            with self.subTest(pid=pid):
+                summary = vm.process_manager.summary(pid)
+                self.assertEqual(('ENDED', 3), (summary.state, summary.instructions))
+
+        stats = vm.process_manager.admission_stats()
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(2 if admission == 'queue' else 0, stats['wait']['count'])
+        self.assertEqual(3 if admission == 'reject' else 1, stats['rejected'])
+
+    @parameterized.expand([
+        ('terminate',), ('deprioritize',)
+    ])
+    def test_instruction_budget(self, budget_action):
+        """
+        Test that a runaway process can't run past its instruction budget
+        """
+
+        vm = VirtualMachine(mem_size=4096, budget_action=budget_action)
+        # Endless loop, unless it's the last time through
+        runaway = self.write_program('LDI R1, 0\nADDI R2, 1\nLDI R3, 300\nSUB R3, R2\nLDI R4, 0\nJMPIG R4, R3\nSTOP\n',
+                                     'runaway.asm')
+        runaway_pid = vm.load_from_file(runaway, _print=False, instruction_budget=100)
+        fibonacci_pid = vm.load_from_file(Path(self.path + 'example_programs/fibonacci.asm'), _print=False)
+
+        ended = []
+        end_current_process = vm.process_manager.end_current_process
+
+        def record_end(*args):
+            ended.append(vm.process_manager.current_process.pid)
+            end_current_process(*args)
+
+        vm.process_manager.end_current_process = record_end
+        vm.start()
+        vm.join()
+
+        runaway, fibonacci = vm.process_manager.summary(runaway_pid), vm.process_manager.summary(fibonacci_pid)
+        self.assertEqual('stop', fibonacci.exit_reason)
+        self.assertGreater(fibonacci.context_switches, 1)
+        self.assertGreater(fibonacci.run_time, 0)
+        if budget_action == 'terminate':
+            self.assertEqual('budget', runaway.exit_reason)
+            self.assertGreaterEqual(runaway.instructions, 100)
+            self.assertLess(runaway.instructions, 100 + vm.process_manager.scheduler.quantum(None) + 1)
+        else:
+            # Demoted, it only finishes after the other process
+            self.assertEqual('stop', runaway.exit_reason)
+            self.assertTrue(vm.process_manager.process(runaway_pid).demoted)
+            self.assertLess(ended.index(fibonacci_pid), ended.index(runaway_pid))
+
     def test_load_program_from_socket(self):
         from source.user.shell import CommandHandler
         import socket
 
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(('localhost', 8899))
+            sock.connect(self.vm.shell_address)
         except Exception as E:
             self.fail(f'Could not connect to socket server. {E}')
 
@@ -251,6 +899,470 @@ class AssemblyTest(unittest.TestCase):
 
         self.assertEqual(len(progs) + 1, len(self.vm.process_manager._processes))
 
+    def test_pipelined_protocol(self):
+        import socket
+        from concurrent.futures import Future
+        from source.user.shell import CommandHandler
+        from source.vm.protocol import FrameDecoder, FrameKind, decode_upload_command, encode_frame, encode_upload
+
+        # `upload` command headers, whose priority is optional
+        self.assertEqual(('my prog.asm', 'STOP\n', 2), decode_upload_command('my prog.asm 2\nSTOP\n'))
+        self.assertEqual(('p2.asm', 'STOP', 0), decode_upload_command(' p2.asm \nSTOP'))
+
+        # Frames split and merged arbitrarily by the transport are put back together
+        stream = b''.join(encode_frame(i, FrameKind.REPLY, b'x' * i) for i in range(5))
+        decoder = FrameDecoder()
+        frames = [frame for i in range(0, len(stream), 3) for frame in decoder.feed(stream[i:i + 3])]
+        self.assertEqual([(i, b'x' * i) for i in range(5)], [(f.request_id, f.payload) for f in frames])
+
+        source = Path('example_programs/p2.asm').read_text()
+        with socket.create_connection(self.vm.shell_address) as sock:
+            handler = CommandHandler(sock)
+            # Everything is sent before a single reply is read
+            ids = [handler.request(FrameKind.UPLOAD, encode_upload('p2.asm', source.encode(), 3)) for _ in range(20)]
+            ids.append(handler.request(FrameKind.COMMAND, f'upload p2.asm 2\n{source}'.encode()))
+            ids.append(handler.request(FrameKind.COMMAND, b'load example_programs/p3.asm'))
+            ids.append(handler.request(FrameKind.UPLOAD, b'\0'))
+
+            replies = [handler.reply(request_id) for request_id in reversed(ids)][::-1]
+            self.assertEqual(FrameKind.ERROR, replies.pop().kind)
+            pids = [int(reply.text().rpartition(' ')[2]) for reply in replies]
+            self.assertEqual(22, len(set(pids)))
+            self.assertNotIn(-1, pids)
+
+            # Commands that fail, now or later, get an error and the connection goes on
+            failed = Future()
+            failed.set_exception(RuntimeError('The VM has shut down'))
+            with patch.object(self.vm.status, 'ps', side_effect=KeyError('pid')), \
+                    patch.object(self.vm.jobs, 'submit_json', return_value=failed):
+                ids = [handler.request(FrameKind.COMMAND, command) for command in (b'ps', b'job {}', b'mem')]
+                replies = [handler.reply(request_id) for request_id in ids]
+            self.assertEqual([FrameKind.ERROR, FrameKind.ERROR, FrameKind.REPLY], [reply.kind for reply in replies])
+            self.assertEqual(["'pid'", 'The VM has shut down'], [reply.text() for reply in replies[:2]])
+
+        # Every upload of the same program is decoded once: one miss for it and one for p3.asm
+        self.assertEqual(2, self.vm.program_cache.stats()['misses'])
+        self.assertEqual([3] * 20 + [2], [self.vm.process_manager.process(pid).priority for pid in pids[:21]])
+        self.assertTrue(self.vm.process_manager.process(pids[0]).name.startswith('p2.asm'))
+
+    def test_status_commands(self):
+        import json
+
+        vm = VirtualMachine(mem_size=4096, scheduler='priority')
+        slow = vm.load_from_file(Path('example_programs/fibonacci.asm'), priority=-1)
+        fast = vm.load_from_file(Path('example_programs/fibonacci.asm'))
+        used = vm.memory.frame_amount - vm.memory.free_frames()
+
+        ps = json.loads(vm.handle_shell_command('ps'))
+        self.assertEqual({slow, fast}, {process['pid'] for process in ps if process['name'].startswith('fib')})
+        self.assertEqual(used, sum(process['frames'] for process in ps))
+        self.assertEqual({'page_size': 16, 'frames': 256, 'free_frames': 256 - used, 'used_frames': used,
+                          'pending_admission': 0}, json.loads(vm.handle_shell_command('mem')))
+
+        vm.start()
+        vm.join()
+        stats = json.loads(vm.handle_shell_command('stats'))
+        details = [json.loads(vm.handle_shell_command(f'proc {pid}')) for pid in (slow, fast)]
+        # The system process the VM starts with runs too, and has been reaped since
+        system = json.loads(vm.handle_shell_command('proc 0'))
+        self.assertTrue(system['reaped'])
+        self.assertEqual(sum(process['instructions'] for process in details + [system]), stats['instructions'])
+        self.assertGreater(stats['instructions_per_second'], 0)
+        self.assertGreaterEqual(stats['context_switches'], 3)
+        self.assertEqual((0, [], 0), (stats['run_queue'], stats['blocked'], stats['io_queue_depth']))
+        self.assertEqual(256, stats['free_frames'])
+        self.assertEqual(['ENDED', 'ENDED'], [process['state'] for process in details])
+
+        # Rates are measured since the previous snapshot
+        self.assertEqual(0, json.loads(vm.handle_shell_command('stats'))['instructions_per_second'])
+        self.assertIn('error', json.loads(vm.handle_shell_command('proc 12345')))
+        self.assertIn('error', json.loads(vm.handle_shell_command('proc x')))
+        self.assertEqual('Unknown command: top', vm.handle_shell_command('top'))
+        # A command that fails isn't mistaken for an unknown one
+        with patch.object(vm.status, 'ps', side_effect=KeyError('pid')):
+            with self.assertRaises(KeyError):
+                vm.handle_shell_command('ps')
+
+    def test_jobs(self):
+        import json
+        import math
+        import socket
+        from source.user.shell import CommandHandler
+        from source.vm.protocol import FrameKind
+
+        vm = VirtualMachine(mem_size=4096, keep_alive=True, shell_endpoint=0)
+        self.addCleanup(vm.shutdown)
+        vm.start()
+
+        jobs = [vm.submit(Path('example_programs/p3_traps.asm'), inputs=[n]) for n in range(1, 8)]
+        fibonacci = vm.submit(Path('example_programs/fibonacci.asm'), memory=[(50, 60), (0, 1)])
+        self.assertEqual([[math.factorial(n)] for n in range(1, 8)], [job.result(5).outputs for job in jobs])
+        result = fibonacci.result(5)
+        self.assertEqual([[0, 1, 1, 2, 3, 5, 8, 13, 21, 34], [None]], result.memory)
+        # Past the end of the process, there is nothing to read
+        beyond = vm.submit(Path('example_programs/fibonacci.asm'), memory=[(50, 52), (5000, 5002)]).result(5)
+        self.assertEqual(('stop', [[0, 1], [None, None]]), (beyond.exit_reason, beyond.memory))
+        with self.assertRaises(ValueError):
+            vm.submit(Path('example_programs/fibonacci.asm'), memory=[(-1, 2)])
+        self.assertEqual(('stop', fibonacci.pid), (result.exit_reason, result.pid))
+
+        # A job given too few inputs is ended, instead of going on with a value it never read
+        starved = vm.submit(Path('example_programs/p3_traps.asm')).result(5)
+        self.assertEqual(('io_error', [], 'No more input values'),
+                         (starved.exit_reason, starved.outputs, starved.io_error))
+
+        # A budget of 0 is a budget, not the VM's default
+        vm.instruction_budget = 10_000
+        self.assertEqual('stop', vm.submit(Path('example_programs/fibonacci.asm')).result(5).exit_reason)
+        self.assertEqual('budget', vm.submit(Path('example_programs/fibonacci.asm'),
+                                             instruction_budget=0).result(5).exit_reason)
+        vm.instruction_budget = None
+
+        # The VM waits for more jobs instead of shutting down
+        sleep(0.05)
+        self.assertTrue(vm.is_alive())
+        with self.assertRaises(Exception):
+            vm.submit('NOT AN INSTRUCTION').result(5)
+
+        # Over the socket, the reply is sent once the job is done
+        vm.create_shell_socket()
+        with socket.create_connection(vm.shell_address) as sock:
+            handler = CommandHandler(sock)
+            source = Path('example_programs/p3_traps.asm').read_text()
+            job = handler.request(FrameKind.COMMAND, f'job {json.dumps({"source": source, "inputs": [5]})}'.encode())
+            ps = handler.request(FrameKind.COMMAND, b'ps')
+            self.assertEqual([120], json.loads(handler.reply(job).text())['outputs'])
+            self.assertIsInstance(json.loads(handler.reply(ps).text()), list)
+
+        vm.shutdown()
+        vm.join(5)
+        self.assertFalse(vm.is_alive())
+
+        # Jobs that haven't finished when the VM shuts down fail
+        vm = VirtualMachine(mem_size=4096, keep_alive=True)
+        job = vm.submit(Path('example_programs/fibonacci.asm'))
+        vm.shutdown()
+        vm.start()
+        vm.join(5)
+        with self.assertRaises(RuntimeError):
+            job.result(5)
+
+    def test_dispatcher(self):
+        import json
+        import math
+        import socket
+        from source.user.shell import CommandHandler
+        from source.vm.dispatcher import Dispatcher
+        from source.vm.protocol import FrameKind
+
+        socket_dir = self.temporary_directory()
+        with Dispatcher(workers=2, vm_options={'trace': 64}, poll_interval=0.05, socket_dir=socket_dir) as dispatcher:
+            self.assertEqual([f'{socket_dir}/vm-{i}.sock' for i in range(2)],
+                             [worker.address for worker in dispatcher.workers])
+            jobs = [dispatcher.submit(Path('example_programs/p3_traps.asm'), inputs=[n]) for n in range(1, 7)]
+            results = [job.result(10) for job in jobs]
+            self.assertEqual([[math.factorial(n)] for n in range(1, 7)], [result['outputs'] for result in results])
+            # Spread over both workers
+            self.assertEqual({0, 1}, {result['worker'] for result in results})
+
+            # Clients talk to the dispatcher as they would to a single VM. Once the workers' load has been polled
+            # again, after the jobs, they're equally loaded and take turns
+            dispatcher.serve(0)
+            sleep(0.2)
+            with socket.create_connection(dispatcher.address) as sock:
+                handler = CommandHandler(sock)
+                uploads = handler.upload([Path('example_programs/fibonacci.asm')] * 4)
+                pids = [reply.rpartition(' ')[2] for reply in uploads]
+                self.assertEqual({'0', '1'}, {pid.partition(':')[0] for pid in pids})
+
+                sleep(0.2)
+                stats = json.loads(handler.reply(handler.request(FrameKind.COMMAND, b'stats')).text())
+                self.assertEqual(2, len(stats['workers']))
+                self.assertEqual(sum(worker['instructions'] for worker in stats['workers']),
+                                 stats['total']['instructions'])
+                process = json.loads(handler.reply(handler.request(FrameKind.COMMAND, f'proc {pids[0]}'.encode()))
+                                     .text())
+                self.assertEqual('ENDED', process['state'])
+                ps = json.loads(handler.reply(handler.request(FrameKind.COMMAND, b'ps')).text())
+                self.assertTrue(set(pids) <= {process['pid'] for process in ps})
+
+                # Every worker writes a trace of its own
+                trace = socket_dir / 'dispatcher.trace'
+                traces = json.loads(handler.reply(handler.request(FrameKind.COMMAND, f'trace {trace}'.encode()))
+                                    .text())
+                self.assertEqual([str((socket_dir / f'dispatcher-{i}.trace').resolve()) for i in range(2)],
+                                 [worker_trace['file'] for worker_trace in traces])
+                self.assertTrue(all(Path(worker_trace['file']).exists() for worker_trace in traces))
+                profiles = json.loads(handler.reply(handler.request(FrameKind.COMMAND, b'profile')).text())
+                self.assertEqual(2, len(profiles))
+                self.assertIn('error', json.loads(handler.reply(handler.request(FrameKind.COMMAND, b'subscribe'))
+                                                  .text()))
+
+        self.assertFalse(any(worker.process.is_alive() for worker in dispatcher.workers))
+
+    def test_client(self):
+        import math
+        from source.user.client import Client
+
+        vm = VirtualMachine(mem_size=8192, keep_alive=True, shell_endpoint=0, create_shell_sock=True)
+        self.addCleanup(vm.shutdown)
+        vm.start()
+        with Client([vm.shell_address[:2]], pool_size=3, timeout=10) as client:
+            pids = client.upload_files([Path('example_programs/fibonacci.asm')] * 20)
+            self.assertEqual(20, len(set(pids)))
+            self.assertEqual(pids[0], client.proc(pids[0])['pid'])
+            self.assertEqual(3, sum(connection is not None for connection in client.client._pools[
+                vm.shell_address[:2]]))
+
+            job = client.job(Path('example_programs/p3_traps.asm'), inputs=[6])
+            self.assertEqual([math.factorial(6)], job.result(10)['outputs'])
+            self.assertEqual(-1, client.upload('bad.asm', 'NOT AN INSTRUCTION'))
+
+            # The VM drops every connection, requests go on over new ones
+            address = vm.shell_address
+            vm.end_threads = True
+            vm._end_threads = False
+            vm.shell_endpoint = address
+            vm.create_shell_socket()
+            self.assertIn('instructions', client.stats())
+            self.assertGreaterEqual(client.client.reconnects, 1)
+
+            client.shutdown()
+        vm.join(5)
+        self.assertFalse(vm.is_alive())
+
+    def test_events(self):
+        import threading
+        from source.user.client import Client
+        from source.vm.events import EventBus
+
+        bus = EventBus(max_queue=2)
+        with self.assertRaises(ValueError):
+            bus.subscribe(['bogus'])
+        slow, outputs = bus.subscribe(), bus.subscribe(['output'])
+        for pid in range(3):
+            bus.publish('scheduled', pid)
+        bus.publish('output', 0, value=7)
+        # The slow subscriber is dropped rather than holding the publisher back, the others don't notice
+        self.assertTrue(slow.dropped)
+        self.assertEqual([0, 1], [event.pid for event in slow.drain()])
+        self.assertEqual([{'value': 7}], [event.data for event in outputs.get(1)])
+        self.assertEqual((1, 1), (len(bus), bus.dropped))
+
+        vm = VirtualMachine(mem_size=512, keep_alive=True, shell_endpoint=0, create_shell_sock=True)
+        self.addCleanup(vm.shutdown)
+        vm.start()
+        with Client([vm.shell_address[:2]], timeout=10) as client:
+            events = []
+
+            def watch():
+                for event in client.subscribe(['created', 'output', 'ended']):
+                    events.append(event)
+                    if event['event'] == 'ended':
+                        return
+
+            watcher = threading.Thread(target=watch, daemon=True)
+            watcher.start()
+            while not vm.events.active:
+                sleep(0.01)
+            out_of_memory = vm.events.subscribe(['out_of_memory'])
+
+            pid = client.job(Path('example_programs/p3_traps.asm'), inputs=[5]).result(10)['pid']
+            watcher.join(10)
+            self.assertEqual([('created', pid), ('output', pid), ('ended', pid)],
+                             [(event['event'], event['pid']) for event in events])
+            self.assertEqual(120, events[1]['value'])
+            self.assertEqual('stop', events[2]['reason'])
+
+            self.assertEqual(-1, client.upload('huge.asm', 'STOP\n' * 1024))
+            event, = out_of_memory.get(5)
+            self.assertEqual(('out_of_memory', -1, 'huge.asm'), (event.kind, event.pid, event.data['name']))
+
+            # The subscription ends with the VM
+            client.shutdown()
+            vm.join(5)
+            self.assertTrue(out_of_memory.closed)
+            self.assertEqual(0, len(vm.events))
+
+    def test_profiler(self):
+        import json
+
+        self.assertIsNone(self.vm.profiler)
+        self.assertIn('error', json.loads(self.vm.handle_shell_command('profile')))
+
+        vm = VirtualMachine(mem_size=4096, profile=True)
+        pid = vm.load_from_file(Path('example_programs/fibonacci.asm'))
+        vm.start()
+        vm.join()
+        self.assertEqual(34, vm.process_manager.access(59, vm.process_manager.process(pid)).command.execute())
+        # The process manager is left as it was
+        self.assertNotIn('relative_to_absolute_address', vars(vm.process_manager))
+
+        profile = json.loads(vm.handle_shell_command('profile 3'))
+        self.assertEqual(vm.cpu.instructions_executed, profile['instructions'])
+        self.assertEqual(profile['instructions'], sum(op['instructions'] for op in profile['opcodes'].values()))
+        self.assertEqual(3, len(profile['hot_spots']))
+        # The loop body runs once per Fibonacci number after the first two
+        self.assertEqual(8, vm.profiler.addresses[(pid, 8)][0])
+        self.assertEqual('ADD', vm.profiler.addresses[(pid, 8)][3])
+        self.assertGreaterEqual(profile['subsystems']['translation']['count'], profile['instructions'])
+        self.assertGreaterEqual(profile['subsystems']['context_switch']['count'], 1)
+        self.assertIn('JMPIG', vm.profiler.report())
+
+        folded = self.temporary_directory() / 'profile.folded'
+        vm.profiler.write_folded(folded)
+        lines = folded.read_text().splitlines()
+        stacks = dict(line.rsplit(' ', 1) for line in lines)
+        self.assertIn(f'fibonacci.asm_{pid};8:ADD', stacks)
+        self.assertIn(f'fibonacci.asm_{pid};8:ADD;translation', stacks)
+        self.assertTrue(all(int(ns) > 0 for ns in stacks.values()))
+
+    def test_trace(self):
+        import json
+
+        from source.cpu.trace import read_trace
+
+        self.assertIsNone(self.vm.tracer)
+        self.assertIn('error', json.loads(self.vm.handle_shell_command('trace')))
+
+        directory = self.temporary_directory()
+        vm = VirtualMachine(mem_size=4096, trace=16, trace_file=directory / 'memory.trace')
+        pid = vm.load_from_file(Path('example_programs/fibonacci.asm'))
+        vm.start()
+        vm.join()
+        self.assertEqual(34, vm.process_manager.access(59, vm.process_manager.process(pid)).command.execute())
+        # Only the last instructions are kept, and the trace isn't written without a fault
+        entries = vm.tracer.entries()
+        self.assertEqual(16, len(entries))
+        self.assertFalse((directory / 'memory.trace').exists())
+        self.assertEqual(['ADDI', 'SUB', 'JMPIG', 'STOP'], [entry.opcode for entry in entries[-4:]])
+        self.assertEqual({'r8': 60}, entries[-4].registers)
+        self.assertEqual({}, entries[-2].registers)
+        self.assertEqual('EShutdown', entries[-1].interrupt)
+        self.assertEqual(sorted(entries, key=lambda entry: entry.time_ns), entries)
+
+        reply = json.loads(vm.handle_shell_command(f'trace {directory / "on_demand.trace"}'))
+        self.assertEqual(16, reply['instructions'])
+        self.assertEqual(entries, read_trace(directory / 'on_demand.trace').entries)
+
+        # A fault writes the trace
+        vm = VirtualMachine(mem_size=4096, trace=16, trace_file=directory / 'memory.trace')
+        pid = vm.load_source('fault', 'LDI R0, 7\nLDI R1, 2\nSTD [5000], R0\nSTOP\n')
+        vm.start()
+        vm.join()
+        trace = read_trace(directory / 'memory.trace')
+        self.assertIn('EInvalidAddress', trace.reason)
+        self.assertEqual(f'fault_{pid}', trace.processes[pid])
+        self.assertEqual([(pid, 'LDI', {'r0': 7}), (pid, 'LDI', {'r1': 2}), (pid, 'STD', {})],
+                         [(entry.pid, entry.opcode, entry.registers) for entry in trace.entries[-3:]])
+        self.assertEqual('EInvalidAddress', trace.entries[-1].interrupt)
+
+    def test_benchmark(self):
+        import copy
+        import os
+
+        import benchmark
+
+        # Nothing is written to the working directory
+        cwd, directory = os.getcwd(), self.temporary_directory()
+        os.chdir(directory)
+        try:
+            results = benchmark.run_benchmarks(['ips', 'load', 'frames'], repeat=1, quick=True)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual([], os.listdir(directory))
+        self.assertIn('ips.p4.n=20', results['results'])
+        for name, result in results['results'].items():
+            with self.subTest(name=name):
+                self.assertEqual(1, len(result['samples']))
+                self.assertGreater(result['value'], 0)
+
+        # Against itself, nothing changes
+        lines, regressions = benchmark.compare(results, results)
+        self.assertEqual([], regressions)
+        self.assertEqual(len(results['results']) + 1, len(lines))
+
+        # Slower is lower throughput or higher latency
+        baseline = copy.deepcopy(results)
+        baseline['results']['ips.fibonacci.n=100']['value'] *= 2
+        baseline['results']['load.lines=1000']['value'] /= 2
+        baseline['results']['frames.allocate']['value'] /= 2
+        del baseline['results']['ips.p3.n=100']
+        lines, regressions = benchmark.compare(results, baseline, threshold=0.1)
+        self.assertEqual(['ips.fibonacci.n=100', 'load.lines=1000'], regressions)
+        self.assertEqual(len(results['results']), len(lines))
+        self.assertTrue(any(line.startswith('frames.allocate') and line.endswith('faster') for line in lines))
+
+    def test_shell_server_shutdown(self):
+        import socket
+
+        # The port is taken by the VM of `setUp`: binding fails without bringing the VM down
+        address = self.vm.shell_address
+        vm = VirtualMachine(mem_size=4096, io_backend='asyncio', shell_endpoint=address)
+        self.addCleanup(vm.io_handler.close)  # The VM never runs, nothing else stops its I/O
+        vm.create_shell_socket()
+        self.assertIsNone(vm._shell_server)
+
+        # Once that VM closes its socket the port is free right away
+        self.vm.end_threads = True
+        vm.create_shell_socket()
+        self.assertEqual(address, vm.shell_address)
+        with socket.create_connection(address) as sock:
+            from source.user.shell import CommandHandler
+            from source.vm.protocol import FrameKind
+
+            handler = CommandHandler(sock)
+            self.assertEqual('Unknown command: bogus', handler.reply(handler.request(FrameKind.COMMAND, b'bogus')).text())
+
+            # Closing the server disconnects its clients
+            vm.end_threads = True
+            self.assertEqual(b'', sock.recv(4096))
+        with self.assertRaises(ConnectionRefusedError):
+            socket.create_connection(address).close()
+
+    def test_shell_endpoints(self):
+        import os
+        import socket
+        from source.user.client import Client
+        from source.user.shell import CommandHandler, connect
+        from source.vm.protocol import FrameKind, format_address, parse_address
+
+        for text, address in [('localhost:8900', ('localhost', 8900)), (':0', ('localhost', 0)), ('9', ('localhost', 9)),
+                              ('[::1]:8899', ('::1', 8899)), ('unix:vm.sock', 'vm.sock'), ('/run/vm.sock', '/run/vm.sock')]:
+            with self.subTest(address=text):
+                self.assertEqual(address, parse_address(text))
+                self.assertEqual(address, parse_address(format_address(address)))
+        with self.assertRaises(ValueError):
+            parse_address('localhost')
+
+        path = str(self.temporary_directory() / 'vm.sock')
+        vm = VirtualMachine(mem_size=4096, keep_alive=True, create_shell_sock=True, shell_endpoint=f'unix:{path}')
+        self.addCleanup(vm.shutdown)
+        vm.start()
+        self.assertEqual(path, vm.shell_address)
+
+        # A second VM can't take a socket that's in use
+        other = VirtualMachine(mem_size=4096, create_shell_sock=True, shell_endpoint=path)
+        self.assertIsNone(other.shell_address)
+
+        with Client([f'unix:{path}'], timeout=10) as client:
+            job = client.job(Path('example_programs/p3_traps.asm'), inputs=[4])
+            self.assertEqual([24], job.result(10)['outputs'])
+            with connect(path) as sock:
+                handler = CommandHandler(sock)
+                self.assertIn('pid', handler.reply(handler.request(FrameKind.COMMAND, b'proc 1')).text())
+            client.shutdown()
+        vm.join(5)
+        self.assertFalse(os.path.exists(path))
+
+        # A socket file left behind by a VM that's gone is replaced
+        with socket.socket(socket.AF_UNIX) as stale:
+            stale.bind(path)
+        vm = VirtualMachine(mem_size=4096, create_shell_sock=True, shell_endpoint=path)
+        self.assertEqual(path, vm.shell_address)
+        vm.end_threads = True
+        self.assertFalse(os.path.exists(path))
+
 
 if __name__ == '__main__':
     unittest.main()